@@ -9,11 +9,18 @@
  *
  */
 
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
+#include <float.h>
 #include <math.h>
 #include <string.h>
 #include <stdio.h>
 
+#if (defined(__x86_64__) || defined(__i386__)) && defined(__GNUC__)
+    #define SIMD_X86
+    #include <immintrin.h>
+#endif
+
 #if PY_MAJOR_VERSION >= 3
     #define PyInt_FromLong PyLong_FromLong
     #define PyString_Check PyUnicode_Check
@@ -485,19 +492,204 @@ static PyObject * c_metrics_max_subtotal(PyObject *self, PyObject * args)
 	
 }
 
+static void report_hit(double *scores, long long *pos, signed char *strand, int n_report, double score, long long j, signed char s) {
+	// Insert a hit in the sorted list of the n_report best hits
+	// Same insertion logic as in pwmscan(), so ties are reported in the same order
+	int p, q;
+
+	p = n_report - 1;
+	while ((p >= 0) && (score > scores[p])) {
+		p--;
+	}
+	if (p < (n_report - 1)) {
+		for (q = n_report - 1; q > (p + 1); q--) {
+			scores[q] = scores[q - 1];
+			pos[q] = pos[q - 1];
+			strand[q] = strand[q - 1];
+		}
+		scores[p + 1] = score;
+		pos[p + 1] = j;
+		strand[p + 1] = s;
+	}
+}
+
+static inline void append_hit(double *scores, long long *pos, signed char *strand, Py_ssize_t capacity,
+		Py_ssize_t *total, double score, long long j, signed char s) {
+	// Append a hit to the output of pwmscan_batch() with n_report 0. Hits
+	// that do not fit in the output are only counted.
+	if (*total < capacity) {
+		scores[*total] = score;
+		pos[*total] = j;
+		strand[*total] = s;
+	}
+	(*total)++;
+}
+
+// Number of positions that are scanned at once. Only this part of the
+// sequence is encoded, so memory usage does not depend on the sequence length.
+#define SCAN_WINDOW 65536
+
+static int encode_nuc(char c) {
+	switch(c) {
+		case 'A':
+		case 'a':
+			return 1;
+		case 'C':
+		case 'c':
+			return 2;
+		case 'G':
+		case 'g':
+			return 3;
+		case 'T':
+		case 't':
+			return 4;
+		default:
+			return 0;
+	}
+}
+
+static PyObject * hit_row(double score, Py_ssize_t pos, int strand) {
+	// Return a match as a [score, pos, strand] list
+	PyObject *row = PyList_New(3);
+	if (row == NULL)
+		return NULL;
+	PyList_SET_ITEM(row, 0, PyFloat_FromDouble(score));
+	PyList_SET_ITEM(row, 1, PyInt_FromLong((long) pos));
+	PyList_SET_ITEM(row, 2, PyInt_FromLong((long) strand));
+	return row;
+}
+
+static PyObject * pwmscan_windows(const char *seq_o, Py_ssize_t seq_len, double (*pwm)[6], int pwm_len, double cutoff, int n_report, int scan_rc, int return_all)
+{
+	// Scan a sequence with a weight matrix (as filled by fill_matrix_with_n()).
+	//
+	// The sequence is scanned in windows of SCAN_WINDOW positions that overlap
+	// by pwm_len - 1 nucleotides. The n_report best hits are kept while scanning,
+	// so only a fixed amount of memory is used, regardless of the sequence length.
+	// The forward strand is scanned completely before the reverse strand, in
+	// order to report tied scores in the same order as before.
+	Py_ssize_t j_max = seq_len - pwm_len + 1;
+	Py_ssize_t start, w, j, n;
+	int i, m, s, n_strands;
+	double score;
+	int *seq = NULL;
+	double *maxScores = NULL;
+	long long *maxPos = NULL;
+	signed char *maxStrand = NULL;
+	PyObject *return_list = NULL;
+	PyObject *row;
+
+	if (j_max < 0) { j_max = 0;}
+
+	seq = PyMem_Malloc((SCAN_WINDOW + pwm_len) * sizeof(int));
+	if (n_report > 0) {
+		maxScores = PyMem_Malloc(n_report * sizeof(double));
+		maxPos = PyMem_Malloc(n_report * sizeof(long long));
+		maxStrand = PyMem_Malloc(n_report * sizeof(signed char));
+	}
+	if (seq == NULL || (n_report > 0 && (maxScores == NULL || maxPos == NULL || maxStrand == NULL))) {
+		PyErr_NoMemory();
+		goto done;
+	}
+
+	// Initialize matrices of n_report highest scores and corresponding positions + strands
+	for (i = 0; i < n_report; i++) {
+		maxScores[i] = -100;
+		maxPos[i] = -1;
+		maxStrand[i] = 1;
+	}
+
+	if (return_all) {
+		return_list = PyList_New(j_max);
+	}
+	else {
+		return_list = PyList_New(0);
+	}
+	if (return_list == NULL)
+		goto done;
+
+	n_strands = 1;
+	if (scan_rc && !return_all) {
+		n_strands = 2;
+	}
+
+	for (s = 0; s < n_strands; s++) {
+		for (start = 0; start < j_max; start += SCAN_WINDOW) {
+			w = j_max - start;
+			if (w > SCAN_WINDOW) { w = SCAN_WINDOW;}
+
+			for (n = 0; n < w + pwm_len - 1; n++) {
+				seq[n] = encode_nuc(seq_o[start + n]);
+			}
+
+			for (j = 0; j < w; j++) {
+				score = 0;
+				if (s == 0) {
+					for (m = 0; m < pwm_len; m++) {
+						score += pwm[m][seq[j + m]];
+					}
+				}
+				else {
+					for (m = 0; m < pwm_len; m++) {
+						score += pwm[pwm_len - m - 1][5 - seq[j + m]];
+					}
+				}
+
+				if (return_all) {
+					PyList_SET_ITEM(return_list, start + j, PyFloat_FromDouble(score));
+				}
+				else if (score >= cutoff) {
+					if (n_report > 0) {
+						report_hit(maxScores, maxPos, maxStrand, n_report, score, start + j, s == 0 ? 1 : -1);
+					}
+					else {
+						row = hit_row(score, start + j, s == 0 ? 1 : -1);
+						if (row == NULL || PyList_Append(return_list, row) < 0) {
+							Py_XDECREF(row);
+							Py_CLEAR(return_list);
+							goto done;
+						}
+						Py_DECREF(row);
+					}
+				}
+			}
+		}
+	}
+
+	if (!return_all) {
+		for (i = 0; i < n_report; i++) {
+			if (maxPos[i] > - 1) {
+				row = hit_row(maxScores[i], maxPos[i], maxStrand[i]);
+				if (row == NULL || PyList_Append(return_list, row) < 0) {
+					Py_XDECREF(row);
+					Py_CLEAR(return_list);
+					goto done;
+				}
+				Py_DECREF(row);
+			}
+		}
+	}
+
+done:
+	PyMem_Free(seq);
+	PyMem_Free(maxScores);
+	PyMem_Free(maxPos);
+	PyMem_Free(maxStrand);
+	return return_list;
+}
+
 static PyObject * c_metrics_pwmscan(PyObject *self, PyObject * args)
 {
 	char *seq_o;
 	PyObject *pwm_o;
 	PyObject *cutoff_o;
-	int seq_len;
+	Py_ssize_t seq_len;
 	int n_report;
 	int pwm_len;
-	int i, j;
 	int scan_rc;
 	int return_all = 0;
 
-	if (!PyArg_ParseTuple(args, "sOOii|i", &seq_o, &pwm_o, &cutoff_o, &n_report, &scan_rc, &return_all))
+	if (!PyArg_ParseTuple(args, "s#OOii|i", &seq_o, &seq_len, &pwm_o, &cutoff_o, &n_report, &scan_rc, &return_all))
 			return NULL;
 
 	// Retrieve frequency matrix
@@ -508,381 +700,1427 @@ static PyObject * c_metrics_pwmscan(PyObject *self, PyObject * args)
 	pwm_len = PyList_Size(pwm_o);
 	double pwm[pwm_len][6];
 	fill_matrix_with_n(pwm, pwm_o);
-	//Py_DECREF(pwm_o);
-
-	seq_len = strlen(seq_o);
-	int seq[seq_len];
-	for (i = 0; i < seq_len; i++) {
-		switch(seq_o[i]) {
-            case 'A':
-				seq[i] = 1;
-                break;
-			case 'T':
-				seq[i] = 4;
-                break;
-			case 'C':
-				seq[i] = 2;
-                break;
-			case 'G':
-				seq[i] = 3;
-                break;
-			case 'N':
-			 	seq[i] = 0;
-                break;
-		}
-	}
-	//Py_DECREF(seq_o);
+	if (PyErr_Occurred())
+			return NULL;
 
 	// Cutoff for every spacer length
 	double cutoff;
 	cutoff = PyFloat_AsDouble(cutoff_o);
 
-	// Scan sequence
-	int j_max = seq_len - pwm_len + 1;
-	double score_matrix[j_max];
-	double rc_score_matrix[j_max];
-	double score, rc_score;
+	return pwmscan_windows(seq_o, seq_len, pwm, pwm_len, cutoff, n_report, scan_rc, return_all);
+}
 
-	if (j_max < 0) { j_max = 0;}
-	int m;
-	int c;
-	double pwm_min = -50;	
-	for (j = 0; j < j_max; j++) {
-		score = 0;
-		rc_score = 0;
-		
+static inline double window_score(const double *pwm, long long pwm_len, const unsigned char *s, int rc)
+{
+	// Score of the window starting at s, on the forward or reverse strand
+	double score = 0;
+	long long m;
+
+	if (rc) {
 		for (m = 0; m < pwm_len; m++) {
-			score += pwm[m][seq[j + m]];
-			rc_score += pwm[pwm_len - m - 1][5 - seq[j + m]];		
+			score += pwm[(pwm_len - m - 1) * 6 + 5 - s[m]];
+		}
+	} else {
+		for (m = 0; m < pwm_len; m++) {
+			score += pwm[m * 6 + s[m]];
 		}
-		score_matrix[j] = score;
-		rc_score_matrix[j] = rc_score;
 	}
-	
-	if (return_all) {
-		PyObject *return_list = PyList_New(j_max);
+	return score;
+}
+
+// SIMD scoring. Windows are scored with float32 accumulation, a block of
+// windows at a time, by the fastest implementation that the CPU supports.
+// These scores are only used to skip windows: a window that is within the
+// rounding tolerance of the cutoff (or of the best score) is scored with
+// window_score(), so results are exactly the same as without SIMD.
+
+// Number of windows that are scored at once
+#define SIMD_BLOCK 4096
+
+// Every row of a motif has 16 floats: the scores of N, A, C, G, T for the
+// forward strand, padded to 8, followed by the reverse complement scores of
+// the window position, see simd_tables()
+#define SIMD_ROW 16
 
-		for (j = 0; j < j_max; j++) {
-    			PyList_SetItem(return_list, j, PyFloat_FromDouble(score_matrix[j]));
+typedef void (*score_block_fn)(const float *tab, long long pwm_len, const unsigned char *s, long long n, float *out);
+
+static void score_block_portable(const float *tab, long long pwm_len, const unsigned char *s, long long n, float *out)
+{
+	long long j, m;
+	const float *row;
+
+	for (j = 0; j < n; j++) {
+		out[j] = 0;
+	}
+	for (m = 0; m < pwm_len; m++) {
+		row = tab + m * SIMD_ROW;
+		for (j = 0; j < n; j++) {
+			out[j] += row[s[j + m]];
 		}
-	    	return return_list;
 	}
+}
 
-	// Initialize matrices of n_report highest scores and corresponding positions + strands
-	double maxScores[n_report];
-	double maxPos[n_report];
-	int maxStrand[n_report];
-	for (j = 0; j < n_report; j++) {
-		maxScores[j] = -100;
-		maxPos[j] = -1;
-		maxStrand[j] = 1;
-	}
-	PyObject*  return_list = PyList_New(0);
-
-
-	int p,q;
-	PyObject *x;
-	for (j = 0; j < j_max; j++) {
-		score = score_matrix[j];
-		if (n_report > 0) {
-			if (score >= cutoff) {
-				p = n_report - 1;
-				while ((p >= 0) && (score > maxScores[p])) {
-					p--;
-				}
-				if (p < (n_report-1)) {
-					for (q = n_report - 1; q > (p + 1); q--) {
-						maxScores[q] = maxScores[q - 1];
-						maxPos[q] = maxPos[q - 1];
-						maxStrand[q] = maxStrand[q - 1];
-					}
-					maxScores[p + 1] = score;
-					maxPos[p + 1] = j;
-					maxStrand[p + 1] = 1;
-				}
+#ifdef SIMD_X86
+__attribute__((target("sse4.1")))
+static void score_block_sse41(const float *tab, long long pwm_len, const unsigned char *s, long long n, float *out)
+{
+	// Four windows at once, the scores of a row are selected with blends
+	long long j, m;
+	int c, four;
+	const float *row;
+	__m128 acc, v;
+	__m128i idx;
+
+	for (j = 0; j + 4 <= n; j += 4) {
+		acc = _mm_setzero_ps();
+		for (m = 0; m < pwm_len; m++) {
+			row = tab + m * SIMD_ROW;
+			memcpy(&four, s + j + m, 4);
+			idx = _mm_cvtepu8_epi32(_mm_cvtsi32_si128(four));
+			v = _mm_set1_ps(row[0]);
+			for (c = 1; c < 5; c++) {
+				v = _mm_blendv_ps(v, _mm_set1_ps(row[c]),
+						_mm_castsi128_ps(_mm_cmpeq_epi32(idx, _mm_set1_epi32(c))));
 			}
+			acc = _mm_add_ps(acc, v);
 		}
-		else {
-			if (score >= cutoff) {
-				PyObject* row = PyList_New(0);
-				x = PyFloat_FromDouble(score);
-				PyList_Append(row, x); Py_DECREF(x);
-				x = PyInt_FromLong((long) j);
-				PyList_Append(row, x); Py_DECREF(x);
-				x = PyInt_FromLong((long) 1);
-				PyList_Append(row, x); Py_DECREF(x);
-				PyList_Append(return_list, row);
-				Py_DECREF(row);
+		_mm_storeu_ps(out + j, acc);
+	}
+	if (j < n) {
+		score_block_portable(tab, pwm_len, s + j, n - j, out + j);
+	}
+}
+
+__attribute__((target("avx2")))
+static void score_block_avx2(const float *tab, long long pwm_len, const unsigned char *s, long long n, float *out)
+{
+	// Eight windows at once, the scores of a row are selected with a permute
+	long long j, m;
+	__m256 acc;
+	__m256i idx;
+
+	for (j = 0; j + 8 <= n; j += 8) {
+		acc = _mm256_setzero_ps();
+		for (m = 0; m < pwm_len; m++) {
+			idx = _mm256_cvtepu8_epi32(_mm_loadl_epi64((const __m128i *) (s + j + m)));
+			acc = _mm256_add_ps(acc, _mm256_permutevar8x32_ps(_mm256_loadu_ps(tab + m * SIMD_ROW), idx));
+		}
+		_mm256_storeu_ps(out + j, acc);
+	}
+	if (j < n) {
+		score_block_portable(tab, pwm_len, s + j, n - j, out + j);
+	}
+}
+#endif
+
+static const char *simd_names[] = {"portable", "sse4.1", "avx2"};
+static const score_block_fn simd_functions[] = {
+	score_block_portable,
+#ifdef SIMD_X86
+	score_block_sse41,
+	score_block_avx2,
+#endif
+};
+static int simd_selected = -1;
+
+static int simd_supported(void)
+{
+	// Highest SIMD level that the CPU supports, index in simd_names
+#ifdef SIMD_X86
+	__builtin_cpu_init();
+	if (__builtin_cpu_supports("avx2")) return 2;
+	if (__builtin_cpu_supports("sse4.1")) return 1;
+#endif
+	return 0;
+}
+
+static score_block_fn score_block(void)
+{
+	if (simd_selected < 0) {
+		simd_selected = simd_supported();
+	}
+	return simd_functions[simd_selected];
+}
+
+typedef struct {
+	float *tables;  // SIMD_ROW floats per row of the stacked matrices
+	double *tol;    // rounding tolerance of every motif
+	float *block;   // approximate scores of a block of windows
+} simd_motifs;
+
+typedef struct {
+	// Approximate scores of the windows of one strand, see simd_score()
+	score_block_fn func;
+	const float *tab;
+	long long pwm_len;
+	const unsigned char *seq;
+	long long j_max;
+	long long start;
+	long long len;
+	float *block;
+} simd_windows;
+
+static void simd_free(simd_motifs *simd)
+{
+	free(simd->tables);
+	free(simd->tol);
+	free(simd->block);
+	simd->tables = NULL;
+	simd->tol = NULL;
+	simd->block = NULL;
+}
+
+static int simd_alloc(const double *matrices, const long long *motif_offsets, Py_ssize_t nmotifs,
+		simd_motifs *simd)
+{
+	// Fill the float32 tables and tolerances of all motifs
+	Py_ssize_t k;
+	long long start, pwm_len, m;
+	Py_ssize_t nrows = nmotifs > 0 ? motif_offsets[nmotifs] : 0;
+	const double *row;
+	float *tab;
+	double sum, row_abs;
+	int c;
+
+	simd->tables = (float *) calloc(nrows * SIMD_ROW + 1, sizeof(float));
+	simd->tol = (double *) malloc((nmotifs + 1) * sizeof(double));
+	simd->block = (float *) malloc(SIMD_BLOCK * sizeof(float));
+	if (simd->tables == NULL || simd->tol == NULL || simd->block == NULL) {
+		simd_free(simd);
+		PyErr_NoMemory();
+		return 0;
+	}
+
+	for (k = 0; k < nmotifs; k++) {
+		start = motif_offsets[k];
+		pwm_len = motif_offsets[k + 1] - start;
+		sum = 1.0;
+		for (m = 0; m < pwm_len; m++) {
+			tab = simd->tables + (start + m) * SIMD_ROW;
+			row = matrices + (start + m) * 6;
+			// Reverse complement: row pwm_len - m - 1, column 5 - c
+			row_abs = 0;
+			for (c = 0; c < 5; c++) {
+				tab[c] = (float) row[c];
+				tab[8 + c] = (float) matrices[(start + pwm_len - m - 1) * 6 + 5 - c];
+				row_abs = fmax(row_abs, fabs(row[c]));
 			}
+			sum += row_abs;
 		}
+		// Converting to float and summing pwm_len floats each differ less
+		// than FLT_EPSILON / 2 times the sum of the absolute row scores
+		simd->tol[k] = (pwm_len + 2) * FLT_EPSILON * sum;
 	}
+	return 1;
+}
+
+static inline void simd_init(simd_windows *w, const simd_motifs *simd, long long row,
+		long long pwm_len, const unsigned char *seq, long long j_max, int rc)
+{
+	w->func = score_block();
+	w->tab = simd->tables + row * SIMD_ROW + (rc ? 8 : 0);
+	w->pwm_len = pwm_len;
+	w->seq = seq;
+	w->j_max = j_max;
+	w->start = 0;
+	w->len = 0;
+	w->block = simd->block;
+}
+
+static inline double simd_score(simd_windows *w, long long j)
+{
+	// Approximate score of window j. Windows should be visited in order,
+	// a block of windows is scored when j is past the current block.
+	if (j >= w->start + w->len) {
+		w->start = j;
+		w->len = w->j_max - j < SIMD_BLOCK ? w->j_max - j : SIMD_BLOCK;
+		w->func(w->tab, w->pwm_len, w->seq + j, w->len, w->block);
+	}
+	return w->block[j - w->start];
+}
+
+static Py_ssize_t scan_batch(const unsigned char *seqs, const long long *seq_offsets, Py_ssize_t nseqs,
+		const double *matrices, const long long *motif_offsets, Py_ssize_t nmotifs,
+		const double *cutoffs, const long long *seq_bins, const double *mean, const double *std,
+		const simd_motifs *simd,
+		int n_report, int scan_rc, double *scores, long long *pos, signed char *strand,
+		long long *nhits, Py_ssize_t capacity)
+{
+	// Scan a batch of sequences with a batch of motifs, see pwmscan_batch().
+	//
+	// With n_report 0, all hits are appended to scores, pos and strand, which
+	// have room for capacity hits, and the number of hits of every sequence
+	// and motif is written to nhits. Returns the total number of hits. If
+	// that is more than capacity, scanning stopped after the sequence and
+	// motif that did not fit, and nhits is not written for the motifs and
+	// sequences after it.
+	//
+	// If seq_bins is not NULL, the scores are converted to z-scores with the
+	// mean and std (nbins x nmotifs) of the GC% bin of every sequence, and the
+	// cutoffs are z-score cutoffs. The z-score is only calculated for windows
+	// with a raw score that can pass the cutoff. Hits are ranked by raw score,
+	// as in pwmscan(), and converted to z-scores when the motif is done.
+	//
+	// If simd is not NULL, windows are skipped based on their SIMD score,
+	// see simd_score().
+	Py_ssize_t i, k, r, first, total = 0;
+	long long j, j_max, pwm_len;
+	const unsigned char *seq;
+	const double *pwm;
+	double score, cutoff, raw_cutoff, simd_cutoff = 0, m_mean = 0, m_std = 1;
+	double *hit_scores;
+	long long *hit_pos;
+	signed char *hit_strand;
+	int zscore = seq_bins != NULL;
+	simd_windows w = {0};
+
+	for (i = 0; i < nseqs; i++) {
+		seq = seqs + seq_offsets[i];
+		for (k = 0; k < nmotifs; k++) {
+			pwm = matrices + motif_offsets[k] * 6;
+			pwm_len = motif_offsets[k + 1] - motif_offsets[k];
+			cutoff = cutoffs[k];
+			j_max = seq_offsets[i + 1] - seq_offsets[i] - pwm_len + 1;
+
+			hit_scores = scores + (i * nmotifs + k) * n_report;
+			hit_pos = pos + (i * nmotifs + k) * n_report;
+			hit_strand = strand + (i * nmotifs + k) * n_report;
+			for (r = 0; r < n_report; r++) {
+				hit_scores[r] = -100;
+				hit_pos[r] = -1;
+				hit_strand[r] = 1;
+			}
+			first = total;
+			if (n_report == 0) {
+				nhits[i * nmotifs + k] = 0;
+			}
+
+			raw_cutoff = cutoff;
+			if (zscore) {
+				m_mean = mean[seq_bins[i] * nmotifs + k];
+				m_std = std[seq_bins[i] * nmotifs + k];
+				if (isinf(cutoff) && cutoff > 0) {
+					continue;
+				}
+				if (m_std > 0 && isfinite(cutoff)) {
+					// Lower bound of the raw score, allowing for rounding;
+					// the z-score itself is compared to the cutoff
+					raw_cutoff = m_mean + cutoff * m_std;
+					raw_cutoff -= 1e-9 * (fabs(raw_cutoff) + 1.0);
+				} else {
+					raw_cutoff = -HUGE_VAL;
+				}
+			}
 
-	if (scan_rc) {
-		for (j = 0; j < j_max; j++) {
-			score = rc_score_matrix[j];
-			if (n_report > 0) {
-				if (score >= cutoff) {
-					p = n_report - 1;
-					while ((p >= 0) && (score > maxScores[p])) {
-						p--;
+			if (simd != NULL) {
+				simd_cutoff = raw_cutoff - simd->tol[k];
+				simd_init(&w, simd, motif_offsets[k], pwm_len, seq, j_max, 0);
+			}
+			for (j = 0; j < j_max; j++) {
+				if (simd != NULL && simd_score(&w, j) < simd_cutoff) {
+					continue;
+				}
+				score = window_score(pwm, pwm_len, seq + j, 0);
+				if (score >= raw_cutoff) {
+					if (zscore && !((score - m_mean) / m_std >= cutoff)) {
+						continue;
 					}
-					if (p < (n_report-1)) {
-						for (q = n_report - 1; q > (p + 1); q--) {
-							maxScores[q] = maxScores[q - 1];
-							maxPos[q] = maxPos[q - 1];
-							maxStrand[q] = maxStrand[q - 1];
+					if (n_report > 0) {
+						report_hit(hit_scores, hit_pos, hit_strand, n_report, score, j, 1);
+					} else {
+						append_hit(scores, pos, strand, capacity, &total, score, j, 1);
+					}
+				}
+			}
+
+			if (scan_rc) {
+				if (simd != NULL) {
+					simd_init(&w, simd, motif_offsets[k], pwm_len, seq, j_max, 1);
+				}
+				for (j = 0; j < j_max; j++) {
+					if (simd != NULL && simd_score(&w, j) < simd_cutoff) {
+						continue;
+					}
+					score = window_score(pwm, pwm_len, seq + j, 1);
+					if (score >= raw_cutoff) {
+						if (zscore && !((score - m_mean) / m_std >= cutoff)) {
+							continue;
+						}
+						if (n_report > 0) {
+							report_hit(hit_scores, hit_pos, hit_strand, n_report, score, j, -1);
+						} else {
+							append_hit(scores, pos, strand, capacity, &total, score, j, -1);
 						}
-						maxScores[p + 1] = score;
-						maxPos[p + 1] = j;
-						maxStrand[p + 1] = -1;
 					}
 				}
 			}
-			else {
-				if (score >= cutoff) {
-					PyObject* row = PyList_New(0);
-					x = PyFloat_FromDouble(score);
-					PyList_Append(row, x); Py_DECREF(x);
-					x = PyInt_FromLong((long) j);
-					PyList_Append(row, x); Py_DECREF(x);
-					x =  PyInt_FromLong((long) 1);
-					PyList_Append(row, x); Py_DECREF(x);
-					PyList_Append(return_list, row);
-					Py_DECREF(row);
+
+			if (zscore) {
+				for (r = 0; r < n_report && hit_pos[r] >= 0; r++) {
+					hit_scores[r] = (hit_scores[r] - m_mean) / m_std;
+				}
+				for (r = first; r < total && r < capacity; r++) {
+					scores[r] = (scores[r] - m_mean) / m_std;
+				}
+			}
+			if (n_report == 0) {
+				nhits[i * nmotifs + k] = total - first;
+				if (total > capacity) {
+					return total;
 				}
 			}
 		}
 	}
+	return total;
+}
 
-	for (i = 0; i < n_report; i++) {
-		if (maxPos[i] > - 1) {
-			PyObject* row = PyList_New(0);
-			x = PyFloat_FromDouble(maxScores[i]);
-			PyList_Append(row, x);  Py_DECREF(x);
-			x = PyInt_FromLong((long)maxPos[i]);
-			PyList_Append(row, x); Py_DECREF(x);
-			x = PyInt_FromLong((long)maxStrand[i]);
-			PyList_Append(row, x); Py_DECREF(x);
-			PyList_Append(return_list, row);
-			Py_DECREF(row);
-		}
+static int get_optional_buffer(PyObject *obj, Py_buffer *b)
+{
+	// Get a writable buffer, or an empty buffer if obj is None
+	if (obj == Py_None) {
+		b->obj = NULL;
+		b->buf = NULL;
+		b->len = 0;
+		return 1;
 	}
+	return PyObject_GetBuffer(obj, b, PyBUF_WRITABLE) == 0;
+}
 
-	return return_list;
+static int check_batch_input(Py_buffer *seqs_b, Py_buffer *seq_offsets_b, Py_buffer *matrices_b,
+		Py_buffer *motif_offsets_b, Py_buffer *cutoffs_b, Py_buffer *scores_b, Py_buffer *pos_b,
+		Py_buffer *strand_b, Py_buffer *nhits_b, int n_report)
+{
+	// Check the buffers of pwmscan_batch(), set an exception and return 0 if invalid
+	const long long *seq_offsets = (const long long *) seq_offsets_b->buf;
+	const long long *motif_offsets = (const long long *) motif_offsets_b->buf;
+	Py_ssize_t nseqs = seq_offsets_b->len / (Py_ssize_t) sizeof(long long) - 1;
+	Py_ssize_t nmotifs = motif_offsets_b->len / (Py_ssize_t) sizeof(long long) - 1;
+	Py_ssize_t nout = nseqs * nmotifs * n_report;
+
+	if (n_report < 0) {
+		PyErr_SetString(PyExc_ValueError, "n_report should not be negative");
+		return 0;
+	}
+	if (nseqs < 0 || nmotifs < 0) {
+		PyErr_SetString(PyExc_ValueError, "offsets should contain at least one element");
+		return 0;
+	}
+	if (seq_offsets[nseqs] > seqs_b->len) {
+		PyErr_SetString(PyExc_ValueError, "sequence offsets out of bounds");
+		return 0;
+	}
+	if (motif_offsets[nmotifs] * 6 * (Py_ssize_t) sizeof(double) > matrices_b->len) {
+		PyErr_SetString(PyExc_ValueError, "motif offsets out of bounds");
+		return 0;
+	}
+	if (cutoffs_b->len < nmotifs * (Py_ssize_t) sizeof(double)) {
+		PyErr_SetString(PyExc_ValueError, "need a cutoff for every motif");
+		return 0;
+	}
+	if (scores_b->len < nout * (Py_ssize_t) sizeof(double) ||
+			pos_b->len < nout * (Py_ssize_t) sizeof(long long) ||
+			strand_b->len < nout * (Py_ssize_t) sizeof(signed char)) {
+		PyErr_SetString(PyExc_ValueError, "output buffers are too small");
+		return 0;
+	}
+	if (n_report == 0 && nhits_b->len != nseqs * nmotifs * (Py_ssize_t) sizeof(long long)) {
+		PyErr_SetString(PyExc_ValueError, "nhits should be an int64 array of nseqs x nmotifs");
+		return 0;
+	}
+	return 1;
 }
 
+static Py_ssize_t batch_capacity(Py_buffer *scores_b, Py_buffer *pos_b, Py_buffer *strand_b)
+{
+	// Number of hits that fit in the output of pwmscan_batch() with n_report 0
+	Py_ssize_t capacity = scores_b->len / (Py_ssize_t) sizeof(double);
 
+	if (pos_b->len / (Py_ssize_t) sizeof(long long) < capacity) {
+		capacity = pos_b->len / (Py_ssize_t) sizeof(long long);
+	}
+	if (strand_b->len < capacity) {
+		capacity = strand_b->len;
+	}
+	return capacity;
+}
 
+static PyObject * c_metrics_pwmscan_batch(PyObject *self, PyObject * args)
+{
+	// Scan a batch of sequences with a batch of motifs.
+	//
+	// All input and output is passed as contiguous buffers (i.e. NumPy arrays):
+	// seqs           uint8    concatenated sequences, encoded as N=0, A=1, C=2, G=3, T=4
+	// seq_offsets    int64    start of every sequence in seqs, length nseqs + 1
+	// matrices       float64  stacked log-odds matrices, six columns per row:
+	//                         [min, A, C, G, T, min]
+	// motif_offsets  int64    start row of every motif in matrices, length nmotifs + 1
+	// cutoffs        float64  cutoff for every motif
+	// n_report       int      number of best hits per sequence and motif, 0 for all hits
+	// scan_rc        int      also scan the reverse complement
+	// scores         float64  output, nseqs x nmotifs x n_report
+	// pos            int64    output, nseqs x nmotifs x n_report, -1 if no match
+	// strand         int8     output, nseqs x nmotifs x n_report
+	// simd           int      optional, skip windows based on SIMD scores, see simd_score()
+	// nhits          int64    output, nseqs x nmotifs, only for n_report 0
+	//
+	// With n_report 0, scores, pos and strand are flat arrays, to which all
+	// hits are appended in order of sequence, motif, strand (forward first)
+	// and position. The number of hits is returned. If it is larger than the
+	// size of the output arrays, scanning stopped at the sequence and motif
+	// whose hits did not fit, and the following elements of nhits are not
+	// written, see scan_batch().
+	Py_buffer seqs_b, seq_offsets_b, matrices_b, motif_offsets_b, cutoffs_b;
+	Py_buffer scores_b, pos_b, strand_b, nhits_b;
+	PyObject *nhits_o = Py_None;
+	Py_ssize_t total;
+	int n_report;
+	int scan_rc;
+	int use_simd = 0;
+	simd_motifs simd = {NULL, NULL, NULL};
+	PyObject *ret = NULL;
 
-static PyObject * c_metrics_pfmscan(PyObject *self, PyObject * args)
+	if (!PyArg_ParseTuple(args, "y*y*y*y*y*iiw*w*w*|iO",
+				&seqs_b, &seq_offsets_b, &matrices_b, &motif_offsets_b, &cutoffs_b,
+				&n_report, &scan_rc, &scores_b, &pos_b, &strand_b, &use_simd, &nhits_o))
+		return NULL;
+
+	nhits_b.obj = NULL;
+	if (!get_optional_buffer(nhits_o, &nhits_b))
+		goto done;
+	if (!check_batch_input(&seqs_b, &seq_offsets_b, &matrices_b, &motif_offsets_b, &cutoffs_b,
+				&scores_b, &pos_b, &strand_b, &nhits_b, n_report))
+		goto done;
+
+	if (use_simd && !simd_alloc((const double *) matrices_b.buf,
+				(const long long *) motif_offsets_b.buf,
+				motif_offsets_b.len / (Py_ssize_t) sizeof(long long) - 1, &simd))
+		goto done;
+
+	Py_BEGIN_ALLOW_THREADS
+	total = scan_batch((const unsigned char *) seqs_b.buf,
+			(const long long *) seq_offsets_b.buf,
+			seq_offsets_b.len / (Py_ssize_t) sizeof(long long) - 1,
+			(const double *) matrices_b.buf,
+			(const long long *) motif_offsets_b.buf,
+			motif_offsets_b.len / (Py_ssize_t) sizeof(long long) - 1,
+			(const double *) cutoffs_b.buf,
+			NULL, NULL, NULL, use_simd ? &simd : NULL,
+			n_report, scan_rc,
+			(double *) scores_b.buf, (long long *) pos_b.buf, (signed char *) strand_b.buf,
+			(long long *) nhits_b.buf, batch_capacity(&scores_b, &pos_b, &strand_b));
+	Py_END_ALLOW_THREADS
+
+	if (n_report == 0) {
+		ret = PyLong_FromSsize_t(total);
+	} else {
+		Py_INCREF(Py_None);
+		ret = Py_None;
+	}
+
+done:
+	simd_free(&simd);
+	PyBuffer_Release(&seqs_b);
+	PyBuffer_Release(&seq_offsets_b);
+	PyBuffer_Release(&matrices_b);
+	PyBuffer_Release(&motif_offsets_b);
+	PyBuffer_Release(&cutoffs_b);
+	PyBuffer_Release(&scores_b);
+	PyBuffer_Release(&pos_b);
+	PyBuffer_Release(&strand_b);
+	PyBuffer_Release(&nhits_b);
+	return ret;
+}
+
+static PyObject * c_metrics_pwmscan_batch_zscore(PyObject *self, PyObject * args)
 {
-	
-        PyObject *pfm_o;
-        PyObject *cutoff_o;
-        char *seq;
-        int seq_len;
-        int n_report;
-        int pwm_len;
-        int i, j;
-        int scan_rc;
-        int return_all = 0;
-
-        if (!PyArg_ParseTuple(args, "sOOii|i", &seq, &pfm_o, &cutoff_o, &n_report, &scan_rc, &return_all))
-                return NULL;
-
-        seq_len = strlen(seq);
-
-        // Retrieve frequency matrix
-        if (!PyList_Check(pfm_o))
-                return NULL;
-
-        // Weight matrices
-        pwm_len = PyList_Size(pfm_o);
-        double pfm[pwm_len][4];
-        double pwm[pwm_len][4];
-        fill_matrix(pfm, pfm_o);
-        //Py_DECREF(pwm_o);
-
-        double g = 0.25;
-        double z = 0.01;
-        for (i = 0; i < pwm_len; i++) {
-                for (j = 0; j < 4; j++) {
-                        pwm[i][j] = log(pfm[i][j] / g + z);
-                }
-        }
-
-        // Cutoff for every spacer length
-        double cutoff;
-        cutoff = PyFloat_AsDouble(cutoff_o);
-
-        // Scan sequence
-        int j_max = seq_len - pwm_len + 1;
-        double score_matrix[j_max];
-        double rc_score_matrix[j_max];
-        double score, rc_score;
-
-        if (j_max < 0) { j_max = 0;}
-        int m;
-	int c;
-	double pwm_min = -50;	
-	for (j = 0; j < j_max; j++) {
-		score = 0;
-		rc_score = 0;
-		for (m = 0; m < pwm_len; m++) {
-			switch(seq[j + m]) {
-                                case 'A':
-                                        score += pwm[m][0];
-                                        rc_score += pwm[pwm_len - m - 1][3];
-                                        break;
-                                case 'C':
-                                        score += pwm[m][1];
-                                        rc_score += pwm[pwm_len - m - 1][2];
-                                        break;
-                                case 'G':
-                                        score += pwm[m][2];
-                                        rc_score += pwm[pwm_len - m - 1][1];
-                                        break;
-                                case 'T':
-                                        score += pwm[m][3];
-                                        rc_score += pwm[pwm_len - m - 1][0];
-                                        break;
-				case 'N':
-					pwm_min = pwm[m][0];
-					for (c = 1; c < 4; c++) {
-						if (pwm[m][c] < pwm_min) {
-							pwm_min = pwm[m][c];
+	// Same as pwmscan_batch(), but the scores are reported as z-scores and
+	// the cutoffs are z-score cutoffs. Additional input, after cutoffs:
+	// seq_bins       int64    GC% bin of every sequence, row in mean and std
+	// mean           float64  background mean score, nbins x nmotifs
+	// std            float64  background standard deviation, nbins x nmotifs
+	Py_buffer seqs_b, seq_offsets_b, matrices_b, motif_offsets_b, cutoffs_b;
+	Py_buffer seq_bins_b, mean_b, std_b;
+	Py_buffer scores_b, pos_b, strand_b, nhits_b;
+	PyObject *nhits_o = Py_None;
+	Py_ssize_t total;
+	int n_report;
+	int scan_rc;
+	int use_simd = 0;
+	simd_motifs simd = {NULL, NULL, NULL};
+	PyObject *ret = NULL;
+
+	if (!PyArg_ParseTuple(args, "y*y*y*y*y*y*y*y*iiw*w*w*|iO",
+				&seqs_b, &seq_offsets_b, &matrices_b, &motif_offsets_b, &cutoffs_b,
+				&seq_bins_b, &mean_b, &std_b,
+				&n_report, &scan_rc, &scores_b, &pos_b, &strand_b, &use_simd, &nhits_o))
+		return NULL;
+
+	nhits_b.obj = NULL;
+	if (!get_optional_buffer(nhits_o, &nhits_b))
+		goto done;
+	if (!check_batch_input(&seqs_b, &seq_offsets_b, &matrices_b, &motif_offsets_b, &cutoffs_b,
+				&scores_b, &pos_b, &strand_b, &nhits_b, n_report))
+		goto done;
+
+	Py_ssize_t nseqs = seq_offsets_b.len / (Py_ssize_t) sizeof(long long) - 1;
+	Py_ssize_t nmotifs = motif_offsets_b.len / (Py_ssize_t) sizeof(long long) - 1;
+	const long long *seq_bins = (const long long *) seq_bins_b.buf;
+	Py_ssize_t i, nbins = 0;
+
+	if (seq_bins_b.len < nseqs * (Py_ssize_t) sizeof(long long)) {
+		PyErr_SetString(PyExc_ValueError, "need a GC% bin for every sequence");
+		goto done;
+	}
+	if (nmotifs > 0) {
+		nbins = mean_b.len / (nmotifs * (Py_ssize_t) sizeof(double));
+		if (std_b.len / (nmotifs * (Py_ssize_t) sizeof(double)) < nbins) {
+			nbins = std_b.len / (nmotifs * (Py_ssize_t) sizeof(double));
+		}
+		for (i = 0; i < nseqs; i++) {
+			if (seq_bins[i] < 0 || seq_bins[i] >= nbins) {
+				PyErr_SetString(PyExc_ValueError, "GC% bin out of bounds");
+				goto done;
+			}
+		}
+	}
+	if (use_simd && !simd_alloc((const double *) matrices_b.buf,
+				(const long long *) motif_offsets_b.buf, nmotifs, &simd))
+		goto done;
+
+	Py_BEGIN_ALLOW_THREADS
+	total = scan_batch((const unsigned char *) seqs_b.buf,
+			(const long long *) seq_offsets_b.buf, nseqs,
+			(const double *) matrices_b.buf,
+			(const long long *) motif_offsets_b.buf, nmotifs,
+			(const double *) cutoffs_b.buf,
+			seq_bins, (const double *) mean_b.buf, (const double *) std_b.buf,
+			use_simd ? &simd : NULL, n_report, scan_rc,
+			(double *) scores_b.buf, (long long *) pos_b.buf, (signed char *) strand_b.buf,
+			(long long *) nhits_b.buf, batch_capacity(&scores_b, &pos_b, &strand_b));
+	Py_END_ALLOW_THREADS
+
+	if (n_report == 0) {
+		ret = PyLong_FromSsize_t(total);
+	} else {
+		Py_INCREF(Py_None);
+		ret = Py_None;
+	}
+
+done:
+	simd_free(&simd);
+	PyBuffer_Release(&seqs_b);
+	PyBuffer_Release(&seq_offsets_b);
+	PyBuffer_Release(&matrices_b);
+	PyBuffer_Release(&motif_offsets_b);
+	PyBuffer_Release(&cutoffs_b);
+	PyBuffer_Release(&seq_bins_b);
+	PyBuffer_Release(&mean_b);
+	PyBuffer_Release(&std_b);
+	PyBuffer_Release(&scores_b);
+	PyBuffer_Release(&pos_b);
+	PyBuffer_Release(&strand_b);
+	PyBuffer_Release(&nhits_b);
+	return ret;
+}
+
+
+
+static PyObject * c_metrics_pwmscan_best(PyObject *self, PyObject * args)
+{
+	// Best score of every motif in every sequence of a batch.
+	//
+	// Input is the same as for pwmscan_batch():
+	// seqs           uint8    concatenated sequences, encoded as N=0, A=1, C=2, G=3, T=4
+	// seq_offsets    int64    start of every sequence in seqs, length nseqs + 1
+	// matrices       float64  stacked log-odds matrices, six columns per row:
+	//                         [min, A, C, G, T, min]
+	// motif_offsets  int64    start row of every motif in matrices, length nmotifs + 1
+	// min_scores     float64  score for sequences that are shorter than the motif
+	// out            float32 or float64, output, nseqs x nmotifs
+	// simd           int      optional, skip windows based on SIMD scores, see simd_score()
+	Py_buffer seqs_b, seq_offsets_b, matrices_b, motif_offsets_b, min_scores_b;
+	Py_buffer out_b;
+	int scan_rc;
+	int use_simd = 0;
+	simd_motifs simd = {NULL, NULL, NULL};
+	PyObject *ret = NULL;
+
+	if (!PyArg_ParseTuple(args, "y*y*y*y*y*iw*|i",
+				&seqs_b, &seq_offsets_b, &matrices_b, &motif_offsets_b, &min_scores_b,
+				&scan_rc, &out_b, &use_simd))
+		return NULL;
+
+	const unsigned char *seqs = (const unsigned char *) seqs_b.buf;
+	const long long *seq_offsets = (const long long *) seq_offsets_b.buf;
+	const double *matrices = (const double *) matrices_b.buf;
+	const long long *motif_offsets = (const long long *) motif_offsets_b.buf;
+	const double *min_scores = (const double *) min_scores_b.buf;
+
+	Py_ssize_t nseqs = seq_offsets_b.len / (Py_ssize_t) sizeof(long long) - 1;
+	Py_ssize_t nmotifs = motif_offsets_b.len / (Py_ssize_t) sizeof(long long) - 1;
+	Py_ssize_t nout = nseqs * nmotifs;
+	int out_double;
+
+	if (nseqs < 0 || nmotifs < 0) {
+		PyErr_SetString(PyExc_ValueError, "offsets should contain at least one element");
+		goto done;
+	}
+	if (seq_offsets[nseqs] > seqs_b.len) {
+		PyErr_SetString(PyExc_ValueError, "sequence offsets out of bounds");
+		goto done;
+	}
+	if (motif_offsets[nmotifs] * 6 * (Py_ssize_t) sizeof(double) > matrices_b.len) {
+		PyErr_SetString(PyExc_ValueError, "motif offsets out of bounds");
+		goto done;
+	}
+	if (min_scores_b.len < nmotifs * (Py_ssize_t) sizeof(double)) {
+		PyErr_SetString(PyExc_ValueError, "need a minimum score for every motif");
+		goto done;
+	}
+	// The type of the output is determined by its size
+	if (out_b.len == nout * (Py_ssize_t) sizeof(double)) {
+		out_double = 1;
+	} else if (out_b.len == nout * (Py_ssize_t) sizeof(float)) {
+		out_double = 0;
+	} else {
+		PyErr_SetString(PyExc_ValueError, "output should be a float32 or float64 array of nseqs x nmotifs");
+		goto done;
+	}
+	if (use_simd && !simd_alloc(matrices, motif_offsets, nmotifs, &simd))
+		goto done;
+
+	Py_BEGIN_ALLOW_THREADS
+	Py_ssize_t i, k;
+	long long j, j_max, m, pwm_len;
+	const unsigned char *seq;
+	const double *pwm;
+	double score, best;
+	simd_windows w = {0};
+	int rc;
+
+	for (i = 0; i < nseqs; i++) {
+		seq = seqs + seq_offsets[i];
+		for (k = 0; k < nmotifs; k++) {
+			pwm = matrices + motif_offsets[k] * 6;
+			pwm_len = motif_offsets[k + 1] - motif_offsets[k];
+			j_max = seq_offsets[i + 1] - seq_offsets[i] - pwm_len + 1;
+
+			if (j_max <= 0) {
+				best = min_scores[k];
+			} else if (use_simd) {
+				// Only windows that can be the best are scored exactly
+				best = -INFINITY;
+				for (rc = 0; rc < (scan_rc ? 2 : 1); rc++) {
+					simd_init(&w, &simd, motif_offsets[k], pwm_len, seq, j_max, rc);
+					for (j = 0; j < j_max; j++) {
+						if (simd_score(&w, j) + simd.tol[k] < best) {
+							continue;
+						}
+						score = window_score(pwm, pwm_len, seq + j, rc);
+						if (score > best) {
+							best = score;
+						}
+					}
+				}
+			} else {
+				best = -INFINITY;
+				for (j = 0; j < j_max; j++) {
+					score = 0;
+					for (m = 0; m < pwm_len; m++) {
+						score += pwm[m * 6 + seq[j + m]];
+					}
+					if (score > best) {
+						best = score;
+					}
+				}
+				if (scan_rc) {
+					for (j = 0; j < j_max; j++) {
+						score = 0;
+						for (m = 0; m < pwm_len; m++) {
+							score += pwm[(pwm_len - m - 1) * 6 + 5 - seq[j + m]];
+						}
+						if (score > best) {
+							best = score;
 						}
 					}
-					score += pwm_min;
-					rc_score += pwm_min; 
-					break;
+				}
+			}
+
+			if (out_double) {
+				((double *) out_b.buf)[i * nmotifs + k] = best;
+			} else {
+				((float *) out_b.buf)[i * nmotifs + k] = (float) best;
 			}
-		
 		}
-		score_matrix[j] = score;
-		rc_score_matrix[j] = rc_score;
 	}
-	
-	if (return_all) {
-		PyObject *return_list = PyList_New(j_max);
+	Py_END_ALLOW_THREADS
+
+	Py_INCREF(Py_None);
+	ret = Py_None;
+
+done:
+	simd_free(&simd);
+	PyBuffer_Release(&seqs_b);
+	PyBuffer_Release(&seq_offsets_b);
+	PyBuffer_Release(&matrices_b);
+	PyBuffer_Release(&motif_offsets_b);
+	PyBuffer_Release(&min_scores_b);
+	PyBuffer_Release(&out_b);
+	return ret;
+}
 
-		for (j = 0; j < j_max; j++) {
-    			PyList_SetItem(return_list, j, PyFloat_FromDouble(score_matrix[j]));
+static PyObject * c_metrics_pwmscan_count(PyObject *self, PyObject * args)
+{
+	// Number of matches of every motif in every sequence of a batch.
+	//
+	// Input is the same as for pwmscan_batch():
+	// seqs           uint8    concatenated sequences, encoded as N=0, A=1, C=2, G=3, T=4
+	// seq_offsets    int64    start of every sequence in seqs, length nseqs + 1
+	// matrices       float64  stacked log-odds matrices, six columns per row:
+	//                         [min, A, C, G, T, min]
+	// motif_offsets  int64    start row of every motif in matrices, length nmotifs + 1
+	// cutoffs        float64  cutoff for every motif
+	// max_count      int      stop counting at this number of matches, 0 for no limit
+	// out            int64    output, nseqs x nmotifs
+	// simd           int      optional, skip windows based on SIMD scores, see simd_score()
+	Py_buffer seqs_b, seq_offsets_b, matrices_b, motif_offsets_b, cutoffs_b;
+	Py_buffer out_b;
+	Py_ssize_t max_count;
+	int scan_rc;
+	int use_simd = 0;
+	simd_motifs simd = {NULL, NULL, NULL};
+	PyObject *ret = NULL;
+
+	if (!PyArg_ParseTuple(args, "y*y*y*y*y*niw*|i",
+				&seqs_b, &seq_offsets_b, &matrices_b, &motif_offsets_b, &cutoffs_b,
+				&max_count, &scan_rc, &out_b, &use_simd))
+		return NULL;
+
+	const unsigned char *seqs = (const unsigned char *) seqs_b.buf;
+	const long long *seq_offsets = (const long long *) seq_offsets_b.buf;
+	const double *matrices = (const double *) matrices_b.buf;
+	const long long *motif_offsets = (const long long *) motif_offsets_b.buf;
+	const double *cutoffs = (const double *) cutoffs_b.buf;
+	long long *out = (long long *) out_b.buf;
+
+	Py_ssize_t nseqs = seq_offsets_b.len / (Py_ssize_t) sizeof(long long) - 1;
+	Py_ssize_t nmotifs = motif_offsets_b.len / (Py_ssize_t) sizeof(long long) - 1;
+
+	if (nseqs < 0 || nmotifs < 0) {
+		PyErr_SetString(PyExc_ValueError, "offsets should contain at least one element");
+		goto done;
+	}
+	if (seq_offsets[nseqs] > seqs_b.len) {
+		PyErr_SetString(PyExc_ValueError, "sequence offsets out of bounds");
+		goto done;
+	}
+	if (motif_offsets[nmotifs] * 6 * (Py_ssize_t) sizeof(double) > matrices_b.len) {
+		PyErr_SetString(PyExc_ValueError, "motif offsets out of bounds");
+		goto done;
+	}
+	if (cutoffs_b.len < nmotifs * (Py_ssize_t) sizeof(double)) {
+		PyErr_SetString(PyExc_ValueError, "need a cutoff for every motif");
+		goto done;
+	}
+	if (out_b.len != nseqs * nmotifs * (Py_ssize_t) sizeof(long long)) {
+		PyErr_SetString(PyExc_ValueError, "output should be an int64 array of nseqs x nmotifs");
+		goto done;
+	}
+	if (max_count <= 0) {
+		max_count = PY_SSIZE_T_MAX;
+	}
+	if (use_simd && !simd_alloc(matrices, motif_offsets, nmotifs, &simd))
+		goto done;
+
+	Py_BEGIN_ALLOW_THREADS
+	Py_ssize_t i, k, n;
+	long long j, j_max, pwm_len;
+	const unsigned char *seq;
+	const double *pwm;
+	double cutoff, simd_cutoff = 0, simd_high = 0, score;
+	simd_windows w = {0};
+
+	for (i = 0; i < nseqs; i++) {
+		seq = seqs + seq_offsets[i];
+		for (k = 0; k < nmotifs; k++) {
+			pwm = matrices + motif_offsets[k] * 6;
+			pwm_len = motif_offsets[k + 1] - motif_offsets[k];
+			cutoff = cutoffs[k];
+			j_max = seq_offsets[i + 1] - seq_offsets[i] - pwm_len + 1;
+
+			n = 0;
+			if (use_simd) {
+				// Windows between simd_cutoff and simd_high are scored again
+				simd_cutoff = cutoff - simd.tol[k];
+				simd_high = cutoff + simd.tol[k];
+				simd_init(&w, &simd, motif_offsets[k], pwm_len, seq, j_max, 0);
+			}
+			for (j = 0; j < j_max && n < max_count; j++) {
+				if (use_simd) {
+					score = simd_score(&w, j);
+					if (score < simd_cutoff) {
+						continue;
+					}
+					if (score >= simd_high) {
+						n++;
+						continue;
+					}
+				}
+				if (window_score(pwm, pwm_len, seq + j, 0) >= cutoff) {
+					n++;
+				}
+			}
+			if (scan_rc) {
+				if (use_simd) {
+					simd_init(&w, &simd, motif_offsets[k], pwm_len, seq, j_max, 1);
+				}
+				for (j = 0; j < j_max && n < max_count; j++) {
+					if (use_simd) {
+						score = simd_score(&w, j);
+						if (score < simd_cutoff) {
+							continue;
+						}
+						if (score >= simd_high) {
+							n++;
+							continue;
+						}
+					}
+					if (window_score(pwm, pwm_len, seq + j, 1) >= cutoff) {
+						n++;
+					}
+				}
+			}
+			out[i * nmotifs + k] = n;
 		}
-	    	return return_list;
 	}
+	Py_END_ALLOW_THREADS
+
+	Py_INCREF(Py_None);
+	ret = Py_None;
+
+done:
+	simd_free(&simd);
+	PyBuffer_Release(&seqs_b);
+	PyBuffer_Release(&seq_offsets_b);
+	PyBuffer_Release(&matrices_b);
+	PyBuffer_Release(&motif_offsets_b);
+	PyBuffer_Release(&cutoffs_b);
+	PyBuffer_Release(&out_b);
+	return ret;
+}
 
-	// Initialize matrices of n_report highest scores and corresponding positions + strands
-	double maxScores[n_report];
-	double maxPos[n_report];
-	int maxStrand[n_report];
-	for (j = 0; j < n_report; j++) {
-		maxScores[j] = -100;
-		maxPos[j] = -1;
-		maxStrand[j] = 1;
-	}
-	PyObject*  return_list = PyList_New(0);
-
-
-
-	int p,q;
-	PyObject *x;
-	for (j = 0; j < j_max; j++) {
-		score = score_matrix[j];
-		if (n_report > 0) {
-			if (score >= cutoff) {
-				p = n_report - 1;
-				while ((p >= 0) && (score > maxScores[p])) {
-					p--;
+static PyObject * c_metrics_pwmscan_count_best(PyObject *self, PyObject * args)
+{
+	// Number of matches and best score of every motif in every sequence of
+	// a batch, in one pass over the sequences.
+	//
+	// Input is the same as for pwmscan_count() and pwmscan_best():
+	// seqs           uint8    concatenated sequences, encoded as N=0, A=1, C=2, G=3, T=4
+	// seq_offsets    int64    start of every sequence in seqs, length nseqs + 1
+	// matrices       float64  stacked log-odds matrices, six columns per row:
+	//                         [min, A, C, G, T, min]
+	// motif_offsets  int64    start row of every motif in matrices, length nmotifs + 1
+	// cutoffs        float64  cutoff for every motif
+	// min_scores     float64  score for sequences that are shorter than the motif
+	// max_count      int      maximum number of matches to count, 0 for no limit
+	// counts         int64    output, nseqs x nmotifs
+	// scores         float32 or float64, output, nseqs x nmotifs
+	// simd           int      optional, skip windows based on SIMD scores, see simd_score()
+	Py_buffer seqs_b, seq_offsets_b, matrices_b, motif_offsets_b, cutoffs_b, min_scores_b;
+	Py_buffer counts_b, scores_b;
+	Py_ssize_t max_count;
+	int scan_rc;
+	int use_simd = 0;
+	simd_motifs simd = {NULL, NULL, NULL};
+	PyObject *ret = NULL;
+
+	if (!PyArg_ParseTuple(args, "y*y*y*y*y*y*niw*w*|i",
+				&seqs_b, &seq_offsets_b, &matrices_b, &motif_offsets_b, &cutoffs_b,
+				&min_scores_b, &max_count, &scan_rc, &counts_b, &scores_b, &use_simd))
+		return NULL;
+
+	const unsigned char *seqs = (const unsigned char *) seqs_b.buf;
+	const long long *seq_offsets = (const long long *) seq_offsets_b.buf;
+	const double *matrices = (const double *) matrices_b.buf;
+	const long long *motif_offsets = (const long long *) motif_offsets_b.buf;
+	const double *cutoffs = (const double *) cutoffs_b.buf;
+	const double *min_scores = (const double *) min_scores_b.buf;
+	long long *counts = (long long *) counts_b.buf;
+
+	Py_ssize_t nseqs = seq_offsets_b.len / (Py_ssize_t) sizeof(long long) - 1;
+	Py_ssize_t nmotifs = motif_offsets_b.len / (Py_ssize_t) sizeof(long long) - 1;
+	Py_ssize_t nout = nseqs * nmotifs;
+	int out_double;
+
+	if (nseqs < 0 || nmotifs < 0) {
+		PyErr_SetString(PyExc_ValueError, "offsets should contain at least one element");
+		goto done;
+	}
+	if (seq_offsets[nseqs] > seqs_b.len) {
+		PyErr_SetString(PyExc_ValueError, "sequence offsets out of bounds");
+		goto done;
+	}
+	if (motif_offsets[nmotifs] * 6 * (Py_ssize_t) sizeof(double) > matrices_b.len) {
+		PyErr_SetString(PyExc_ValueError, "motif offsets out of bounds");
+		goto done;
+	}
+	if (cutoffs_b.len < nmotifs * (Py_ssize_t) sizeof(double)) {
+		PyErr_SetString(PyExc_ValueError, "need a cutoff for every motif");
+		goto done;
+	}
+	if (min_scores_b.len < nmotifs * (Py_ssize_t) sizeof(double)) {
+		PyErr_SetString(PyExc_ValueError, "need a minimum score for every motif");
+		goto done;
+	}
+	if (counts_b.len != nout * (Py_ssize_t) sizeof(long long)) {
+		PyErr_SetString(PyExc_ValueError, "counts should be an int64 array of nseqs x nmotifs");
+		goto done;
+	}
+	// The type of the scores is determined by their size
+	if (scores_b.len == nout * (Py_ssize_t) sizeof(double)) {
+		out_double = 1;
+	} else if (scores_b.len == nout * (Py_ssize_t) sizeof(float)) {
+		out_double = 0;
+	} else {
+		PyErr_SetString(PyExc_ValueError, "scores should be a float32 or float64 array of nseqs x nmotifs");
+		goto done;
+	}
+	if (max_count <= 0) {
+		max_count = PY_SSIZE_T_MAX;
+	}
+	if (use_simd && !simd_alloc(matrices, motif_offsets, nmotifs, &simd))
+		goto done;
+
+	Py_BEGIN_ALLOW_THREADS
+	Py_ssize_t i, k, n;
+	long long j, j_max, m, pwm_len;
+	const unsigned char *seq;
+	const double *pwm;
+	double score, best, cutoff, approx;
+	int strand;
+	simd_windows w = {0};
+
+	for (i = 0; i < nseqs; i++) {
+		seq = seqs + seq_offsets[i];
+		for (k = 0; k < nmotifs; k++) {
+			pwm = matrices + motif_offsets[k] * 6;
+			pwm_len = motif_offsets[k + 1] - motif_offsets[k];
+			cutoff = cutoffs[k];
+			j_max = seq_offsets[i + 1] - seq_offsets[i] - pwm_len + 1;
+
+			n = 0;
+			best = min_scores[k];
+			for (strand = 0; strand < (scan_rc ? 2 : 1); strand++) {
+				if (use_simd) {
+					simd_init(&w, &simd, motif_offsets[k], pwm_len, seq, j_max, strand);
 				}
-				if (p < (n_report-1)) {
-					for (q = n_report - 1; q > (p + 1); q--) {
-						maxScores[q] = maxScores[q - 1];
-						maxPos[q] = maxPos[q - 1];
-						maxStrand[q] = maxStrand[q - 1];
+				for (j = 0; j < j_max; j++) {
+					if (use_simd) {
+						// Skip windows that can neither match nor be the best
+						approx = simd_score(&w, j) + simd.tol[k];
+						if (approx < cutoff && approx < best) {
+							continue;
+						}
+					}
+					score = 0;
+					if (strand == 0) {
+						for (m = 0; m < pwm_len; m++) {
+							score += pwm[m * 6 + seq[j + m]];
+						}
+					} else {
+						for (m = 0; m < pwm_len; m++) {
+							score += pwm[(pwm_len - m - 1) * 6 + 5 - seq[j + m]];
+						}
+					}
+					if (score >= cutoff && n < max_count) {
+						n++;
+					}
+					if (score > best) {
+						best = score;
 					}
-					maxScores[p + 1] = score;
-					maxPos[p + 1] = j;
-					maxStrand[p + 1] = 1;
 				}
 			}
+
+			counts[i * nmotifs + k] = n;
+			if (out_double) {
+				((double *) scores_b.buf)[i * nmotifs + k] = best;
+			} else {
+				((float *) scores_b.buf)[i * nmotifs + k] = (float) best;
+			}
 		}
-		else {
-			if (score >= cutoff) {
-				PyObject* row = PyList_New(0);
-				x = PyFloat_FromDouble(score);
-				PyList_Append(row, x); Py_DECREF(x);
-				x = PyInt_FromLong((long) j);
-				PyList_Append(row, x); Py_DECREF(x);
-				x = PyInt_FromLong((long) 1);
-				PyList_Append(row, x); Py_DECREF(x);
-				PyList_Append(return_list, row);
-				Py_DECREF(row);
+	}
+	Py_END_ALLOW_THREADS
+
+	Py_INCREF(Py_None);
+	ret = Py_None;
+
+done:
+	simd_free(&simd);
+	PyBuffer_Release(&seqs_b);
+	PyBuffer_Release(&seq_offsets_b);
+	PyBuffer_Release(&matrices_b);
+	PyBuffer_Release(&motif_offsets_b);
+	PyBuffer_Release(&cutoffs_b);
+	PyBuffer_Release(&min_scores_b);
+	PyBuffer_Release(&counts_b);
+	PyBuffer_Release(&scores_b);
+	return ret;
+}
+
+// Number of windows that are scored at once with super-alphabet tables
+#define KMER_BLOCK 4096
+
+static void kmer_encode(const unsigned char *seqs, const long long *seq_offsets, Py_ssize_t nseqs,
+		int k, unsigned short *codes)
+{
+	// Encode every position of the sequences as the k-mer that starts there,
+	// as a base-5 number of the encoded nucleotides. Positions after the end
+	// of a sequence count as N (0).
+	Py_ssize_t i;
+	long long j, end;
+	int d;
+	unsigned int code;
+
+	for (i = 0; i < nseqs; i++) {
+		end = seq_offsets[i + 1];
+		for (j = seq_offsets[i]; j < end; j++) {
+			code = 0;
+			for (d = 0; d < k; d++) {
+				code = code * 5 + (j + d < end ? seqs[j + d] : 0);
 			}
+			codes[j] = (unsigned short) code;
 		}
 	}
+}
 
-	if (scan_rc) {
-		for (j = 0; j < j_max; j++) {
-			score = rc_score_matrix[j];
-			if (n_report > 0) {
-				if (score >= cutoff) {
-					p = n_report - 1;
-					while ((p >= 0) && (score > maxScores[p])) {
-						p--;
+static PyObject * c_metrics_pwmscan_kmer(PyObject *self, PyObject * args)
+{
+	// Number of matches and/or best score of every motif in every sequence
+	// of a batch, using super-alphabet score tables.
+	//
+	// Every window is scored with one lookup per k motif positions, in a
+	// table with the summed scores of these positions for every k-mer. The
+	// tables sum in a different order than the plain kernels, so windows
+	// that are close to the cutoff or to the best score are rescored with
+	// the matrix. Counts and scores are exactly the same as those of
+	// pwmscan_count() and pwmscan_best().
+	//
+	// seqs           uint8    concatenated sequences, encoded as N=0, A=1, C=2, G=3, T=4
+	// seq_offsets    int64    start of every sequence in seqs, length nseqs + 1
+	// matrices       float64  stacked log-odds matrices, six columns per row:
+	//                         [min, A, C, G, T, min]
+	// motif_offsets  int64    start row of every motif in matrices, length nmotifs + 1
+	// tables         float64  stacked score tables, 5^k entries per table. Every
+	//                         motif has ceil(pwm_len / k) tables for the forward
+	//                         strand, followed by as many for the reverse strand.
+	// table_offsets  int64    first table of every motif, length nmotifs + 1
+	// k              int      number of positions per table
+	// cutoffs        float64  cutoff for every motif
+	// min_scores     float64  score for sequences that are shorter than the motif
+	// max_count      int      maximum number of matches to count, 0 for no limit
+	// scan_rc        int      also scan the reverse complement
+	// counts         int64    output, nseqs x nmotifs, or None
+	// scores         float32 or float64, output, nseqs x nmotifs, or None
+	Py_buffer seqs_b, seq_offsets_b, matrices_b, motif_offsets_b, tables_b, table_offsets_b;
+	Py_buffer cutoffs_b, min_scores_b, counts_b, scores_b;
+	PyObject *counts_o, *scores_o;
+	Py_ssize_t max_count;
+	int k, scan_rc;
+	unsigned short *codes = NULL;
+	double *block = NULL;
+	PyObject *ret = NULL;
+
+	if (!PyArg_ParseTuple(args, "y*y*y*y*y*y*iy*y*niOO",
+				&seqs_b, &seq_offsets_b, &matrices_b, &motif_offsets_b, &tables_b,
+				&table_offsets_b, &k, &cutoffs_b, &min_scores_b, &max_count, &scan_rc,
+				&counts_o, &scores_o))
+		return NULL;
+
+	counts_b.obj = NULL;
+	scores_b.obj = NULL;
+	if (!get_optional_buffer(counts_o, &counts_b) || !get_optional_buffer(scores_o, &scores_b))
+		goto done;
+
+	const unsigned char *seqs = (const unsigned char *) seqs_b.buf;
+	const long long *seq_offsets = (const long long *) seq_offsets_b.buf;
+	const double *matrices = (const double *) matrices_b.buf;
+	const long long *motif_offsets = (const long long *) motif_offsets_b.buf;
+	const double *tables = (const double *) tables_b.buf;
+	const long long *table_offsets = (const long long *) table_offsets_b.buf;
+	const double *cutoffs = (const double *) cutoffs_b.buf;
+	const double *min_scores = (const double *) min_scores_b.buf;
+	long long *counts = (long long *) counts_b.buf;
+
+	Py_ssize_t nseqs = seq_offsets_b.len / (Py_ssize_t) sizeof(long long) - 1;
+	Py_ssize_t nmotifs = motif_offsets_b.len / (Py_ssize_t) sizeof(long long) - 1;
+	Py_ssize_t nout = nseqs * nmotifs;
+	Py_ssize_t k_size = 1, m_idx;
+	int out_double = 0;
+
+	if (k < 1 || k > 6) {
+		PyErr_SetString(PyExc_ValueError, "k should be between 1 and 6");
+		goto done;
+	}
+	for (m_idx = 0; m_idx < k; m_idx++) {
+		k_size *= 5;
+	}
+	if (nseqs < 0 || nmotifs < 0) {
+		PyErr_SetString(PyExc_ValueError, "offsets should contain at least one element");
+		goto done;
+	}
+	if (seq_offsets[nseqs] > seqs_b.len) {
+		PyErr_SetString(PyExc_ValueError, "sequence offsets out of bounds");
+		goto done;
+	}
+	if (motif_offsets[nmotifs] * 6 * (Py_ssize_t) sizeof(double) > matrices_b.len) {
+		PyErr_SetString(PyExc_ValueError, "motif offsets out of bounds");
+		goto done;
+	}
+	if (table_offsets_b.len != (nmotifs + 1) * (Py_ssize_t) sizeof(long long) ||
+			table_offsets[nmotifs] * k_size * (Py_ssize_t) sizeof(double) > tables_b.len) {
+		PyErr_SetString(PyExc_ValueError, "table offsets out of bounds");
+		goto done;
+	}
+	for (m_idx = 0; m_idx < nmotifs; m_idx++) {
+		long long pwm_len = motif_offsets[m_idx + 1] - motif_offsets[m_idx];
+		if (table_offsets[m_idx + 1] - table_offsets[m_idx] != 2 * ((pwm_len + k - 1) / k)) {
+			PyErr_SetString(PyExc_ValueError, "tables do not match the motifs");
+			goto done;
+		}
+	}
+	if (min_scores_b.len < nmotifs * (Py_ssize_t) sizeof(double)) {
+		PyErr_SetString(PyExc_ValueError, "need a minimum score for every motif");
+		goto done;
+	}
+	if (counts != NULL) {
+		if (cutoffs_b.len < nmotifs * (Py_ssize_t) sizeof(double)) {
+			PyErr_SetString(PyExc_ValueError, "need a cutoff for every motif");
+			goto done;
+		}
+		if (counts_b.len != nout * (Py_ssize_t) sizeof(long long)) {
+			PyErr_SetString(PyExc_ValueError, "counts should be an int64 array of nseqs x nmotifs");
+			goto done;
+		}
+	}
+	if (scores_b.buf != NULL) {
+		// The type of the scores is determined by their size
+		if (scores_b.len == nout * (Py_ssize_t) sizeof(double)) {
+			out_double = 1;
+		} else if (scores_b.len != nout * (Py_ssize_t) sizeof(float)) {
+			PyErr_SetString(PyExc_ValueError, "scores should be a float32 or float64 array of nseqs x nmotifs");
+			goto done;
+		}
+	}
+	if (max_count <= 0) {
+		max_count = PY_SSIZE_T_MAX;
+	}
+
+	codes = (unsigned short *) malloc((seq_offsets[nseqs] + 1) * sizeof(unsigned short));
+	block = (double *) malloc(KMER_BLOCK * sizeof(double));
+	if (codes == NULL || block == NULL) {
+		PyErr_NoMemory();
+		goto done;
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	Py_ssize_t i, m, n;
+	long long b, b_len, j, j_max, c, ncols, pwm_len;
+	const unsigned short *seq_codes;
+	const double *pwm, *table;
+	double score, exact, best, cutoff, tol, count_above, count_near;
+	int strand;
+	int want_best = scores_b.buf != NULL;
+
+	kmer_encode(seqs, seq_offsets, nseqs, k, codes);
+
+	// Motifs in the outer loop, so the tables of a motif stay in the cache
+	for (m = 0; m < nmotifs; m++) {
+		pwm = matrices + motif_offsets[m] * 6;
+		pwm_len = motif_offsets[m + 1] - motif_offsets[m];
+		ncols = (pwm_len + k - 1) / k;
+		cutoff = counts != NULL ? cutoffs[m] : INFINITY;
+
+		// Upper bound of the rounding difference between table and matrix
+		// scores, windows within tol are rescored with the matrix
+		tol = 1.0;
+		for (j = 0; j < pwm_len; j++) {
+			tol += fabs(pwm[j * 6 + 1]) + fabs(pwm[j * 6 + 2]) + fabs(pwm[j * 6 + 3]) + fabs(pwm[j * 6 + 4]);
+		}
+		tol *= 1e-9;
+		count_above = cutoff + tol;
+		count_near = cutoff - tol;
+
+		for (i = 0; i < nseqs; i++) {
+			seq_codes = codes + seq_offsets[i];
+			j_max = seq_offsets[i + 1] - seq_offsets[i] - pwm_len + 1;
+
+			n = 0;
+			best = j_max > 0 ? -INFINITY : min_scores[m];
+			for (strand = 0; strand < (scan_rc ? 2 : 1); strand++) {
+				table = tables + (table_offsets[m] + strand * ncols) * k_size;
+				for (b = 0; b < j_max && (want_best || n < max_count); b += KMER_BLOCK) {
+					b_len = j_max - b < KMER_BLOCK ? j_max - b : KMER_BLOCK;
+					// Add the tables one by one, for a block of windows
+					for (j = 0; j < b_len; j++) {
+						block[j] = table[seq_codes[b + j]];
 					}
-					if (p < (n_report-1)) {
-						for (q = n_report - 1; q > (p + 1); q--) {
-							maxScores[q] = maxScores[q - 1];
-							maxPos[q] = maxPos[q - 1];
-							maxStrand[q] = maxStrand[q - 1];
+					for (c = 1; c < ncols; c++) {
+						for (j = 0; j < b_len; j++) {
+							block[j] += table[c * k_size + seq_codes[b + j + c * k]];
+						}
+					}
+					for (j = 0; j < b_len; j++) {
+						score = block[j];
+						if (score >= count_above) {
+							if (n < max_count) n++;
+						} else if (score >= count_near) {
+							if (window_score(pwm, pwm_len, seqs + seq_offsets[i] + b + j, strand) >= cutoff && n < max_count) {
+								n++;
+							}
+						}
+						if (want_best && score > best - tol) {
+							exact = window_score(pwm, pwm_len, seqs + seq_offsets[i] + b + j, strand);
+							if (exact > best) {
+								best = exact;
+							}
 						}
-						maxScores[p + 1] = score;
-						maxPos[p + 1] = j;
-						maxStrand[p + 1] = -1;
 					}
 				}
 			}
-			else {
-				if (score >= cutoff) {
-					PyObject* row = PyList_New(0);
-					x = PyFloat_FromDouble(score);
-					PyList_Append(row, x); Py_DECREF(x);
-					x = PyInt_FromLong((long) j);
-					PyList_Append(row, x); Py_DECREF(x);
-					x =  PyInt_FromLong((long) 1);
-					PyList_Append(row, x); Py_DECREF(x);
-					PyList_Append(return_list, row);
-					Py_DECREF(row);
+
+			if (counts != NULL) {
+				counts[i * nmotifs + m] = n;
+			}
+			if (scores_b.buf != NULL) {
+				if (out_double) {
+					((double *) scores_b.buf)[i * nmotifs + m] = best;
+				} else {
+					((float *) scores_b.buf)[i * nmotifs + m] = (float) best;
 				}
 			}
 		}
 	}
+	Py_END_ALLOW_THREADS
+
+	Py_INCREF(Py_None);
+	ret = Py_None;
+
+done:
+	free(codes);
+	free(block);
+	PyBuffer_Release(&seqs_b);
+	PyBuffer_Release(&seq_offsets_b);
+	PyBuffer_Release(&matrices_b);
+	PyBuffer_Release(&motif_offsets_b);
+	PyBuffer_Release(&tables_b);
+	PyBuffer_Release(&table_offsets_b);
+	PyBuffer_Release(&cutoffs_b);
+	PyBuffer_Release(&min_scores_b);
+	if (counts_b.obj != NULL) PyBuffer_Release(&counts_b);
+	if (scores_b.obj != NULL) PyBuffer_Release(&scores_b);
+	return ret;
+}
 
-	for (i = 0; i < n_report; i++) {
-		if (maxPos[i] > - 1) {
-			PyObject* row = PyList_New(0);
-			x = PyFloat_FromDouble(maxScores[i]);
-			PyList_Append(row, x);  Py_DECREF(x);
-			x = PyInt_FromLong((long)maxPos[i]);
-			PyList_Append(row, x); Py_DECREF(x);
-			x = PyInt_FromLong((long)maxStrand[i]);
-			PyList_Append(row, x); Py_DECREF(x);
-			PyList_Append(return_list, row);
-			Py_DECREF(row);
+static PyObject * c_metrics_pfmscan(PyObject *self, PyObject * args)
+{
+	PyObject *pfm_o;
+	PyObject *cutoff_o;
+	char *seq;
+	Py_ssize_t seq_len;
+	int n_report;
+	int pwm_len;
+	int i, j;
+	int scan_rc;
+	int return_all = 0;
+
+	if (!PyArg_ParseTuple(args, "s#OOii|i", &seq, &seq_len, &pfm_o, &cutoff_o, &n_report, &scan_rc, &return_all))
+			return NULL;
+
+	// Retrieve frequency matrix
+	if (!PyList_Check(pfm_o))
+			return NULL;
+
+	// Weight matrices
+	pwm_len = PyList_Size(pfm_o);
+	double pfm[pwm_len][4];
+	double pwm[pwm_len][6];
+	fill_matrix(pfm, pfm_o);
+	if (PyErr_Occurred())
+			return NULL;
+
+	// Convert to log-odds, with the minimum score of every row for N
+	double g = 0.25;
+	double z = 0.01;
+	for (i = 0; i < pwm_len; i++) {
+		pwm[i][0] = 10;
+		for (j = 0; j < 4; j++) {
+			pwm[i][j + 1] = log(pfm[i][j] / g + z);
+			if (pwm[i][j + 1] < pwm[i][0]) {
+				pwm[i][0] = pwm[i][j + 1];
+			}
 		}
+		pwm[i][5] = pwm[i][0];
 	}
 
-	return return_list;
+	// Cutoff for every spacer length
+	double cutoff;
+	cutoff = PyFloat_AsDouble(cutoff_o);
+
+	return pwmscan_windows(seq, seq_len, pwm, pwm_len, cutoff, n_report, scan_rc, return_all);
 }
 
 
 
+static PyObject * c_metrics_simd_level(PyObject *self, PyObject * args)
+{
+	// Return the name of the SIMD implementation that is used by the scan
+	// functions. If a name is given, that implementation is selected; this
+	// is mainly useful to test or benchmark the slower implementations.
+	const char *name = NULL;
+	int level;
+
+	if (!PyArg_ParseTuple(args, "|s", &name))
+		return NULL;
+
+	if (name != NULL) {
+		for (level = 0; level < (int) (sizeof(simd_names) / sizeof(simd_names[0])); level++) {
+			if (strcmp(name, simd_names[level]) == 0) {
+				break;
+			}
+		}
+		if (level == (int) (sizeof(simd_names) / sizeof(simd_names[0]))) {
+			PyErr_Format(PyExc_ValueError, "unknown SIMD level %s", name);
+			return NULL;
+		}
+		if (level > simd_supported()) {
+			PyErr_Format(PyExc_ValueError, "SIMD level %s is not supported by this CPU", name);
+			return NULL;
+		}
+		simd_selected = level;
+	}
+	score_block();
+	return PyUnicode_FromString(simd_names[simd_selected]);
+}
+
 static PyMethodDef CoreMethods[] = {
 	{"score", c_metrics_score, METH_VARARGS,"Test"},
 	{"c_max_subtotal", c_metrics_max_subtotal, METH_VARARGS,"Test"},
 	{"pfmscan", c_metrics_pfmscan, METH_VARARGS,"Test"},
 	{"pwmscan", c_metrics_pwmscan, METH_VARARGS,"Test"},
+	{"pwmscan_batch", c_metrics_pwmscan_batch, METH_VARARGS,
+		"Scan a batch of encoded sequences with stacked motifs, results are written to output arrays"},
+	{"pwmscan_batch_zscore", c_metrics_pwmscan_batch_zscore, METH_VARARGS,
+		"Same as pwmscan_batch, with z-scores based on the background mean and std per GC% bin"},
+	{"pwmscan_best", c_metrics_pwmscan_best, METH_VARARGS,
+		"Best score of stacked motifs in a batch of encoded sequences, written to an output array"},
+	{"pwmscan_count", c_metrics_pwmscan_count, METH_VARARGS,
+		"Number of matches of stacked motifs in a batch of encoded sequences, written to an output array"},
+	{"pwmscan_count_best", c_metrics_pwmscan_count_best, METH_VARARGS,
+		"Number of matches and best score of stacked motifs in a batch of encoded sequences, in one pass"},
+	{"pwmscan_kmer", c_metrics_pwmscan_kmer, METH_VARARGS,
+		"Number of matches and/or best score of stacked motifs, scored with super-alphabet tables"},
+	{"simd_level", c_metrics_simd_level, METH_VARARGS,
+		"Name of the SIMD implementation of the scan functions, optionally select another one"},
 	{NULL, NULL, NULL, 0, NULL}
 };
 
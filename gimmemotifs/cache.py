@@ -0,0 +1,419 @@
+# Copyright (c) 2009-2021 Simon van Heeringen <simon.vanheeringen@gmail.com>
+#
+# This module is free software. You can redistribute it and/or modify it under
+# the terms of the MIT License, see the file COPYING included with this
+# distribution.
+""" Tiered cache of motif thresholds, background scores and backgrounds.
+
+Values are first looked up in a small in-process LRU cache and then in a
+persistent store. By default the store is a diskcache.Cache in the GimmeMotifs
+cache directory, which is shared by all processes and evicts the least
+recently used values when it is larger than its size limit. Memcached can be
+used as store instead, this requires pylibmc and a running memcached server.
+
+Values that are expensive to compute are computed once with get_or_compute().
+The keys that are computed are locked in the store, so other processes that
+need the same keys wait for the result, while processes that need other keys
+continue. A lock records the host and process id of its owner; the lock of a
+process that is no longer running is taken over. Values of many keys are read
+and written in one transaction.
+
+The store is configured in the [params] section of the configuration:
+
+    cache_backend = disk            # or memcached
+    cache_size = 1073741824         # maximum size of the disk cache in bytes
+    memcached_servers = 127.0.0.1   # comma-separated
+"""
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import xxhash
+from diskcache import Cache
+
+from gimmemotifs.config import MotifConfig, CACHE_DIR
+
+logger = logging.getLogger("gimme.cache")
+
+# Maximum number of values in the in-process cache
+MEMORY_SIZE = 10000
+
+# Default maximum size of the disk cache in bytes
+DISK_SIZE = 2 ** 30
+
+BACKENDS = ["disk", "memcached"]
+
+# Seconds after which the lock of a key is released. Locks of processes on
+# the same host that are no longer running are taken over right away, this is
+# for processes on other hosts that share a memcached store.
+LOCK_EXPIRE = 3600
+# Seconds between attempts to acquire a lock, and between log messages while
+# waiting for a lock
+LOCK_POLL = 0.05
+LOCK_LOG_INTERVAL = 60
+
+# Cache of this process, see get_cache()
+_cache = None
+
+
+class DiskStore(Cache):
+    """diskcache.Cache that reads and writes many keys in one transaction."""
+
+    def get_many(self, keys):
+        values = {}
+        with self.transact(retry=True):
+            for key in keys:
+                value = self.get(key, retry=True)
+                if value is not None:
+                    values[key] = value
+        return values
+
+    def set_many(self, items):
+        with self.transact(retry=True):
+            for key, value in items.items():
+                self.set(key, value, retry=True)
+
+    def add(self, key, value, expire=None):
+        return super().add(key, value, expire=expire, retry=True)
+
+    def delete(self, key):
+        return super().delete(key, retry=True)
+
+    def cas(self, key, old, new):
+        """Replace the value of key by new (or delete it if new is None), only
+        if the value is still old. Returns True if it was replaced."""
+        with self.transact(retry=True):
+            if self.get(key, retry=True) != old:
+                return False
+            if new is None:
+                self.delete(key)
+            else:
+                self.set(key, new, expire=LOCK_EXPIRE, retry=True)
+        return True
+
+
+class MemcachedStore(object):
+    """Persistent store in memcached, with the same interface as diskcache.
+
+    Parameters
+    ----------
+    servers : list, optional
+        Memcached servers, by default the local server.
+    """
+
+    def __init__(self, servers=None):
+        import pylibmc
+
+        if servers is None:
+            servers = ["127.0.0.1"]
+        self.client = pylibmc.Client(servers, binary=True, behaviors={"cas": True})
+
+    @staticmethod
+    def _key(key):
+        # Memcached keys are limited to 250 characters without whitespace
+        return xxhash.xxh64(key).hexdigest()
+
+    def get(self, key, default=None):
+        value = self.client.get(self._key(key))
+        return default if value is None else value
+
+    def set(self, key, value):
+        return self.client.set(self._key(key), value)
+
+    def get_many(self, keys):
+        hashed = {self._key(key): key for key in keys}
+        values = self.client.get_multi(list(hashed))
+        return {hashed[k]: v for k, v in values.items() if v is not None}
+
+    def set_many(self, items):
+        self.client.set_multi({self._key(k): v for k, v in items.items()})
+
+    def add(self, key, value, expire=None):
+        return self.client.add(self._key(key), value, time=expire or 0)
+
+    def delete(self, key):
+        return self.client.delete(self._key(key))
+
+    def cas(self, key, old, new):
+        """Same as DiskStore.cas(). Deleting is not atomic in memcached, a
+        value that is set between the check and the delete is deleted."""
+        key = self._key(key)
+        value, cas_id = self.client.gets(key)
+        if value is None or value != old:
+            return False
+        if new is None:
+            return self.client.delete(key)
+        return self.client.cas(key, new, cas_id, time=LOCK_EXPIRE)
+
+    def close(self):
+        self.client.disconnect_all()
+
+
+class TieredCache(object):
+    """In-process LRU cache in front of a persistent store.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Directory of the disk cache, by default the GimmeMotifs cache
+        directory.
+
+    backend : str, optional
+        Persistent store, "disk" (default) or "memcached".
+
+    memory_size : int, optional
+        Maximum number of values in the in-process cache.
+
+    size_limit : int, optional
+        Maximum size of the disk cache in bytes.
+
+    servers : list, optional
+        Memcached servers.
+    """
+
+    def __init__(
+        self,
+        directory=None,
+        backend="disk",
+        memory_size=MEMORY_SIZE,
+        size_limit=DISK_SIZE,
+        servers=None,
+    ):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown cache backend {}".format(backend))
+
+        if backend == "memcached":
+            self.store = MemcachedStore(servers)
+        else:
+            if directory is None:
+                directory = CACHE_DIR
+            self.store = DiskStore(
+                directory,
+                size_limit=int(size_limit),
+                eviction_policy="least-recently-used",
+            )
+        self.backend = backend
+        self.pid = os.getpid()
+        self.memory_size = memory_size
+        self._memory = OrderedDict()
+        self.hits = {"memory": 0, backend: 0}
+        self.misses = 0
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get(self, key, default=None):
+        """Return the value of key, or default if it is not in the cache."""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits["memory"] += 1
+            return self._memory[key]
+
+        value = self.store.get(key)
+        if value is None:
+            self.misses += 1
+            return default
+
+        self.hits[self.backend] += 1
+        self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        """Store a value in both tiers."""
+        self._remember(key, value)
+        self.store.set(key, value)
+
+    def get_many(self, keys):
+        """Return a dictionary with the values of the keys that are cached."""
+        values = {}
+        missing = []
+        for key in keys:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                values[key] = self._memory[key]
+            else:
+                missing.append(key)
+        self.hits["memory"] += len(values)
+
+        found = self._get_store(missing)
+        self.misses += len(missing) - len(found)
+        values.update(found)
+        return values
+
+    def _get_store(self, keys):
+        """Return the values of keys from the store and keep them in memory."""
+        if len(keys) == 0:
+            return {}
+        values = self.store.get_many(keys)
+        for key, value in values.items():
+            self._remember(key, value)
+        self.hits[self.backend] += len(values)
+        return values
+
+    def set_many(self, items):
+        """Store a dictionary of values in both tiers."""
+        for key, value in items.items():
+            self._remember(key, value)
+        self.store.set_many(items)
+
+    @contextmanager
+    def lock(self, keys):
+        """Lock keys, in all processes that use the same store.
+
+        Keys are locked in sorted order, so processes that lock overlapping
+        sets of keys cannot deadlock. The locks are released when the block
+        exits, also on an exception. A lock that is held by a process that
+        is no longer running is taken over, see _owner_running().
+        """
+        # The token distinguishes locks of the same process
+        owner = (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        locked = []
+        last_log = None
+        try:
+            for key in sorted(set(keys)):
+                lock_key = "lock|{}".format(key)
+                while not self.store.add(lock_key, owner, expire=LOCK_EXPIRE):
+                    current = self.store.get(lock_key)
+                    if current is None:
+                        # Released in the meantime
+                        continue
+                    if not _owner_running(current):
+                        if self.store.cas(lock_key, current, owner):
+                            logger.warning(
+                                "Took over the lock of %s from %s, "
+                                "which is no longer running",
+                                key,
+                                _owner_name(current),
+                            )
+                            break
+                        continue
+                    now = time.monotonic()
+                    if last_log is None or now - last_log > LOCK_LOG_INTERVAL:
+                        logger.info(
+                            "Waiting for %s, which is computed by %s",
+                            key,
+                            _owner_name(current),
+                        )
+                        last_log = now
+                    time.sleep(LOCK_POLL)
+                locked.append(lock_key)
+            yield
+        finally:
+            for lock_key in locked:
+                # Only release the locks that were not taken over
+                self.store.cas(lock_key, owner, None)
+
+    def get_or_compute(self, keys, compute):
+        """Return the values of keys, and compute the missing values once.
+
+        The missing keys are locked while they are computed. A process that
+        needs one of these keys waits until the value is stored, and does not
+        compute it again.
+
+        Parameters
+        ----------
+        keys : list
+            Cache keys.
+
+        compute : callable
+            Function that is called with the list of missing keys, and
+            returns a dictionary with their values.
+
+        Returns
+        -------
+        dict
+            Value of every key.
+        """
+        values = self.get_many(keys)
+        missing = [key for key in dict.fromkeys(keys) if key not in values]
+        if len(missing) == 0:
+            return values
+
+        with self.lock(missing):
+            # Values computed by another process while waiting for the lock
+            values.update(self._get_store(missing))
+            missing = [key for key in missing if key not in values]
+            if len(missing) > 0:
+                computed = compute(missing)
+                self.set_many(computed)
+                values.update(computed)
+        return values
+
+    def stats(self):
+        """Return the number of hits per tier and the number of misses."""
+        stats = {"{}_hits".format(tier): n for tier, n in self.hits.items()}
+        stats["misses"] = self.misses
+        return stats
+
+    def __getstate__(self):
+        # The in-process cache is not copied
+        state = self.__dict__.copy()
+        state["_memory"] = OrderedDict()
+        return state
+
+    def clear_memory(self):
+        """Remove all values from the in-process cache."""
+        self._memory.clear()
+
+    def close(self):
+        self.store.close()
+
+
+def _owner_name(owner):
+    """Description of the owner of a lock, for log messages."""
+    if isinstance(owner, tuple):
+        return "process {} on {}".format(owner[1], owner[0])
+    return "process {}".format(owner)
+
+
+def _owner_running(owner):
+    """Return False if the process that owns a lock is no longer running.
+
+    This can only be checked for processes on this host, the locks of
+    processes on other hosts expire after LOCK_EXPIRE seconds.
+    """
+    if not isinstance(owner, tuple):
+        # Lock of an older version, without the host
+        return False
+    host, pid = owner[:2]
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running, as another user
+        pass
+    return True
+
+
+def get_cache():
+    """Return the cache of this process, configured from the GimmeMotifs
+    configuration.
+
+    Returns
+    -------
+    TieredCache
+    """
+    global _cache
+    if _cache is None or _cache.pid != os.getpid():
+        params = MotifConfig().get_default_params()
+        backend = params.get("cache_backend", "disk")
+        servers = params.get("memcached_servers", "127.0.0.1").split(",")
+        size_limit = int(params.get("cache_size", DISK_SIZE))
+        try:
+            _cache = TieredCache(
+                backend=backend, size_limit=size_limit, servers=servers
+            )
+        except ImportError:
+            logger.warning("pylibmc is not installed, using the disk cache")
+            _cache = TieredCache(size_limit=size_limit)
+    return _cache
@@ -190,7 +190,11 @@ def cli(sys_args):
     NREPORT = 1
     p = subparsers.add_parser("scan")
     p.add_argument(
-        "inputfile", help="inputfile (FASTA, BED, regions)", metavar="INPUTFILE"
+        "inputfile",
+        help="inputfile (FASTA, BED, regions)",
+        metavar="INPUTFILE",
+        nargs="?",
+        default=None,
     )
     p.add_argument(
         "-g", "--genome", dest="genome", help="Genome", metavar="GENOME", default=None
@@ -231,9 +235,9 @@ def cli(sys_args):
         "-n",
         "--nreport",
         dest="nreport",
-        help="report the N best matches",
+        help="report the N best matches (default %s)" % NREPORT,
         metavar="N",
-        default=NREPORT,
+        default=None,
         type=int,
     )
     p.add_argument(
@@ -268,6 +272,22 @@ def cli(sys_args):
         action="store_true",
         default=False,
     )
+    p.add_argument(
+        "--format",
+        dest="fmt",
+        help="output format: text (GFF, BED or table), or columnar "
+        "arrow (Arrow IPC / Feather) or parquet (default text)",
+        choices=["text", "arrow", "parquet"],
+        default="text",
+    )
+    p.add_argument(
+        "--kernel",
+        dest="kernel",
+        help="scanning kernel, all kernels give the same results "
+        "(moods requires MOODS-python)",
+        choices=["default", "superalphabet", "simd", "moods"],
+        default="default",
+    )
     p.add_argument(
         "-z",
         "--zscore",
@@ -292,12 +312,27 @@ def cli(sys_args):
         type=int,
         default=int(params["ncpus"]),
     )
+    p.add_argument(
+        "--genome-wide",
+        dest="genome_wide",
+        help="scan the complete genome (-g) and write all hits as sorted BED files, "
+        "one per chromosome, to DIR (no INPUTFILE needed)",
+        metavar="DIR",
+        default=None,
+    )
+    p.add_argument(
+        "--bgzip",
+        dest="bgzip",
+        help="compress and index the --genome-wide output with bgzip and tabix",
+        action="store_true",
+        default=False,
+    )
     p.add_argument(
         "-M",
         "--do_MOODS",
         dest="moods",
         help=argparse.SUPPRESS,
-        # help="experimental: use MOODS for scanning",
+        # same as --kernel moods
         action="store_true",
         default=False,
     )
@@ -306,7 +341,7 @@ def cli(sys_args):
         "--pvalue",
         dest="pvalue",
         help=argparse.SUPPRESS,
-        # help="experimental: MOODS p-value cutoff",
+        # same as --fpr
         metavar="",
         type=float,
         default=None,
@@ -531,6 +566,16 @@ def cli(sys_args):
         "inputfile", help="FASTA file with background sequences", metavar="FAFILE"
     )
     p.add_argument("fpr", help="Desired fpr", type=float, metavar="FPR")
+    p.add_argument(
+        "-m",
+        "--method",
+        dest="method",
+        help="scan the background sequences (scan) or calculate the exact score "
+        "distribution based on the background nucleotide composition (dp) "
+        "(default scan)",
+        choices=["scan", "dp"],
+        default="scan",
+    )
     p.set_defaults(func=commands.threshold)
 
     # motif_localization_plots.py
@@ -11,8 +11,8 @@ Creates a histogram of motif matches relative to sequence center.
 from gimmemotifs.fasta import Fasta
 from gimmemotifs.motif import read_motifs
 from gimmemotifs.utils import motif_localization
-from multiprocessing import Pool
 from gimmemotifs.config import MotifConfig
+from gimmemotifs.pool import get_pool
 import os
 
 
@@ -41,7 +41,7 @@ def location(args):
         ids = args.ids.split(",")
 
     n_cpus = int(MotifConfig().get_default_params()["ncpus"])
-    pool = Pool(processes=n_cpus, maxtasksperchild=1000)
+    pool = get_pool(n_cpus)
     for motif in motifs:
         if motif.id in ids:
             outfile = os.path.join("%s_histogram" % motif.id)
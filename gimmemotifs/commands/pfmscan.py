@@ -9,18 +9,57 @@ Command line function 'scan'.
 """
 import sys
 
-from gimmemotifs.scanner import scan_to_file
+from gimmemotifs.scanner import scan_to_file, scan_genome_to_files
 
 MAX_CPUS = 16
 
 
 def pfmscan(args):
 
+    if args.genome_wide:
+        if not args.genome:
+            sys.stderr.write("A genome (-g) is needed to scan genome-wide!\n")
+            sys.exit(1)
+        # All matches are written as BED files, with logodds scores
+        ignored = [
+            ("-n", args.nreport is not None),
+            ("-t", args.table),
+            ("-T", args.score_table),
+            ("-z", args.zscore),
+            ("--gc", args.gcnorm),
+            ("-B", args.bgfile),
+            ("--format", args.fmt != "text"),
+        ]
+        ignored = [option for option, specified in ignored if specified]
+        if ignored:
+            sys.stderr.write(
+                "Option(s) {} can't be used with --genome-wide!\n".format(
+                    ", ".join(ignored)
+                )
+            )
+            sys.exit(1)
+        scan_genome_to_files(
+            args.genome,
+            args.pfmfile,
+            args.genome_wide,
+            fpr=args.fpr,
+            cutoff=args.cutoff,
+            scan_rc=args.scan_rc,
+            bgzip=args.bgzip,
+            ncpus=args.ncpus,
+            kernel="moods" if args.moods else args.kernel,
+        )
+        return
+
+    if args.inputfile is None:
+        sys.stderr.write("Please specify an INPUTFILE!\n")
+        sys.exit(1)
+
     scan_to_file(
         args.inputfile,
         args.pfmfile,
         sys.stdout,
-        nreport=args.nreport,
+        nreport=1 if args.nreport is None else args.nreport,
         fpr=args.fpr,
         cutoff=args.cutoff,
         bed=args.bed,
@@ -34,4 +73,6 @@ def pfmscan(args):
         ncpus=args.ncpus,
         zscore=args.zscore,
         gcnorm=args.gcnorm,
+        fmt=args.fmt,
+        kernel=args.kernel,
     )
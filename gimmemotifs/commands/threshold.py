@@ -20,13 +20,15 @@ def threshold(args):
 
     s = Scanner()
     s.set_motifs(args.pfmfile)
-    s.set_threshold(args.fpr, filename=args.inputfile)
+    s.set_background(fname=args.inputfile)
+    s.set_threshold(fpr=args.fpr, method=args.method)
+    thresholds = s.get_gc_thresholds(s.background.seqs)
 
     print("Motif\tScore\tCutoff")
     for motif in motifs:
         min_score = motif.pwm_min_score()
         max_score = motif.pwm_max_score()
-        opt_score = s.threshold[motif.id]
+        opt_score = thresholds[motif.id]
         if opt_score is None:
             opt_score = motif.pwm_max_score()
         threshold = (opt_score - min_score) / (max_score - min_score)
@@ -26,9 +26,9 @@ import pandas as pd
 from gimmemotifs.config import MotifConfig
 from gimmemotifs.c_metrics import pfmscan, score
 from gimmemotifs.motif import parse_motifs, read_motifs
+from gimmemotifs.pool import get_pool, pool_available
 from gimmemotifs.utils import pfmfile_location
 
-# pool import is at the bottom
 
 try:
     import copy_reg
@@ -717,13 +717,13 @@ class MotifComparer(object):
         # hash of result scores
         scores = {}
 
-        if parallel:
+        if parallel and pool_available():
             # Divide the job into big chunks, to keep parallel overhead to minimum
             # Number of chunks = number of processors available
             if ncpus is None:
                 ncpus = int(MotifConfig().get_default_params()["ncpus"])
 
-            pool = Pool(processes=ncpus, maxtasksperchild=1000)
+            pool = get_pool(ncpus)
 
             batch_len = len(dbmotifs) // ncpus
             if batch_len <= 0:
@@ -746,7 +746,6 @@ class MotifComparer(object):
                 )
                 jobs.append(p)
 
-            pool.close()
             for job in jobs:
                 # Get the job result
                 result = job.get()
@@ -756,8 +755,6 @@ class MotifComparer(object):
                         if m1 not in scores:
                             scores[m1] = {}
                         scores[m1][m2] = s
-
-            pool.join()
         else:
             # Do the whole thing at once if we don't want parallel
             scores = _get_all_scores(
@@ -1001,11 +998,3 @@ def select_nonredundant_motifs(
         f"selected {len(selected_features)} non-redundant motifs: ROC AUC {roc_auc:.3f}, PR AUC {pr_auc:.3f}"
     )
     return selected_features
-
-
-# import here is necessary as workaround
-# see: http://stackoverflow.com/questions/18947876/using-python-multiprocessing-pool-in-the-terminal-and-in-code-modules-for-django  # noqa: E501
-try:
-    from multiprocessing import Pool
-except ImportError:
-    pass
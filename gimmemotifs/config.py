@@ -187,8 +187,11 @@ class MotifConfig(object):
 
     def get_default_params(self):
         d = dict(self.config.items("params"))
-        for k in ["use_strand", "use_cache"]:
+        for k in ["use_strand"]:
             d[k] = self.config.getboolean("params", k)
+        # Not present in configuration files of older versions
+        if self.config.has_option("params", "scan_cache"):
+            d["scan_cache"] = self.config.getboolean("params", "scan_cache")
 
         if "size" not in d:
             d["size"] = d["width"]
@@ -13,8 +13,14 @@ import numpy as np
 
 class Fasta(object):
     def __init__(self, fname=None, split_whitespace=False, fdict=None):
-        """Instantiate fasta object. Optional Fasta-formatted file as argument"""
-        self.ids = []
+        """Instantiate fasta object. Optional Fasta-formatted file as argument
+
+        Sequences are stored in order in the ids and seqs lists. A dictionary
+        maps every id to its position, so lookup by id is O(1). The lists
+        should not be changed in place, assign a new list to ids instead.
+        """
+        self._ids = []
+        self._index = {}
         self.seqs = []
         p = re.compile(r"[^abcdefghiklmnpqrstuvwyzxABCDEFGHIKLMNPQRSTUVWXYZ]")
         if fname:
@@ -24,27 +30,52 @@ class Fasta(object):
             if not (c.startswith(">")):
                 raise IOError("Not a valid FASTA file")
 
+            ids = []
             for seq in re.split(r"\r?\n>", c[1:]):
                 if len(seq) > 1:
                     lines = re.split(r"\r?\n", seq)
                     seq_name = lines[0]
                     if split_whitespace:
                         seq_name = seq_name.split(" ")
-                    self.ids.append(seq_name)
+                    ids.append(seq_name)
                     sequence = "".join(lines[1:])
                     if p.match(sequence):
                         raise IOError("Not a valid FASTA file")
                     self.seqs.append(sequence)
+            self.ids = ids
         elif fdict is not None:
-            for name, seq in fdict.items():
-                self.ids.append(name)
-                self.seqs.append(seq)
+            self.ids = list(fdict.keys())
+            self.seqs = list(fdict.values())
+
+    @property
+    def ids(self):
+        return self._ids
+
+    @ids.setter
+    def ids(self, ids):
+        self._ids = list(ids)
+        self._index = None
+
+    def __setstate__(self, state):
+        # Fasta objects pickled before the index was added store ids directly
+        if "ids" in state:
+            state["_ids"] = state.pop("ids")
+        state["_index"] = None
+        self.__dict__.update(state)
+
+    def _get_index(self):
+        """Return the dictionary of id to position, built on first use."""
+        if self._index is None:
+            # Duplicate ids point to their first occurrence
+            self._index = {}
+            for i, seq_id in enumerate(self._ids):
+                self._index.setdefault(seq_id, i)
+        return self._index
 
     def hardmask(self):
         """Mask all lowercase nucleotides with N's"""
         p = re.compile("a|c|g|t|n")
-        for seq_id in self.ids:
-            self[seq_id] = p.sub("N", self[seq_id])
+        self.seqs = [p.sub("N", seq) for seq in self.seqs]
         return self
 
     def get_random(self, n, length=None):
@@ -77,13 +108,13 @@ class Fasta(object):
     def __getitem__(self, idx):
         if isinstance(idx, slice):
             f = Fasta()
-            f.ids = self.ids[idx][:]
-            f.seqs = self.seqs[idx][:]
+            f.ids = self.ids[idx]
+            f.seqs = self.seqs[idx]
             return f
-        elif idx in self.ids:
-            return self.seqs[self.ids.index(idx)]
-        else:
+        i = self._get_index().get(idx)
+        if i is None:
             return None
+        return self.seqs[i]
 
     def __repr__(self):
         return "%s sequences" % len(self.ids)
@@ -92,29 +123,35 @@ class Fasta(object):
         return len(self.ids)
 
     def __setitem__(self, key, value):
-        if key in self.ids:
-            self.seqs[self.ids.index(key)] = value
+        i = self._get_index().get(key)
+        if i is None:
+            self.add(key, value)
         else:
-            self.ids.append(key)
-            self.seqs.append(value)
+            self.seqs[i] = value
 
     def __delitem__(self, key):
-        i = self.ids.index(key)
-        self.ids.pop(i)
+        i = self._get_index().get(key)
+        if i is None:
+            raise ValueError("{} is not in Fasta".format(key))
+        self._ids.pop(i)
         self.seqs.pop(i)
+        # Positions after i have changed, the index is rebuilt on next use
+        self._index = None
+
+    def __contains__(self, key):
+        return key in self._get_index()
 
     def _format_seq(self, seq):
         return seq
 
     def add(self, seq_id, seq):
-        self.ids.append(seq_id)
+        if self._index is not None:
+            self._index.setdefault(seq_id, len(self._ids))
+        self._ids.append(seq_id)
         self.seqs.append(seq)
 
     def has_key(self, key):
-        if key in self.ids:
-            return True
-        else:
-            return False
+        return key in self
 
     def __str__(self):
         return "%s sequences" % len(self.ids)
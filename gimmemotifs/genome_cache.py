@@ -0,0 +1,276 @@
+# Copyright (c) 2009-2021 Simon van Heeringen <simon.vanheeringen@gmail.com>
+#
+# This module is free software. You can redistribute it and/or modify it under
+# the terms of the MIT License, see the file COPYING included with this
+# distribution.
+""" Memory-mapped genome cache for fast retrieval of regions.
+
+The first time a genome is used, all chromosomes are encoded with one byte per
+nucleotide (N=0, A=1, C=2, G=3, T=4) and stored in the GimmeMotifs cache
+directory. The encoded genome is memory-mapped, so regions can be copied
+directly to the buffer that is scanned, without a temporary FASTA file.
+
+The encoded genome takes one byte per nucleotide on disk, about 3.1 GB for
+hg38. The total size of the encoded genomes in the cache directory is limited
+by the genome_cache_size parameter in the [params] section of the
+configuration (in bytes, by default MAX_SIZE). A genome that does not fit is
+not cached, its regions are read from the FASTA file instead. An encoded
+genome is replaced when the FASTA file changes, for instance when it is
+downloaded again.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+from tempfile import mkstemp
+
+import numpy as np
+import pandas as pd
+from genomepy import Genome
+
+from gimmemotifs.config import CACHE_DIR, MotifConfig
+
+logger = logging.getLogger("gimme.genome_cache")
+
+# Lookup table to encode sequences: N=0, A=1, C=2, G=3, T=4.
+# Any other character is treated as an N.
+SEQ_ENCODING = np.zeros(256, dtype=np.uint8)
+for _i, _nuc in enumerate("ACGT"):
+    SEQ_ENCODING[ord(_nuc)] = _i + 1
+    SEQ_ENCODING[ord(_nuc.lower())] = _i + 1
+
+# Nucleotides that are read from the genome FASTA file at once when the
+# cache is created, and maximum size of one gather from the cache.
+CHUNK_SIZE = 2 ** 24
+
+# Default maximum size in bytes of all encoded genomes in the cache directory
+MAX_SIZE = 2 ** 30
+
+region_p = re.compile(r"^([^\s:@]+):(\d+)-(\d+)$")
+
+# Open genome caches, by genome name
+_genome_caches = {}
+
+
+def get_genome_cache(genome):
+    """Return the GenomeCache of a genome, it is only opened once per process.
+
+    Parameters
+    ----------
+    genome : str or genomepy.Genome
+        Genome name, FASTA file or Genome instance.
+
+    Returns
+    -------
+    GenomeCache
+    """
+    name = genome.filename if isinstance(genome, Genome) else genome
+    if name not in _genome_caches:
+        _genome_caches[name] = GenomeCache(genome)
+    return _genome_caches[name]
+
+
+def is_region_list(regions):
+    """Return True if regions is a list or array of chrom:start-end regions."""
+    if not isinstance(regions, (list, np.ndarray)) or len(regions) == 0:
+        return False
+    # Same as as_fasta(), only the first element is checked
+    return isinstance(regions[0], str) and region_p.match(regions[0]) is not None
+
+
+class GenomeCache(object):
+    """Genome encoded with one byte per nucleotide, memory-mapped from disk.
+
+    Parameters
+    ----------
+    genome : str or genomepy.Genome
+        Genome name, FASTA file or Genome instance.
+
+    cache_dir : str, optional
+        Directory of the cache, by default the GimmeMotifs cache directory.
+
+    max_size : int, optional
+        Maximum size in bytes of all encoded genomes in the cache directory,
+        by default the genome_cache_size parameter of the configuration. If
+        the genome does not fit, regions are read from the FASTA file.
+    """
+
+    def __init__(self, genome, cache_dir=None, max_size=None):
+        if not isinstance(genome, Genome):
+            genome = Genome(genome)
+        self.genome = genome
+        self._pid = os.getpid()
+        self.cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+        if max_size is None:
+            params = MotifConfig().get_default_params()
+            max_size = int(params.get("genome_cache_size", MAX_SIZE))
+        self.max_size = max_size
+
+        fname = os.path.abspath(genome.filename)
+        stat = os.stat(fname)
+        key = hashlib.md5(
+            "{}|{}|{}".format(fname, stat.st_size, stat.st_mtime_ns).encode()
+        ).hexdigest()[:16]
+        base = os.path.join(
+            self.cache_dir, "{}.{}".format(os.path.basename(fname), key)
+        )
+        self.fname = base + ".encoded"
+        self.index_fname = base + ".index.json"
+
+        self.data = None
+        if os.path.exists(self.index_fname):
+            with open(self.index_fname) as f:
+                index = json.load(f)
+        else:
+            self._remove_stale(fname)
+            index = {"fasta": fname, "chroms": list(genome.keys())}
+            index["sizes"] = [len(genome[chrom]) for chrom in index["chroms"]]
+            if self._cached_size() + sum(index["sizes"]) <= self.max_size:
+                self._create(index)
+            else:
+                logger.info(
+                    "%s does not fit in the genome cache (genome_cache_size = %d), "
+                    "reading regions from the FASTA file",
+                    genome.name,
+                    self.max_size,
+                )
+
+        self.chroms = index["chroms"]
+        self.sizes = np.array(index["sizes"], dtype=np.int64)
+        self.offsets = np.zeros(len(self.sizes) + 1, dtype=np.int64)
+        np.cumsum(self.sizes, out=self.offsets[1:])
+        self._chrom_idx = pd.Series(np.arange(len(self.chroms)), index=self.chroms)
+
+        if os.path.exists(self.index_fname):
+            if self.offsets[-1] > 0:
+                self.data = np.memmap(self.fname, dtype=np.uint8, mode="r")
+            else:
+                self.data = np.zeros(0, dtype=np.uint8)
+
+    def _cached_size(self):
+        """Return the size in bytes of all encoded genomes in the cache."""
+        return sum(
+            os.path.getsize(fname)
+            for fname in glob.glob(os.path.join(self.cache_dir, "*.encoded"))
+        )
+
+    def _remove_stale(self, fasta):
+        """Remove the encoded genomes of older versions of a FASTA file."""
+        pattern = "{}.*.index.json".format(glob.escape(os.path.basename(fasta)))
+        for index_fname in glob.glob(os.path.join(self.cache_dir, pattern)):
+            try:
+                with open(index_fname) as f:
+                    if json.load(f).get("fasta") != fasta:
+                        continue
+                logger.info("removing old genome cache %s", index_fname)
+                # The index is removed first, the cache is incomplete without it
+                os.unlink(index_fname)
+                os.unlink(index_fname[: -len(".index.json")] + ".encoded")
+            except (OSError, ValueError):
+                # Removed by another process, or incomplete
+                continue
+
+    def _create(self, index):
+        """Encode the genome and write it to the cache."""
+        logger.info("creating genome cache of %s", self.genome.name)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        chroms, sizes = index["chroms"], index["sizes"]
+        fd, tmp = mkstemp(dir=self.cache_dir, suffix=".encoded")
+        os.close(fd)
+        try:
+            if sum(sizes) > 0:
+                data = np.memmap(tmp, dtype=np.uint8, mode="w+", shape=(sum(sizes),))
+                offset = 0
+                for chrom, size in zip(chroms, sizes):
+                    for start in range(0, size, CHUNK_SIZE):
+                        seq = self.genome[chrom][start : start + CHUNK_SIZE].seq
+                        raw = seq.encode("ascii", errors="replace")
+                        pos = offset + start
+                        data[pos : pos + len(raw)] = SEQ_ENCODING[
+                            np.frombuffer(raw, np.uint8)
+                        ]
+                    offset += size
+                data.flush()
+                del data
+            os.replace(tmp, self.fname)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+        # The index is written last, the cache is complete if it exists
+        fd, tmp = mkstemp(dir=self.cache_dir, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, self.index_fname)
+
+    def _fasta(self):
+        """Return the genome FASTA, it is opened once per process."""
+        if self._pid != os.getpid():
+            self.genome = Genome(self.genome.filename)
+            self._pid = os.getpid()
+        return self.genome
+
+    def encode_regions(self, regions):
+        """Return the encoded sequences of regions.
+
+        Parameters
+        ----------
+        regions : list
+            Regions in chrom:start-end format, with 0-based start.
+
+        Returns
+        -------
+        encoded : numpy.ndarray
+            Concatenated sequences as uint8 array (N=0, A=1, C=2, G=3, T=4).
+
+        offsets : numpy.ndarray
+            Start position of every sequence in encoded. The last element is
+            the total length.
+        """
+        coords = pd.Series(regions, dtype=object).str.extract(region_p)
+        if coords.isnull().values.any():
+            raise ValueError("regions should be in chrom:start-end format")
+
+        chrom_idx = coords[0].map(self._chrom_idx)
+        if chrom_idx.isnull().any():
+            chrom = coords[0][chrom_idx.isnull()].iloc[0]
+            raise ValueError("chromosome {} is not in the genome".format(chrom))
+        chrom_idx = chrom_idx.values.astype(np.int64)
+
+        # Regions are clipped to the chromosome
+        chrom_size = self.sizes[chrom_idx]
+        start = np.minimum(coords[1].values.astype(np.int64), chrom_size)
+        end = np.clip(coords[2].values.astype(np.int64), start, chrom_size)
+
+        seq_offsets = np.zeros(len(regions) + 1, dtype=np.int64)
+        np.cumsum(end - start, out=seq_offsets[1:])
+
+        if self.data is None:
+            # Not cached, read the regions from the FASTA file
+            fasta = self._fasta()
+            raw = "".join(
+                [
+                    fasta[chrom][s:e].seq
+                    for chrom, s, e in zip(coords[0], start.tolist(), end.tolist())
+                ]
+            ).encode("ascii", errors="replace")
+            return SEQ_ENCODING[np.frombuffer(raw, np.uint8)], seq_offsets
+
+        start += self.offsets[chrom_idx]
+        encoded = np.empty(seq_offsets[-1], dtype=np.uint8)
+
+        # Gather the regions in blocks, to limit the size of the index
+        i = 0
+        while i < len(regions):
+            j = np.searchsorted(seq_offsets, seq_offsets[i] + CHUNK_SIZE, "right")
+            j = min(max(j - 1, i + 1), len(regions))
+            lengths = seq_offsets[i + 1 : j + 1] - seq_offsets[i:j]
+            idx = np.arange(seq_offsets[i], seq_offsets[j]) + np.repeat(
+                start[i:j] - seq_offsets[i:j], lengths
+            )
+            encoded[seq_offsets[i] : seq_offsets[j]] = self.data[idx]
+            i = j
+        return encoded, seq_offsets
@@ -22,6 +22,7 @@ from functools import partial
 import numpy as np
 import pandas as pd
 from sklearn.preprocessing import scale
+from scipy.sparse import csr_matrix, issparse
 from scipy.stats import pearsonr
 from scipy.cluster import hierarchy
 from scipy.spatial.distance import pdist
@@ -39,13 +40,19 @@ sns.set_style("white")
 
 from gimmemotifs.config import MotifConfig, DIRECT_NAME, INDIRECT_NAME
 from gimmemotifs.moap import moap, Moap
-from gimmemotifs.scanner import scan_regionfile_to_table
+from gimmemotifs.scanner import scan_regionfile_to_table, scan_regionfile_to_tables
 from gimmemotifs.rank import rankagg
 from gimmemotifs.motif import read_motifs
+from gimmemotifs.pool import get_pool
 from gimmemotifs.report import maelstrom_html_report
-from gimmemotifs.utils import join_max, pfmfile_location
+from gimmemotifs.utils import (
+    join_max,
+    pfmfile_location,
+    read_motif_table,
+    table_to_matrix,
+    write_sparse_table,
+)
 
-from multiprocessing import Pool
 
 BG_LENGTH = 200
 BG_NUMBER = 10000
@@ -85,6 +92,54 @@ def moap_with_table(input_table, motif_table, data_dir, method, scoring, ncpus=N
     )
 
 
+def count_table_fname(outdir, prefix="motif"):
+    """Return the name of the count table in outdir.
+
+    Count tables are stored as sparse .npz file, see write_sparse_table().
+    A text table from an earlier version of maelstrom is used if it exists.
+    """
+    fname = os.path.join(outdir, "{}.count.txt.gz".format(prefix))
+    if os.path.exists(fname):
+        return fname
+    return os.path.join(outdir, "{}.count.npz".format(prefix))
+
+
+def group_mean(counts, labels):
+    """Return the mean of every column of counts per group.
+
+    This is the same as counts.groupby(labels).mean(), but counts can also
+    be a table with sparse columns.
+
+    Parameters
+    ----------
+    counts : pandas.DataFrame
+        Table with motif counts, with dense or sparse columns.
+
+    labels : pandas.Series
+        Group of every region. Regions without a group are skipped.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Mean counts, with the groups (sorted) as index.
+    """
+    labels = labels.reindex(counts.index)
+    keep = labels.notnull().values
+    groups, idx = np.unique(labels[keep].values, return_inverse=True)
+    onehot = csr_matrix(
+        (np.ones(len(idx)), (idx, np.arange(len(idx)))),
+        shape=(len(groups), len(idx)),
+    )
+    sums = onehot @ table_to_matrix(counts)[keep]
+    if issparse(sums):
+        sums = sums.toarray()
+    return pd.DataFrame(
+        sums / np.bincount(idx)[:, None],
+        index=pd.Index(groups, name=labels.name),
+        columns=counts.columns,
+    )
+
+
 def safe_join(df1, df2):
     tmp = df1.copy()
     tmp["_safe_count"] = list(range(df1.shape[0]))
@@ -186,11 +241,8 @@ def df_rank_aggregation(df, dfs, exps, method="int_stouffer"):
         pd.concat([v[col].rename(k, inplace=True) for k, v in dfs.items()], axis=1)
         for col in names
     ]
-    pool = Pool(16)
     func = partial(rankagg, method=method)
-    ret = pool.map(func, dfs)
-    pool.close()
-    pool.join()
+    ret = get_pool().map(func, dfs)
 
     for name, result in zip(names, ret):
         df_p[name] = result
@@ -335,9 +387,32 @@ def run_maelstrom(
         if os.path.exists(mapfile):
             shutil.copy2(mapfile, outdir)
 
+    # Scan only once if both the count and the score table are needed
+    if count_table is None and score_table is None:
+        count_table = count_table_fname(outdir)
+        score_table = os.path.join(outdir, "motif.score.txt.gz")
+        if not os.path.exists(count_table) and not os.path.exists(score_table):
+            logger.info("motif scanning (counts and scores)")
+            counts, scores = scan_regionfile_to_tables(
+                infile,
+                genome,
+                pfmfile=pfmfile,
+                ncpus=ncpus,
+                zscore=zscore,
+                gc=gc,
+                sparse=True,
+            )
+            write_sparse_table(counts, count_table)
+            scores.to_csv(
+                score_table, sep="\t", float_format="%.3f", compression="gzip"
+            )
+        else:
+            # At least one of the tables exists, create the missing one below
+            count_table = score_table = None
+
     # Create a file with the number of motif matches
     if count_table is None:
-        count_table = os.path.join(outdir, "motif.count.txt.gz")
+        count_table = count_table_fname(outdir)
         if not os.path.exists(count_table):
             logger.info("motif scanning (counts)")
             counts = scan_regionfile_to_table(
@@ -348,8 +423,9 @@ def run_maelstrom(
                 ncpus=ncpus,
                 zscore=zscore,
                 gc=gc,
+                sparse=True,
             )
-            counts.to_csv(count_table, sep="\t", compression="gzip")
+            write_sparse_table(counts, count_table)
         else:
             logger.info("Counts, using: %s", count_table)
 
@@ -373,7 +449,7 @@ def run_maelstrom(
         else:
             logger.info("Scores, using: %s", score_table)
 
-    counts = pd.read_csv(count_table, index_col=0, comment="#", sep="\t")
+    counts = read_motif_table(count_table)
     scores = pd.read_csv(score_table, index_col=0, comment="#", sep="\t")
 
     if filter_redundant:
@@ -406,8 +482,8 @@ def run_maelstrom(
         counts = counts[selected_motifs]
         score_table = os.path.join(outdir, "motif.nr.score.txt.gz")
         scores.to_csv(score_table, sep="\t", compression="gzip")
-        count_table = os.path.join(outdir, "motif.nr.count.txt.gz")
-        counts.to_csv(count_table, sep="\t", compression="gzip")
+        count_table = os.path.join(outdir, "motif.nr.count.npz")
+        write_sparse_table(counts, count_table)
 
         m2f = pd.read_table(os.path.join(outdir, mapfile), comment="#")
         m2f = m2f.join(motif_map, on="Motif")
@@ -515,7 +591,7 @@ def run_maelstrom(
         if df.shape[1] > 1:
             df_p["% with motif"] = (counts[df_p.index] > 0).sum(0) / df.shape[0] * 100
         else:
-            bla = counts.join(df).groupby(df.columns[0]).mean() * 100
+            bla = group_mean(counts, df.iloc[:, 0]) * 100
             bla = bla.T
             bla = bla.rename(
                 columns={col: f"{col} % with motif" for col in bla.columns}
@@ -536,9 +612,7 @@ def run_maelstrom(
     # Write motif frequency table
 
     if df.shape[1] == 1:
-        mcount = df.join(counts)
-        m_group = mcount.groupby(df.columns[0])
-        freq = m_group.sum() / m_group.count()
+        freq = group_mean(counts, df.iloc[:, 0])
         freq.to_csv(os.path.join(outdir, "motif.freq.txt"), sep="\t")
 
     if plot and len(methods) > 1:
@@ -611,9 +685,7 @@ class MaelstromResult:
         self.scores = pd.read_table(
             os.path.join(outdir, "motif.score.txt.gz"), index_col=0
         )
-        self.counts = pd.read_table(
-            os.path.join(outdir, "motif.count.txt.gz"), index_col=0
-        )
+        self.counts = read_motif_table(count_table_fname(outdir))
         fname = os.path.join(outdir, "motif.freq.txt")
         if os.path.exists(fname):
             self.freq = pd.read_table(fname, index_col=0)
@@ -26,6 +26,7 @@ import logging
 
 import pandas as pd
 import numpy as np
+from scipy.sparse import issparse
 from scipy.stats import hypergeom, mannwhitneyu
 from statsmodels.stats.multitest import multipletests
 from tqdm.auto import tqdm
@@ -46,7 +47,12 @@ from gimmemotifs import __version__
 from gimmemotifs.motif import read_motifs
 from gimmemotifs.scanner import scan_regionfile_to_table
 from gimmemotifs.config import MotifConfig
-from gimmemotifs.utils import pfmfile_location
+from gimmemotifs.utils import (
+    is_sparse_table,
+    pfmfile_location,
+    read_motif_table,
+    table_to_matrix,
+)
 
 import warnings
 
@@ -55,6 +61,48 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 logger = logging.getLogger("gimme.maelstrom")
 
 
+def column_quantile(X, q):
+    """Return the q-th quantile of every column, with linear interpolation.
+
+    Parameters
+    ----------
+    X : numpy.ndarray or scipy.sparse matrix
+        Matrix of values.
+
+    q : float
+        Quantile, between 0 and 1.
+
+    Returns
+    -------
+    numpy.ndarray
+        Quantile of every column.
+    """
+    if not issparse(X):
+        return np.quantile(X, q, axis=0)
+
+    X = X.tocsc()
+    n = X.shape[0]
+    pos = q * (n - 1)
+    lo, hi = int(np.floor(pos)), int(np.ceil(pos))
+    result = np.zeros(X.shape[1])
+    for j in range(X.shape[1]):
+        values = np.sort(X.data[X.indptr[j] : X.indptr[j + 1]])
+        # The column sorted is: negative values, the implicit zeros, the
+        # other values
+        nneg = np.searchsorted(values, 0)
+        nzero = n - len(values)
+
+        def value(k):
+            if k < nneg:
+                return values[k]
+            if k < nneg + nzero:
+                return 0
+            return values[k - nzero]
+
+        result[j] = value(lo) + (value(hi) - value(lo)) * (pos - lo)
+    return result
+
+
 class Moap(object):
     """Moap base class.
 
@@ -354,29 +402,29 @@ class HypergeomMoap(Moap):
         if df_y.shape[1] != 1:
             raise ValueError("y needs to have 1 label column")
 
-        if set(df_X.dtypes) != set([np.dtype(int)]):
+        # Counts can be a dense or a sparse table
+        X = table_to_matrix(df_X)
+        if not np.issubdtype(X.dtype, np.integer):
             raise ValueError("need motif counts, not scores")
+        has_motif = X > 0
+        total_true = np.asarray(has_motif.sum(0)).ravel()
 
         # calculate hypergeometric p-values
         pvals = []
+        labels = df_y.iloc[:, 0].values
         clusters = df_y[df_y.columns[0]].unique()
         M = df_X.shape[0]
         for cluster in clusters:
-            pos = df_X[df_y.iloc[:, 0] == cluster]
-            neg = df_X[df_y.iloc[:, 0] != cluster]
+            in_cluster = labels == cluster
 
-            pos_true = (pos > 0).sum(0)
-            pos_false = (pos == 0).sum(0)
-            neg_true = (neg > 0).sum(0)
+            pos_true = np.asarray(has_motif[in_cluster].sum(0)).ravel()
+            pos_false = in_cluster.sum() - pos_true
+            neg_true = total_true - pos_true
 
-            p = []
-            for pt, pf, nt in zip(pos_true, pos_false, neg_true):
-                n = pt + nt
-                N = pt + pf
-                x = pt - 1
-                p.append(hypergeom.sf(x, M, n, N))
-
-            pvals.append(p)
+            n = pos_true + neg_true
+            N = pos_true + pos_false
+            x = pos_true - 1
+            pvals.append(hypergeom.sf(x, M, n, N))
 
         # correct for multipe testing
         pvals = np.array(pvals)
@@ -425,22 +473,25 @@ class RFMoap(Moap):
         le = LabelEncoder()
         y = le.fit_transform(df_y.iloc[:, 0].values)
 
+        # Sparse count tables are used as CSR matrix
+        X = table_to_matrix(df_X)
+
         clf = RandomForestClassifier(n_estimators=100, n_jobs=self.ncpus)
 
         # Multiclass
         if len(le.classes_) > 2:
             orc = OneVsRestClassifier(clf)
-            orc.fit(df_X.values, y)
+            orc.fit(X, y)
 
             importances = np.array([c.feature_importances_ for c in orc.estimators_]).T
         else:  # Only two classes
-            clf.fit(df_X.values, y)
+            clf.fit(X, y)
             importances = np.array(
                 [clf.feature_importances_, clf.feature_importances_]
             ).T
 
         for i, _ in enumerate(le.classes_):
-            diff = df_X.loc[y == i].quantile(q=0.75) - df_X.loc[y != i].quantile(q=0.75)
+            diff = column_quantile(X[y == i], 0.75) - column_quantile(X[y != i], 0.75)
             sign = (diff >= 0) * 2 - 1
             importances[:, i] *= sign
 
@@ -660,12 +711,8 @@ def moap(
     if scoring and scoring not in ["score", "count"]:
         raise ValueError("valid values are 'score' and 'count'")
 
-    if inputfile.endswith("feather"):
-        df = pd.read_feather(inputfile)
-        df = df.set_index(df.columns[0])
-    else:
-        # read data
-        df = pd.read_table(inputfile, index_col=0, comment="#")
+    # read data
+    df = read_motif_table(inputfile)
 
     clf = Moap.create(method, ncpus=ncpus)
 
@@ -691,7 +738,7 @@ def moap(
         motif_names = [m.id for m in read_motifs(pfmfile)]
         scores = []
         if method == "classic" or scoring == "count":
-            logger.info("motif scanning (scores)")
+            logger.info("motif scanning (counts)")
             scores = scan_regionfile_to_table(
                 inputfile,
                 genome,
@@ -700,6 +747,7 @@ def moap(
                 ncpus=ncpus,
                 zscore=zscore,
                 gc=gc,
+                sparse=True,
             )
         else:
             logger.info("motif scanning (scores)")
@@ -717,7 +765,11 @@ def moap(
     elif isinstance(motiffile, pd.DataFrame):
         motifs = motiffile
     else:
-        motifs = pd.read_table(motiffile, index_col=0, comment="#")
+        motifs = read_motif_table(motiffile)
+
+    if is_sparse_table(motifs) and clf.ptype != "classification":
+        # Only the classification predictors support sparse count tables
+        motifs = motifs.sparse.to_dense()
 
     if outfile and os.path.exists(outfile):
         out = pd.read_table(outfile, index_col=0, comment="#")
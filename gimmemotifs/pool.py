@@ -0,0 +1,173 @@
+# Copyright (c) 2009-2021 Simon van Heeringen <simon.vanheeringen@gmail.com>
+#
+# This module is free software. You can redistribute it and/or modify it under
+# the terms of the MIT License, see the file COPYING included with this
+# distribution.
+""" Process-wide pool of worker processes.
+
+All parallel work in GimmeMotifs (scanning, motif statistics, motif
+comparison, de novo motif prediction) runs on the same pool, which is
+created on first use. This way the start-up cost of the worker processes
+is only paid once per process.
+"""
+import atexit
+import logging
+import multiprocessing as mp
+from collections import deque
+
+try:
+    from multiprocessing import resource_tracker
+except ImportError:
+    # Python < 3.8
+    resource_tracker = None
+
+from gimmemotifs.config import MotifConfig
+
+logger = logging.getLogger("gimme.pool")
+
+_pool = None
+_pool_size = 0
+
+
+def pool_available():
+    """Return True if this process can use a worker pool.
+
+    Worker processes are daemonic, and are not allowed to start a pool of
+    their own. Functions that run in a worker should do their work serially.
+    """
+    return not mp.current_process().daemon
+
+
+def get_pool(ncpus=None):
+    """Return the shared pool of worker processes.
+
+    The pool is created on first use. If more processes are requested than
+    the pool has, the pool is replaced by a larger one. Jobs that were
+    already submitted to the old pool will still finish.
+
+    Parameters
+    ----------
+    ncpus : int, optional
+        Number of worker processes. By default the ncpus value from the
+        configuration is used.
+
+    Returns
+    -------
+    pool : multiprocessing.pool.Pool
+    """
+    global _pool, _pool_size
+
+    if not pool_available():
+        raise RuntimeError("Worker processes cannot start a pool")
+
+    if ncpus is None:
+        ncpus = int(MotifConfig().get_default_params()["ncpus"])
+
+    if _pool is None or ncpus > _pool_size:
+        if _pool is not None:
+            logger.debug("Replacing pool of %s processes", _pool_size)
+            _pool.close()
+
+        if resource_tracker is not None:
+            # Start the resource tracker before the workers are forked, so
+            # they share it. Otherwise every worker starts its own tracker,
+            # which unlinks shared memory when the worker exits.
+            resource_tracker.ensure_running()
+
+        logger.debug("Starting pool of %s processes", ncpus)
+        _pool = mp.Pool(processes=ncpus, maxtasksperchild=1000)
+        _pool_size = ncpus
+
+    return _pool
+
+
+def shutdown_pool(wait=True):
+    """Shut down the shared pool of worker processes.
+
+    Parameters
+    ----------
+    wait : bool, optional
+        Wait for all submitted jobs to finish. Otherwise the workers are
+        terminated immediately.
+    """
+    global _pool, _pool_size
+
+    if _pool is None:
+        return
+
+    if wait:
+        _pool.close()
+        _pool.join()
+    else:
+        _pool.terminate()
+    _pool = None
+    _pool_size = 0
+
+
+def imap_ordered(func, jobs, pool=None, max_jobs=None, max_bytes=None, sizeof=None):
+    """Run func with every tuple of arguments in jobs, yield results in order.
+
+    Jobs are submitted to the pool while earlier results are consumed, so
+    all workers stay busy. The number of jobs in flight is limited, both in
+    number and in (estimated) memory, so a slow consumer does not cause
+    results to pile up. Without a pool the jobs are run serially.
+
+    Parameters
+    ----------
+    func : callable
+        Function to run, must be picklable.
+
+    jobs : iterable
+        Tuples of arguments for func. Consumed lazily.
+
+    pool : multiprocessing.pool.Pool, optional
+        Pool to run the jobs on. If None, jobs are run in this process.
+
+    max_jobs : int, optional
+        Maximum number of jobs in flight. By default two per worker process.
+
+    max_bytes : int, optional
+        Maximum estimated memory of the jobs in flight. At least one job is
+        always in flight.
+
+    sizeof : callable, optional
+        Function that returns the estimated memory of a job, in bytes, given
+        its arguments. Required for max_bytes.
+
+    Yields
+    ------
+    result
+        Return value of func, in the order of the jobs.
+    """
+    if pool is None:
+        for args in jobs:
+            yield func(*args)
+        return
+
+    if max_jobs is None:
+        max_jobs = 2 * pool._processes
+    max_jobs = max(1, max_jobs)
+    if max_bytes is not None and sizeof is None:
+        raise ValueError("sizeof is required to limit the memory of jobs in flight")
+
+    queue = deque()
+    in_flight = 0
+    for args in jobs:
+        nbytes = sizeof(args) if max_bytes is not None else 0
+        # Wait for the oldest job while the window is full. Later jobs keep
+        # running in the meantime.
+        while queue and (
+            len(queue) >= max_jobs
+            or (max_bytes is not None and in_flight + nbytes > max_bytes)
+        ):
+            job, job_bytes = queue.popleft()
+            in_flight -= job_bytes
+            yield job.get()
+        queue.append((pool.apply_async(func, args), nbytes))
+        in_flight += nbytes
+
+    while queue:
+        yield queue.popleft()[0].get()
+
+
+atexit.register(shutdown_pool, wait=False)
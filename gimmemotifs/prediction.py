@@ -15,12 +15,12 @@ except ImportError:
     import thread
 from time import sleep
 import inspect
-from multiprocessing import Pool
 
 # GimmeMotifs imports
 from gimmemotifs import tools as tool_classes
 from gimmemotifs.config import MotifConfig, parse_denovo_params
 from gimmemotifs.fasta import Fasta
+from gimmemotifs.pool import get_pool
 from gimmemotifs import mytmpdir
 from gimmemotifs.stats import calc_stats
 
@@ -97,7 +97,7 @@ class PredictionResult(object):
         if job_server:
             self.job_server = job_server
         else:
-            self.job_server = Pool(2)
+            self.job_server = get_pool()
         self.counter = 0
         self.do_counter = do_counter
 
@@ -249,7 +249,7 @@ def pp_predict_motifs(
 
     if not job_server:
         n_cpus = int(config.get_default_params()["ncpus"])
-        job_server = Pool(processes=n_cpus, maxtasksperchild=1000)
+        job_server = get_pool(n_cpus)
 
     jobs = {}
 
@@ -0,0 +1,175 @@
+# Copyright (c) 2009-2021 Simon van Heeringen <simon.vanheeringen@gmail.com>
+#
+# This module is free software. You can redistribute it and/or modify it under
+# the terms of the MIT License, see the file COPYING included with this
+# distribution.
+""" Module to calculate exact motif score thresholds.
+
+The null distribution of the score of a motif is calculated by dynamic
+programming on a discretised log-odds matrix, similar to TFM-Pvalue. The
+background is modelled as a 0th or 1st order Markov model. This is much
+faster than scanning a set of background sequences.
+"""
+import numpy as np
+import xxhash
+
+# Precision of the discretised scores.
+GRANULARITY = 0.001
+
+# Translation table to encode sequences as N=0, A=1, C=2, G=3, T=4.
+_NUC_TABLE = bytes(max("NACGT".find(chr(c).upper()), 0) for c in range(256))
+
+
+def background_composition(seqs, order=1, pseudo=1):
+    """Estimate a 0th or 1st order Markov background from sequences.
+
+    Parameters
+    ----------
+    seqs : list
+        List of sequences.
+
+    order : int, optional
+        Order of the Markov model, either 0 or 1.
+
+    pseudo : int, optional
+        Pseudocount that is added to the nucleotide counts.
+
+    Returns
+    -------
+    init : numpy.ndarray
+        Frequency of A, C, G and T.
+
+    trans : numpy.ndarray
+        4x4 array with the probability of each nucleotide (column) given
+        the previous nucleotide (row).
+    """
+    if order not in [0, 1]:
+        raise ValueError("Only a 0th or 1st order background is supported")
+
+    codes = np.frombuffer("N".join(seqs).encode().translate(_NUC_TABLE), np.uint8)
+    codes = codes.astype(np.int64)
+
+    counts = np.bincount(codes[codes > 0] - 1, minlength=4) + pseudo
+    init = counts / counts.sum()
+    if order == 0:
+        return init, np.tile(init, (4, 1))
+
+    valid = (codes[:-1] > 0) & (codes[1:] > 0)
+    pairs = (codes[:-1][valid] - 1) * 4 + codes[1:][valid] - 1
+    trans = np.bincount(pairs, minlength=16).reshape(4, 4) + pseudo
+    return init, trans / trans.sum(axis=1, keepdims=True)
+
+
+def composition_hash(composition):
+    """Return a hash of a background composition, to use as cache key."""
+    init, trans = composition
+    vals = ",".join("{:.4f}".format(x) for x in np.hstack((init, trans.flatten())))
+    return xxhash.xxh64(vals).hexdigest()
+
+
+def score_distribution(matrix, composition, granularity=GRANULARITY):
+    """Calculate the null distribution of the score of a motif.
+
+    Parameters
+    ----------
+    matrix : list
+        Log-odds matrix of the motif, as in Motif.logodds.
+
+    composition : tuple
+        Background model, as returned by background_composition().
+
+    granularity : float, optional
+        The scores are rounded to this precision.
+
+    Returns
+    -------
+    scores : numpy.ndarray
+        All possible (discretised) scores, in ascending order.
+
+    probs : numpy.ndarray
+        Probability of every score.
+    """
+    init, trans = composition
+    m = np.rint(np.array(matrix) / granularity).astype(np.int64)
+    offset = m.min(axis=1).sum()
+    m = m - m.min(axis=1, keepdims=True)
+    size = m.max(axis=1).sum() + 1
+
+    # dist[n, s] is the probability of score s for all words that end with n
+    dist = np.zeros((4, size))
+    for n in range(4):
+        dist[n, m[0, n]] = init[n]
+
+    max_score = m[0].max()
+    for row in m[1:]:
+        prev = dist[:, : max_score + 1]
+        dist = np.zeros((4, size))
+        for n in range(4):
+            dist[n, row[n] : row[n] + max_score + 1] = trans[:, n] @ prev
+        max_score += row.max()
+
+    scores = (np.arange(size) + offset) * granularity
+    return scores, dist.sum(axis=0)
+
+
+def pvalue_threshold(matrix, pvalue, composition, granularity=GRANULARITY):
+    """Return the lowest score cutoff with a p-value of at most `pvalue`.
+
+    Parameters
+    ----------
+    matrix : list
+        Log-odds matrix of the motif, as in Motif.logodds.
+
+    pvalue : float
+        P-value of a single motif match.
+
+    composition : tuple
+        Background model, as returned by background_composition().
+
+    granularity : float, optional
+        The scores are rounded to this precision.
+
+    Returns
+    -------
+    cutoff : float or None
+        Score cutoff, or None if even the best possible match has a
+        higher p-value.
+    """
+    scores, probs = score_distribution(matrix, composition, granularity)
+    # P(score >= s) for every score s
+    tail = np.cumsum(probs[::-1])[::-1]
+    idx = np.nonzero(tail <= pvalue)[0]
+    if len(idx) == 0:
+        return None
+    return scores[idx[0]]
+
+
+def fpr_to_pvalue(fpr, seqlen, motiflen, scan_rc=True):
+    """Convert a per-sequence FPR to a p-value for a single position.
+
+    The FPR in GimmeMotifs is the fraction of background sequences with a
+    match. Assuming independent positions, this is converted to the p-value
+    of a match at a single position.
+
+    Parameters
+    ----------
+    fpr : float
+        False positive rate per sequence.
+
+    seqlen : int
+        Length of the sequences.
+
+    motiflen : int
+        Length of the motif.
+
+    scan_rc : bool, optional
+        Whether the reverse complement is scanned as well.
+
+    Returns
+    -------
+    pvalue : float
+    """
+    npos = max(1, seqlen - motiflen + 1)
+    if scan_rc:
+        npos *= 2
+    return 1 - (1 - fpr) ** (1 / npos)
@@ -7,7 +7,6 @@
 import os
 import sys
 from datetime import datetime
-from multiprocessing import Pool
 import re
 import shutil
 import logging
@@ -35,6 +34,7 @@ from gimmemotifs.fasta import Fasta
 from gimmemotifs.motif import read_motifs
 from gimmemotifs.config import MotifConfig
 from gimmemotifs.plot import roc_plot
+from gimmemotifs.pool import get_pool
 from gimmemotifs.stats import calc_stats, add_star, write_stats
 from gimmemotifs import __version__
 from gimmemotifs.utils import motif_localization
@@ -609,7 +609,7 @@ def create_roc_plots(pfmfile, fgfa, background, outdir, genome):
     """Make ROC plots for all motifs."""
     motifs = read_motifs(pfmfile, fmt="pwm", as_dict=True)
     ncpus = int(MotifConfig().get_default_params()["ncpus"])
-    pool = Pool(processes=ncpus)
+    pool = get_pool(ncpus)
     jobs = {}
     for bg, fname in background.items():
         for m_id, m in motifs.items():
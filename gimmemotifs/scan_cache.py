@@ -0,0 +1,321 @@
+# Copyright (c) 2009-2021 Simon van Heeringen <simon.vanheeringen@gmail.com>
+#
+# This module is free software. You can redistribute it and/or modify it under
+# the terms of the MIT License, see the file COPYING included with this
+# distribution.
+""" On-disk cache of motif scan results per sequence.
+
+The best score and the number of matches of a motif in a sequence are stored
+under the hash of the sequence and a key per motif. The key combines
+Motif.hash() with the scan settings, and for counts the cutoff and nreport.
+Results are therefore reused for overlapping sets of regions and for other
+motif databases that share motifs, and only the remaining sequences and
+motifs are scanned.
+
+Every scan of missing results is stored as one chunk: an .npz file with the
+sorted sequence hashes, the keys of all motifs that were scanned, and a matrix
+of values per output (counts and scores). The keys and sequence hashes of the
+chunks are kept in an index in memory, so a lookup only opens the chunks that
+contain results of the sequences and keys, and chunks are only read into the
+index once per process. Chunks that were least recently used are removed when
+a new chunk makes the cache larger than its maximum size.
+
+The cache is not used by default, see Scanner.set_scan_cache().
+"""
+import logging
+import os
+import zipfile
+from tempfile import mkstemp
+
+import numpy as np
+import xxhash
+
+from gimmemotifs.config import CACHE_DIR
+
+logger = logging.getLogger("gimme.scan_cache")
+
+# Default maximum size of the cache in bytes
+MAX_SIZE = 2 ** 30
+
+
+def seq_hashes(encoded, seq_offsets):
+    """Return the hash of every encoded sequence.
+
+    Parameters
+    ----------
+    encoded, seq_offsets
+        Encoded sequences, as returned by encode_seqs().
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of uint64 hashes.
+    """
+    return np.array(
+        [
+            xxhash.xxh64_intdigest(encoded[start:end].tobytes())
+            for start, end in zip(seq_offsets[:-1], seq_offsets[1:])
+        ],
+        dtype=np.uint64,
+    )
+
+
+def score_key(motif, scan_rc):
+    """Return the cache key of the best scores of a motif."""
+    return xxhash.xxh64("score|{}|{}".format(motif.hash(), int(scan_rc))).hexdigest()
+
+
+def count_key(motif, cutoff, nreport, scan_rc):
+    """Return the cache key of the number of matches of a motif."""
+    return xxhash.xxh64(
+        "count|{}|{!r}|{}|{}".format(motif.hash(), float(cutoff), nreport, int(scan_rc))
+    ).hexdigest()
+
+
+class ScanCache(object):
+    """Cache of scan results per sequence and motif, see the module docs.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Directory of the cache, by default a subdirectory of the GimmeMotifs
+        cache directory.
+
+    max_size : int, optional
+        Maximum size of the cache in bytes.
+    """
+
+    def __init__(self, cache_dir=None, max_size=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(CACHE_DIR, "scan")
+        self.cache_dir = cache_dir
+        self.max_size = MAX_SIZE if max_size is None else max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Index of the chunks by file name: sequence hashes, the output and
+        # column of every key, and the file size
+        self._index = {}
+
+    def _update_index(self):
+        """Add the chunks of other processes to the index, and remove the
+        chunks that were evicted."""
+        names = {e.name for e in os.scandir(self.cache_dir) if e.name.endswith(".npz")}
+        for name in set(self._index) - names:
+            del self._index[name]
+        for name in names - set(self._index):
+            try:
+                size = os.path.getsize(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            chunk = self._read_chunk(name, ["seq_hash", "keys", "output"])
+            if chunk is not None:
+                self._add_index(name, chunk, size)
+
+    def _add_index(self, name, chunk, size):
+        seq_hash, keys, output = chunk
+        columns = np.zeros(len(output), dtype=np.int64)
+        for o in np.unique(output):
+            columns[output == o] = np.arange(np.sum(output == o))
+        self._index[name] = (
+            seq_hash,
+            dict(zip(keys.tolist(), zip(output.tolist(), columns.tolist()))),
+            size,
+        )
+
+    def _read_chunk(self, name, arrays):
+        """Return arrays of a chunk, None if it is gone."""
+        try:
+            with np.load(os.path.join(self.cache_dir, name)) as f:
+                return [f[a] for a in arrays]
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # Removed by another process
+            return None
+
+    def get(self, keys, hashes, dtypes):
+        """Return the cached values of sequences.
+
+        Parameters
+        ----------
+        keys : list
+            For every output, a list with the cache key of every motif, see
+            score_key() and count_key().
+
+        hashes : numpy.ndarray
+            Sequence hashes, see seq_hashes().
+
+        dtypes : list
+            For every output, the data type.
+
+        Returns
+        -------
+        found : numpy.ndarray
+            Boolean matrix of nseqs x nmotifs, True if the values of all
+            outputs are in the cache.
+
+        values : list
+            For every output, a matrix of nseqs x nmotifs with the cached
+            values, 0 if they are not in the cache.
+        """
+        self._update_index()
+        nmotifs = len(keys[0])
+        found = [np.zeros((len(hashes), nmotifs), dtype=bool) for _ in keys]
+        values = [np.zeros((len(hashes), nmotifs), dtype=dtype) for dtype in dtypes]
+        for name, (chunk_hashes, chunk_keys, _) in list(self._index.items()):
+            if len(chunk_hashes) == 0:
+                continue
+            idx = np.minimum(
+                np.searchsorted(chunk_hashes, hashes), len(chunk_hashes) - 1
+            )
+            rows = np.flatnonzero(chunk_hashes[idx] == hashes)
+            if len(rows) == 0:
+                continue
+            # Output and column in the chunk of every key that it contains
+            columns = [
+                [
+                    (j, chunk_keys[key])
+                    for j, key in enumerate(out_keys)
+                    if key in chunk_keys
+                ]
+                for out_keys in keys
+            ]
+            if not any(columns):
+                continue
+            outputs = sorted({o for cols in columns for _, (o, _) in cols})
+            chunk = self._read_chunk(name, ["value{}".format(o) for o in outputs])
+            if chunk is None:
+                continue
+            chunk = dict(zip(outputs, chunk))
+            for out_found, out, cols in zip(found, values, columns):
+                for o in outputs:
+                    j = [j for j, (co, _) in cols if co == o]
+                    if len(j) == 0:
+                        continue
+                    c = [c for _, (co, c) in cols if co == o]
+                    out[np.ix_(rows, j)] = chunk[o][np.ix_(idx[rows], c)]
+                    out_found[np.ix_(rows, j)] = True
+            self._touch(name)
+        return np.logical_and.reduce(found), values
+
+    def set(self, keys, hashes, values):
+        """Store the values of sequences as one chunk.
+
+        If the cache is then larger than its maximum size, the least recently
+        used chunks are removed, see evict().
+
+        Parameters
+        ----------
+        keys : list
+            For every output, a list with the cache key of every motif, see
+            score_key() and count_key().
+
+        hashes : numpy.ndarray
+            Sequence hashes, see seq_hashes().
+
+        values : list
+            For every output, a matrix of nseqs x nmotifs.
+        """
+        if len(hashes) == 0:
+            return
+        hashes, idx = np.unique(hashes, return_index=True)
+        arrays = {
+            "seq_hash": hashes,
+            "keys": np.array([key for out_keys in keys for key in out_keys]),
+            "output": np.repeat(np.arange(len(keys)), [len(k) for k in keys]),
+        }
+        for o, out in enumerate(values):
+            arrays["value{}".format(o)] = np.asarray(out)[idx]
+
+        fd, tmp = mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        name = os.path.basename(tmp)[: -len(".tmp")] + ".npz"
+        fname = os.path.join(self.cache_dir, name)
+        os.replace(tmp, fname)
+        chunk = [arrays[a] for a in ["seq_hash", "keys", "output"]]
+        self._add_index(name, chunk, os.path.getsize(fname))
+
+        # Chunks of other processes also count
+        self._update_index()
+        if self.size() > self.max_size:
+            self.evict()
+
+    def _touch(self, name):
+        try:
+            os.utime(os.path.join(self.cache_dir, name))
+        except FileNotFoundError:
+            pass
+
+    def size(self):
+        """Return the total size of the chunks in the index in bytes."""
+        return sum(size for _, _, size in self._index.values())
+
+    def evict(self):
+        """Remove the least recently used chunks until the cache fits."""
+        chunks = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".npz"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            chunks.append((stat.st_mtime, entry.name, stat.st_size))
+        chunks.sort()
+        total = sum(size for _, _, size in chunks)
+        for _, name, size in chunks:
+            if total <= self.max_size:
+                break
+            logger.debug("evicting %s from scan cache", name)
+            try:
+                os.unlink(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            self._index.pop(name, None)
+            total -= size
+
+    def lookup(self, hashes, keys, dtypes, scan):
+        """Return cached results, scan the sequences and motifs that are missing.
+
+        All sequences with a missing result are scanned with all motifs with
+        a missing result. The new results are added to the cache as one chunk.
+
+        Parameters
+        ----------
+        hashes : numpy.ndarray
+            Sequence hashes, see seq_hashes().
+
+        keys : list
+            For every output, a list with the cache key of every motif.
+
+        dtypes : list
+            For every output, the data type.
+
+        scan : callable
+            Function that is called with the indices of the sequences and the
+            motifs that are missing, and returns a list of matrices of
+            nseqs x nmotifs, one for every output.
+
+        Returns
+        -------
+        list
+            For every output, a matrix of nseqs x nmotifs.
+        """
+        found, results = self.get(keys, hashes, dtypes)
+        seq_idx = np.flatnonzero(~found.all(1))
+        motif_idx = np.flatnonzero(~found.all(0))
+        if len(seq_idx) == 0:
+            return results
+
+        logger.debug(
+            "scan cache: scanning %s sequences with %s motifs",
+            len(seq_idx),
+            len(motif_idx),
+        )
+        new = scan(seq_idx, motif_idx)
+        for out, rows in zip(results, new):
+            out[np.ix_(seq_idx, motif_idx)] = rows
+        self.set(
+            [[out_keys[j] for j in motif_idx] for out_keys in keys],
+            hashes[seq_idx],
+            new,
+        )
+        return results
@@ -1,36 +1,68 @@
+import atexit
+import inspect
 import os
 import re
 import sys
-import time
-import math
-from collections import Counter
+import weakref
 from functools import partial
-from tempfile import mkdtemp, NamedTemporaryFile
+from itertools import chain
+from tempfile import mkstemp, NamedTemporaryFile
 import logging
-import multiprocessing as mp
+from collections import OrderedDict
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
 
-# "hidden" features, in development
 try:
     import MOODS.tools
-    import MOODS.parsers
     import MOODS.scan
 except ImportError:
-    pass
+    MOODS = None
 
 from genomepy import Genome
-from diskcache import Cache
 import numpy as np
-from sklearn.preprocessing import scale
+import pysam
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scipy.sparse import csr_matrix, vstack
 import sqlite3
 
-from gimmemotifs import __version__
+from gimmemotifs import __version__, mytmpdir
 from gimmemotifs.background import RandomGenomicFasta, gc_bin_bedfile
+from gimmemotifs.cache import get_cache
 from gimmemotifs.config import MotifConfig, CACHE_DIR
 from gimmemotifs.fasta import Fasta
-from gimmemotifs.c_metrics import pwmscan
+from gimmemotifs.genome_cache import SEQ_ENCODING, get_genome_cache, is_region_list
+from gimmemotifs.c_metrics import (
+    pwmscan,
+    pwmscan_batch,
+    pwmscan_batch_zscore,
+    pwmscan_best,
+    pwmscan_count,
+    pwmscan_count_best,
+    pwmscan_kmer,
+    simd_level,
+)
 from gimmemotifs.motif import read_motifs
-from gimmemotifs.utils import parse_cutoff, as_fasta, file_checksum, rc
+from gimmemotifs.pool import get_pool, imap_ordered, pool_available
+from gimmemotifs.scan_cache import ScanCache, count_key, score_key, seq_hashes
+from gimmemotifs.pvalue import (
+    background_composition,
+    composition_hash,
+    fpr_to_pvalue,
+    pvalue_threshold,
+)
+from gimmemotifs.utils import (
+    parse_cutoff,
+    as_fasta,
+    as_fasta_batches,
+    count_dtype,
+    file_checksum,
+)
 
 
 try:
@@ -47,17 +79,46 @@ try:
 except Exception:
     pass
 
-# only used when using cache, should not be a requirement
-try:
-    from dogpile.cache import make_region
-    import xxhash
-except ImportError:
-    pass
-
 logger = logging.getLogger("gimme.scanner")
 config = MotifConfig()
 FPR = 0.01
-lock = mp.Lock()
+
+# Maximum number of hits (sequences x motifs x nreport) that the batch kernel
+# fills in one call. Larger chunks are split to keep memory usage bounded.
+BATCH_MAX_HITS = 2 ** 22
+
+# Number of jobs that can be in flight per worker process, and the maximum
+# estimated memory of their results. See Scanner._run_jobs().
+JOBS_PER_CPU = 4
+MAX_INFLIGHT_BYTES = 2 ** 30
+
+# Size of the chunks that are scanned when scanning a complete genome.
+GENOME_CHUNK_SIZE = 1000000
+
+# Number of sequences that are counted at once for a sparse count matrix.
+# Only the counts of one batch are stored as a dense matrix.
+SPARSE_BATCH_SIZE = 10000
+
+# Number of sequences that the matrix methods of Scanner read, encode and
+# scan at once, see Scanner._input_batches(). Only the encoded sequences of
+# one batch are in memory.
+INPUT_BATCH_SIZE = 50000
+
+# Number of lines of a region table that are read at once.
+TABLE_CHUNK_SIZE = 100000
+
+# Shared memory arrays that a worker process is attached to, see _attach_array().
+_attached = OrderedDict()
+MAX_ATTACHED = 16
+
+# Scanners with motifs in shared memory, these are released at exit.
+_sharing_scanners = weakref.WeakSet()
+
+
+@atexit.register
+def _release_all_shared_motifs():
+    for s in list(_sharing_scanners):
+        s._release_shared_motifs()
 
 
 def print_cluster_error_message():
@@ -72,13 +133,53 @@ def print_cluster_error_message():
     )
 
 
+# Sequence ids in chrom:start-end format, for BED output
+seq_id_p = re.compile(r"([^\s:]+):(\d+)-(\d+)")
+STRANDMAP = {-1: "-", 1: "+"}
+
+# Output formats of scan_to_file()
+SCAN_FORMATS = ["text", "arrow", "parquet"]
+
+# Scanning kernels, see Scanner.set_kernel(). Kernels are selected in the
+# scan functions with the keyword argument in KERNEL_ARGS, see
+# kernel_kwargs(). Functions without this argument use the default kernel.
+KERNELS = ["default", "superalphabet", "simd", "moods"]
+KERNEL_ARGS = {"simd": "simd", "moods": "moods"}
+
+# Super-alphabet scoring, see kmer_tensor(). Every table covers KMER_SIZE
+# motif positions. The default kernel uses it for count and best score
+# matrices when there are at least KMER_MIN_MOTIFS motifs with an average
+# length of at least KMER_MIN_LENGTH.
+KMER_SIZE = 4
+KMER_MIN_MOTIFS = 10
+KMER_MIN_LENGTH = 8
+
+# Kernels that are not faster than the super-alphabet tables. These use the
+# tables for count and best score matrices when the default kernel would.
+KMER_FIRST_KERNELS = ["simd"]
+
+# Maximum size of the super-alphabet tables that are kept per process.
+KMER_CACHE_BYTES = 2 ** 28
+_kmer_tables = OrderedDict()
+
+# MOODS kernel, see scan_moods_encoded(). Scanners are kept per process for
+# the MAX_MOODS_SCANNERS most recently used motif collections.
+MOODS_WINDOW = 7
+# Motifs with a cutoff below this fraction of the score range have too many
+# hits for MOODS, and are scanned with the native kernel, see _moods_blocks()
+MOODS_MIN_CUTOFF = 0.8
+MOODS_DECODING = np.frombuffer(b"NACGT", dtype=np.uint8)
+MAX_MOODS_SCANNERS = 4
+_moods_scanners = OrderedDict()
+
+
 def _format_line(
     seq, seq_id, motif, score, pos, strand, bed=False, seq_p=None, strandmap=None
 ):
     if seq_p is None:
-        seq_p = re.compile(r"([^\s:]+):(\d+)-(\d+)")
+        seq_p = seq_id_p
     if strandmap is None:
-        strandmap = {-1: "-", 1: "+"}
+        strandmap = STRANDMAP
     if bed:
         m = seq_p.search(seq_id)
         if m:
@@ -111,8 +212,77 @@ def _format_line(
         )
 
 
+def _regionfile_scanner(input_table, genome, pfmfile=None, ncpus=None, gc=True):
+    """Return the regions, index, motif names and a Scanner for an input table.
+
+    Only the first column of the table, with the regions, is read. See
+    scan_regionfile_to_table() for the parameters.
+    """
+    config = MotifConfig()
+
+    if pfmfile is None:
+        pfmfile = config.get_default_params().get("motif_db", None)
+        if pfmfile is not None:
+            pfmfile = os.path.join(config.get_motif_dir(), pfmfile)
+
+    if pfmfile is None:
+        raise ValueError("no pfmfile given and no default database specified")
+
+    logger.info("reading table")
+    if input_table.endswith("feather"):
+        # Only the column with the regions is read
+        idx = pd.read_feather(input_table, columns=[0]).iloc[:, 0].values
+    else:
+        chunks = pd.read_table(
+            input_table,
+            index_col=0,
+            usecols=[0],
+            comment="#",
+            chunksize=TABLE_CHUNK_SIZE,
+        )
+        idx = pd.concat(chunks).index
+
+    regions = np.asarray(idx)
+    if len(regions) >= 1000:
+        check_regions = np.random.choice(regions, size=1000, replace=False)
+    else:
+        check_regions = regions
+
+    size = int(
+        np.median([len(seq) for seq in as_fasta(check_regions, genome=genome).seqs])
+    )
+    s = Scanner(ncpus=ncpus)
+    s.set_motifs(pfmfile)
+    s.set_genome(genome)
+    s.set_background(genome=genome, gc=gc, size=size)
+
+    motif_names = [m.id for m in read_motifs(pfmfile)]
+    return regions, idx, motif_names, s
+
+
+def _count_table(counts, idx, motif_names):
+    """Return a DataFrame of a dense or sparse count matrix."""
+    if isinstance(counts, csr_matrix):
+        return pd.DataFrame.sparse.from_spmatrix(counts, index=idx, columns=motif_names)
+    return pd.DataFrame(counts, index=idx, columns=motif_names)
+
+
+def _score_type(zscore, gc):
+    """Return a description of the scores, for logging."""
+    if zscore:
+        return "(z-score, GC%)" if gc else "(z-score)"
+    return "(logodds)"
+
+
 def scan_regionfile_to_table(
-    input_table, genome, scoring, pfmfile=None, ncpus=None, zscore=True, gc=True
+    input_table,
+    genome,
+    scoring,
+    pfmfile=None,
+    ncpus=None,
+    zscore=True,
+    gc=True,
+    sparse=False,
 ):
     """Scan regions in input table with motifs.
 
@@ -135,172 +305,157 @@ def scan_regionfile_to_table(
     ncpus : int, optional
         If defined this specifies the number of cores to use.
 
+    sparse : bool, optional
+        Return counts as a DataFrame with sparse unsigned integer columns,
+        see Scanner.count_matrix(). Only used for "count" scoring.
+
     Returns
     -------
     table : pandas.DataFrame
         DataFrame with motif ids as column names and regions as index. Values
         are either counts or scores depending on the 'scoring' parameter.s
     """
-    config = MotifConfig()
-
-    if pfmfile is None:
-        pfmfile = config.get_default_params().get("motif_db", None)
-        if pfmfile is not None:
-            pfmfile = os.path.join(config.get_motif_dir(), pfmfile)
-
-    if pfmfile is None:
-        raise ValueError("no pfmfile given and no default database specified")
-
-    logger.info("reading table")
-    if input_table.endswith("feather"):
-        df = pd.read_feather(input_table)
-        idx = df.iloc[:, 0].values
-    else:
-        df = pd.read_table(input_table, index_col=0, comment="#")
-        idx = df.index
-
-    regions = list(idx)
-    if len(regions) >= 1000:
-        check_regions = np.random.choice(regions, size=1000, replace=False)
-    else:
-        check_regions = regions
-
-    size = int(
-        np.median([len(seq) for seq in as_fasta(check_regions, genome=genome).seqs])
+    regions, idx, motif_names, s = _regionfile_scanner(
+        input_table, genome, pfmfile, ncpus, gc
     )
-    s = Scanner(ncpus=ncpus)
-    s.set_motifs(pfmfile)
-    s.set_genome(genome)
-    s.set_background(genome=genome, gc=gc, size=size)
 
-    scores = []
     if scoring == "count":
         logger.info("setting threshold")
         s.set_threshold(fpr=FPR)
         logger.info("creating count table")
-        for row in s.count(regions):
-            scores.append(row)
+        counts = s.count_matrix(regions, sparse=sparse)
         logger.info("done")
+
+        return _count_table(counts, idx, motif_names)
     else:
-        s.set_threshold(threshold=0.0)
-        msg = "creating score table"
-        if zscore:
-            msg += " (z-score"
-            if gc:
-                msg += ", GC%"
-            msg += ")"
-        else:
-            msg += " (logodds)"
-        logger.info(msg)
-        for row in s.best_score(regions, zscore=zscore, gc=gc):
-            scores.append(row)
+        logger.info("creating score table %s", _score_type(zscore, gc))
+        scores = s.best_score_matrix(regions, zscore=zscore, gc=gc, dtype=np.float16)
         logger.info("done")
 
-    motif_names = [m.id for m in read_motifs(pfmfile)]
+        # The DataFrame wraps the score matrix, it is not copied
+        return pd.DataFrame(scores, index=idx, columns=motif_names)
 
-    logger.info("creating dataframe")
-    dtype = "float16"
-    if scoring == "count":
-        dtype = int
-    df = pd.DataFrame(scores, index=idx, columns=motif_names, dtype=dtype)
 
-    return df
+def scan_regionfile_to_tables(
+    input_table,
+    genome,
+    pfmfile=None,
+    ncpus=None,
+    zscore=True,
+    gc=True,
+    sparse=False,
+):
+    """Scan regions in input table with motifs, return counts and scores.
 
+    This gives the same tables as scan_regionfile_to_table() with "count"
+    and "score" scoring, but the regions are scanned only once.
 
-def scan_table(
-    s, inputfile, fa, motifs, cutoff, bgfile, nreport, scan_rc, pvalue, moods
-):
+    Parameters
+    ----------
+    input_table : str
+        Filename of input table. Can be either a text-separated tab file or a
+        feather file.
+
+    genome : str
+        Genome name. Can be either the name of a FASTA-formatted file or a
+        genomepy genome name.
+
+    pfmfile : str, optional
+        Specify a PFM file for scanning.
+
+    ncpus : int, optional
+        If defined this specifies the number of cores to use.
+
+    sparse : bool, optional
+        Return counts as a DataFrame with sparse unsigned integer columns,
+        see Scanner.count_matrix().
+
+    Returns
+    -------
+    counts : pandas.DataFrame
+        DataFrame with motif ids as column names and regions as index, with
+        the number of matches.
+
+    scores : pandas.DataFrame
+        DataFrame with motif ids as column names and regions as index, with
+        the best motif score.
+    """
+    regions, idx, motif_names, s = _regionfile_scanner(
+        input_table, genome, pfmfile, ncpus, gc
+    )
+
+    logger.info("setting threshold")
+    s.set_threshold(fpr=FPR)
+    logger.info("creating count and score table %s", _score_type(zscore, gc))
+    counts, scores = s.count_and_best_score(
+        regions, zscore=zscore, gc=gc, dtype=np.float16, sparse=sparse
+    )
+    logger.info("done")
+
+    return (
+        _count_table(counts, idx, motif_names),
+        pd.DataFrame(scores, index=idx, columns=motif_names),
+    )
+
+
+def scan_table(s, batches, motifs, nreport, scan_rc):
     # header
     yield "\t{}".format("\t".join([m.id for m in motifs]))
-    table = True
-    if moods:
-        result_it = scan_it_moods(
-            inputfile, motifs, cutoff, bgfile, nreport, scan_rc, pvalue, table
-        )
-        for seq_id, counts in result_it:
-            yield "{}\t{}".format(seq_id, "\t".join([str(x) for x in counts]))
-    else:
-        # get iterator
-        result_it = s.count(fa, nreport, scan_rc)
-        # counts table
-        for i, counts in enumerate(result_it):
-            yield "{}\t{}".format(fa.ids[i], "\t".join([str(x) for x in counts]))
+    # counts table
+    for fa in batches:
+        counts = s.count_matrix(fa, nreport, scan_rc)
+        for seq_id, row in zip(fa.ids, counts.tolist()):
+            yield "{}\t{}".format(seq_id, "\t".join([str(x) for x in row]))
 
 
-def scan_score_table(s, fa, motifs, scan_rc, zscore=False, gcnorm=False):
+def scan_score_table(s, batches, motifs, scan_rc, zscore=False, gcnorm=False):
 
     s.set_threshold(threshold=0.0, gc=gcnorm)
-    # get iterator
-    result_it = s.best_score(fa, scan_rc, zscore=zscore, gc=gcnorm)
     # header
     yield "\t{}".format("\t".join([m.id for m in motifs]))
     # score table
-    for i, scores in enumerate(result_it):
-        yield "{}\t{}".format(fa.ids[i], "\t".join(["{:4f}".format(x) for x in scores]))
-
+    for fa in batches:
+        result_it = s.best_score(fa, scan_rc, zscore=zscore, gc=gcnorm)
+        for seq_id, scores in zip(fa.ids, result_it):
+            yield "{}\t{}".format(
+                seq_id, "\t".join(["{:4f}".format(x) for x in scores])
+            )
 
-def scan_normal(
-    s,
-    inputfile,
-    fa,
-    motifs,
-    cutoff,
-    bgfile,
-    nreport,
-    scan_rc,
-    pvalue,
-    moods,
-    bed,
-    zscore,
-    gcnorm,
-):
 
-    table = False
-    if moods:
-        result_it = scan_it_moods(
-            inputfile, motifs, cutoff, bgfile, nreport, scan_rc, pvalue, table
-        )
-        for motif, d in result_it:
-            for seq_id, matches in d.items():
-                for pos, score, strand in matches:
-                    yield _format_line(
-                        fa[seq_id], seq_id, motif, score, pos, strand, bed=bed
-                    )
-    else:
+def scan_normal(s, batches, motifs, nreport, scan_rc, bed, zscore, gcnorm):
+    for fa in batches:
         result_it = s.scan(fa, nreport, scan_rc, zscore, gc=gcnorm)
-        for i, result in enumerate(result_it):
-            seq_id = fa.ids[i]
-            seq = fa[seq_id]
+        for seq_id, seq, result in zip(fa.ids, fa.seqs, result_it):
             for motif, matches in zip(motifs, result):
                 for (score, pos, strand) in matches:
                     yield _format_line(seq, seq_id, motif, score, pos, strand, bed=bed)
 
 
-def command_scan(
+def _scan_setup(
     inputfile,
     pfmfile,
-    nreport=1,
     fpr=0.01,
     cutoff=None,
-    bed=False,
-    scan_rc=True,
-    table=False,
     score_table=False,
-    moods=False,
-    pvalue=None,
     bgfile=None,
     genome=None,
     ncpus=None,
-    zscore=False,
     gcnorm=False,
+    kernel="default",
 ):
+    """Return the Scanner, the motifs and the Fasta batches to scan."""
     motifs = read_motifs(pfmfile)
 
-    fa = as_fasta(inputfile, genome)
+    # Read the input in batches, it does not have to fit in memory
+    batches = as_fasta_batches(inputfile, genome)
+    # The background size is based on the first batch of sequences
+    fa = next(batches, Fasta())
+    batches = chain([fa], batches)
 
     # initialize scanner
     s = Scanner(ncpus=ncpus)
     s.set_motifs(pfmfile)
+    s.set_kernel(kernel)
 
     if genome:
         s.set_genome(genome=genome)
@@ -315,33 +470,183 @@ def command_scan(
     if not score_table:
         s.set_threshold(fpr=fpr, threshold=cutoff)
 
+    return s, motifs, batches
+
+
+def command_scan(
+    inputfile,
+    pfmfile,
+    nreport=1,
+    fpr=0.01,
+    cutoff=None,
+    bed=False,
+    scan_rc=True,
+    table=False,
+    score_table=False,
+    bgfile=None,
+    genome=None,
+    ncpus=None,
+    zscore=False,
+    gcnorm=False,
+    kernel="default",
+):
+    s, motifs, batches = _scan_setup(
+        inputfile,
+        pfmfile,
+        fpr=fpr,
+        cutoff=cutoff,
+        score_table=score_table,
+        bgfile=bgfile,
+        genome=genome,
+        ncpus=ncpus,
+        gcnorm=gcnorm,
+        kernel=kernel,
+    )
+
     if table:
-        it = scan_table(
-            s, inputfile, fa, motifs, cutoff, bgfile, nreport, scan_rc, pvalue, moods
-        )
+        it = scan_table(s, batches, motifs, nreport, scan_rc)
     elif score_table:
-        it = scan_score_table(s, fa, motifs, scan_rc, zscore=zscore, gcnorm=gcnorm)
+        it = scan_score_table(s, batches, motifs, scan_rc, zscore=zscore, gcnorm=gcnorm)
     else:
         it = scan_normal(
-            s,
-            inputfile,
-            fa,
-            motifs,
-            cutoff,
-            bgfile,
-            nreport,
-            scan_rc,
-            pvalue,
-            moods,
-            bed,
-            zscore=zscore,
-            gcnorm=gcnorm,
+            s, batches, motifs, nreport, scan_rc, bed, zscore=zscore, gcnorm=gcnorm
         )
 
     for row in it:
         yield row
 
 
+def _hit_schema():
+    return pa.schema(
+        [
+            ("region", pa.string()),
+            ("motif", pa.dictionary(pa.int32(), pa.string())),
+            ("pos", pa.int32()),
+            ("score", pa.float32()),
+            ("strand", pa.dictionary(pa.int8(), pa.string())),
+        ]
+    )
+
+
+def _table_schema(motif_ids, dtype):
+    return pa.schema([("region", pa.string())] + [(m, dtype) for m in motif_ids])
+
+
+def command_scan_columnar(
+    inputfile,
+    pfmfile,
+    nreport=1,
+    fpr=0.01,
+    cutoff=None,
+    scan_rc=True,
+    table=False,
+    score_table=False,
+    bgfile=None,
+    genome=None,
+    ncpus=None,
+    zscore=False,
+    gcnorm=False,
+    kernel="default",
+):
+    """Scan an inputfile with motifs, yield the results as Arrow record batches.
+
+    The arguments are the same as for command_scan(). The first value that is
+    yielded is the schema, followed by one record batch per batch of input
+    sequences.
+
+    Hits have the columns region, motif, pos (0-based position in the
+    region), score and strand. The motif and strand columns are dictionary
+    encoded. Tables have a region column followed by one column per motif,
+    with int32 counts or float32 scores.
+
+    Yields
+    ------
+    pyarrow.Schema, followed by pyarrow.RecordBatch
+    """
+    s, motifs, batches = _scan_setup(
+        inputfile,
+        pfmfile,
+        fpr=fpr,
+        cutoff=cutoff,
+        score_table=score_table,
+        bgfile=bgfile,
+        genome=genome,
+        ncpus=ncpus,
+        gcnorm=gcnorm,
+        kernel=kernel,
+    )
+    motif_ids = pa.array([m.id for m in motifs], type=pa.string())
+    strands = pa.array(["-", "+"], type=pa.string())
+
+    if table:
+        schema = _table_schema(motif_ids.to_pylist(), pa.int32())
+        yield schema
+        for fa in batches:
+            counts = s.count_matrix(fa, nreport, scan_rc).T.astype(np.int32)
+            yield pa.RecordBatch.from_arrays(
+                [pa.array(fa.ids, type=pa.string())] + [pa.array(c) for c in counts],
+                schema=schema,
+            )
+    elif score_table:
+        schema = _table_schema(motif_ids.to_pylist(), pa.float32())
+        yield schema
+        s.set_threshold(threshold=0.0, gc=gcnorm)
+        for fa in batches:
+            scores = s.best_score_matrix(fa, scan_rc, zscore=zscore, gc=gcnorm)
+            scores = np.ascontiguousarray(scores.T)
+            yield pa.RecordBatch.from_arrays(
+                [pa.array(fa.ids, type=pa.string())] + [pa.array(c) for c in scores],
+                schema=schema,
+            )
+    else:
+        schema = _hit_schema()
+        yield schema
+        for fa in batches:
+            seq_ids = []
+            motif_idx = []
+            hits = []
+            result_it = s.scan(fa, nreport, scan_rc, zscore, gc=gcnorm)
+            for seq_id, result in zip(fa.ids, result_it):
+                for i, matches in enumerate(result):
+                    seq_ids += [seq_id] * len(matches)
+                    motif_idx += [i] * len(matches)
+                    hits += matches
+            hits = np.array(hits, dtype=np.float64).reshape(-1, 3)
+            yield pa.RecordBatch.from_arrays(
+                [
+                    pa.array(seq_ids, type=pa.string()),
+                    pa.DictionaryArray.from_arrays(
+                        np.array(motif_idx, dtype=np.int32), motif_ids
+                    ),
+                    pa.array(hits[:, 1].astype(np.int32)),
+                    pa.array(hits[:, 0].astype(np.float32)),
+                    pa.DictionaryArray.from_arrays(
+                        (hits[:, 2] > 0).astype(np.int8), strands
+                    ),
+                ],
+                schema=schema,
+            )
+
+
+def _write_columnar(it, fo, fmt, metadata=None):
+    """Write the schema and record batches of it to fo, as Arrow or Parquet."""
+    schema = next(it)
+    if metadata:
+        schema = schema.with_metadata(metadata)
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(fo, schema)
+    else:
+        writer = pa.ipc.new_file(fo, schema)
+    try:
+        for batch in it:
+            if fmt == "parquet":
+                writer.write_table(pa.Table.from_batches([batch], schema=schema))
+            else:
+                writer.write_batch(batch)
+    finally:
+        writer.close()
+
+
 def scan_to_file(
     inputfile,
     pfmfile,
@@ -354,23 +659,45 @@ def scan_to_file(
     table=False,
     score_table=False,
     moods=False,
-    pvalue=False,
+    pvalue=None,
     bgfile=None,
     genome=None,
     ncpus=None,
     zscore=True,
     gcnorm=True,
+    fmt="text",
+    kernel="default",
 ):
-    """Scan an inputfile with motifs."""
+    """Scan an inputfile with motifs.
+
+    With fmt "arrow" (Arrow IPC file, also known as Feather V2) or "parquet"
+    the hits or table are written in columns, see command_scan_columnar().
+    The header is stored in the schema metadata. These formats can be read
+    with pandas.read_feather() and pandas.read_parquet().
+
+    The kernel is one of KERNELS, see Scanner.set_kernel(). The results have
+    the same format for every kernel. For backwards compatibility, moods=True
+    selects the "moods" kernel and pvalue is used as FPR.
+    """
+    if fmt not in SCAN_FORMATS:
+        raise ValueError("fmt should be one of {}".format(", ".join(SCAN_FORMATS)))
+    if moods:
+        kernel = "moods"
+    if pvalue:
+        fpr = pvalue
+
+    mode = "w" if fmt == "text" else "wb"
     should_close = False
     if filepath_or_buffer is None:
-        fo = sys.stdout
+        fo = sys.stdout if fmt == "text" else sys.stdout.buffer
     else:
         if hasattr(filepath_or_buffer, "write"):
             fo = filepath_or_buffer
+            if fmt != "text" and hasattr(fo, "buffer"):
+                fo = fo.buffer
         else:
             try:
-                fo = open(os.path.expanduser(filepath_or_buffer), "w")
+                fo = open(os.path.expanduser(filepath_or_buffer), mode)
                 should_close = True
             except Exception:
                 logger.error(f"Could not open {filepath_or_buffer} for writing")
@@ -379,23 +706,52 @@ def scan_to_file(
     if fpr is None and cutoff is None:
         fpr = 0.01
 
-    print("# GimmeMotifs version {}".format(__version__), file=fo)
-    print("# Input: {}".format(inputfile), file=fo)
-    print("# Motifs: {}".format(pfmfile), file=fo)
+    header = [
+        "GimmeMotifs version {}".format(__version__),
+        "Input: {}".format(inputfile),
+        "Motifs: {}".format(pfmfile),
+    ]
     if fpr and not score_table:
         if genome is not None:
-            print("# FPR: {} ({})".format(fpr, genome), file=fo)
+            header.append("FPR: {} ({})".format(fpr, genome))
         elif bgfile:
-            print("# FPR: {} ({})".format(fpr, bgfile), file=fo)
+            header.append("FPR: {} ({})".format(fpr, bgfile))
     if cutoff is not None:
-        print("# Threshold: {}".format(cutoff), file=fo)
+        header.append("Threshold: {}".format(cutoff))
     if zscore:
         if gcnorm:
-            print("# Scoring: GC frequency normalized z-score", file=fo)
+            header.append("Scoring: GC frequency normalized z-score")
         else:
-            print("# Scoring: normalized z-score", file=fo)
+            header.append("Scoring: normalized z-score")
     else:
-        print("# Scoring: logodds score", file=fo)
+        header.append("Scoring: logodds score")
+
+    if fmt != "text":
+        it = command_scan_columnar(
+            inputfile,
+            pfmfile,
+            nreport=nreport,
+            fpr=fpr,
+            cutoff=cutoff,
+            scan_rc=scan_rc,
+            table=table,
+            score_table=score_table,
+            bgfile=bgfile,
+            genome=genome,
+            ncpus=ncpus,
+            zscore=zscore,
+            gcnorm=gcnorm,
+            kernel=kernel,
+        )
+        try:
+            _write_columnar(it, fo, fmt, {"gimmemotifs": "\n".join(header)})
+        finally:
+            if should_close:
+                fo.close()
+        return
+
+    for line in header:
+        print("# {}".format(line), file=fo)
 
     for line in command_scan(
         inputfile,
@@ -407,13 +763,12 @@ def scan_to_file(
         scan_rc=scan_rc,
         table=table,
         score_table=score_table,
-        moods=moods,
-        pvalue=pvalue,
         bgfile=bgfile,
         genome=genome,
         ncpus=ncpus,
         zscore=zscore,
         gcnorm=gcnorm,
+        kernel=kernel,
     ):
         print(line, file=fo)
 
@@ -424,11 +779,115 @@ def scan_to_file(
             pass
 
 
-def scan_to_best_match(
-    fname, motifs, ncpus=None, genome=None, score=False, zscore=False, gc=False
-):
-    """Scan a FASTA file with motifs.
-
+def scan_genome_to_files(
+    genome,
+    pfmfile,
+    outdir,
+    fpr=None,
+    cutoff=None,
+    scan_rc=True,
+    bgzip=False,
+    ncpus=None,
+    kernel="default",
+):
+    """Scan a complete genome with motifs and write all hits per chromosome.
+
+    Hits are written as sorted BED files, one file per chromosome, to
+    `outdir`. Chromosomes without hits get an empty file.
+
+    Parameters
+    ----------
+    genome : str
+        Genome name or FASTA file.
+
+    pfmfile : str
+        File with motifs in pfm format.
+
+    outdir : str
+        Output directory.
+
+    fpr : float, optional
+        Desired FPR, between 0.0 and 1.0. The default is 0.01, unless a cutoff
+        is specified.
+
+    cutoff : float or str, optional
+        Motif score threshold, see `Scanner.set_threshold()`.
+
+    scan_rc : bool, optional
+        Scan the reverse complement.
+
+    bgzip : bool, optional
+        Compress the files with bgzip and index them with tabix.
+
+    ncpus : int, optional
+        Number of processes to use.
+
+    kernel : str, optional
+        Scanning kernel, see `Scanner.set_kernel()`.
+
+    Returns
+    -------
+    fnames : list
+        Names of the output files.
+    """
+    if fpr is None and cutoff is None:
+        fpr = 0.01
+
+    s = Scanner(ncpus=ncpus)
+    s.set_kernel(kernel)
+    s.set_motifs(pfmfile)
+    s.set_genome(genome)
+    if cutoff is None:
+        s.set_background(genome=genome)
+    s.set_threshold(fpr=fpr, threshold=cutoff)
+    motifs = read_motifs(pfmfile)
+
+    os.makedirs(outdir, exist_ok=True)
+    suffix = ".bed.gz" if bgzip else ".bed"
+
+    fnames = []
+    current = None
+    f = None
+    for chrom, hits in s.scan_genome(scan_rc=scan_rc):
+        if chrom != current:
+            if f is not None:
+                f.close()
+            fname = os.path.join(outdir, f"{chrom}{suffix}")
+            fnames.append(fname)
+            if bgzip:
+                f = pysam.BGZFile(fname, "wb")
+            else:
+                f = open(fname, "wb")
+            current = chrom
+
+        lines = [
+            "{}\t{}\t{}\t{}\t{}\t{}\n".format(
+                chrom,
+                pos,
+                pos + len(motifs[i]),
+                motifs[i].id,
+                score,
+                STRANDMAP[strand],
+            )
+            for pos, i, strand, score in zip(*[arr.tolist() for arr in hits])
+        ]
+        f.write("".join(lines).encode())
+
+    if f is not None:
+        f.close()
+
+    if bgzip:
+        for fname in fnames:
+            pysam.tabix_index(fname, preset="bed", force=True)
+
+    return fnames
+
+
+def scan_to_best_match(
+    fname, motifs, ncpus=None, genome=None, score=False, zscore=False, gc=False
+):
+    """Scan a FASTA file with motifs.
+
     Scan a FASTA file and return a dictionary with the best match per motif.
 
     Parameters
@@ -464,7 +923,7 @@ def scan_to_best_match(
         for motif, score in zip(motifs, scores):
             result[motif.id].append(score)
 
-    # Close the pool and reclaim memory
+    # Release the shared memory
     del s
 
     return result
@@ -525,114 +984,1434 @@ def scan_seq_mult(
     return ret
 
 
-def scan_fa_with_motif_moods(
-    fo, motifs, matrices, bg, thresholds, nreport, scan_rc=True
+def encode_seqs(seqs):
+    """Encode sequences for the batch scanning kernel.
+
+    Parameters
+    ----------
+    seqs : list
+        List of sequences.
+
+    Returns
+    -------
+    encoded : numpy.ndarray
+        Concatenated sequences as uint8 array (N=0, A=1, C=2, G=3, T=4).
+
+    offsets : numpy.ndarray
+        Start position of every sequence in encoded. The last element is the
+        total length.
+    """
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    np.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+    raw = np.frombuffer("".join(seqs).encode("ascii", errors="replace"), np.uint8)
+    return SEQ_ENCODING[raw], offsets
+
+
+def _input_size(seqs):
+    """Return the number of sequences of scan input, or None if it is only
+    known after reading the input."""
+    if isinstance(seqs, tuple):
+        return len(seqs[1]) - 1
+    if isinstance(seqs, (list, np.ndarray, Fasta)):
+        return len(seqs)
+    return None
+
+
+def _encoded(seqs):
+    """Return sequences as (encoded, offsets), see encode_seqs().
+
+    A tuple is assumed to be encoded already.
+    """
+    if isinstance(seqs, tuple):
+        return seqs
+    return encode_seqs(seqs)
+
+
+def _encoded_slice(seqs, start, end):
+    """Return the encoded sequences from start to end (exclusive)."""
+    encoded, seq_offsets = seqs
+    seq_offsets = seq_offsets[start : end + 1]
+    return encoded[seq_offsets[0] : seq_offsets[-1]], seq_offsets - seq_offsets[0]
+
+
+def _encoded_take(seqs, idx):
+    """Return the encoded sequences with index idx.
+
+    Also used for the stacked motifs of motif_tensor().
+    """
+    encoded, seq_offsets = seqs
+    if len(idx) == len(seq_offsets) - 1:
+        return seqs
+    starts = seq_offsets[idx]
+    lengths = seq_offsets[np.asarray(idx) + 1] - starts
+    offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    gather = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+    return encoded[gather], offsets
+
+
+def _encoded_batches(seqs, batch_size):
+    """Yield the start index and the encoded sequences of every batch."""
+    for start in range(0, len(seqs[1]) - 1, batch_size):
+        yield start, _encoded_slice(seqs, start, start + batch_size)
+
+
+def sparse_counts(counts, nmotifs, nreport):
+    """Stack dense count matrices to one sparse matrix.
+
+    Parameters
+    ----------
+    counts : iterable
+        Dense count matrices of consecutive batches of sequences. Every
+        matrix is converted as soon as it is consumed.
+
+    nmotifs : int
+        Number of motifs (columns).
+
+    nreport : int
+        Maximum number of matches counted per motif, 0 for no limit.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Counts as the smallest unsigned integer type, see count_dtype().
+    """
+    dtype = count_dtype(nreport)
+    parts = [csr_matrix(c.astype(dtype)) for c in counts]
+    if len(parts) == 0:
+        return csr_matrix((0, nmotifs), dtype=dtype)
+    return vstack(parts, format="csr", dtype=dtype)
+
+
+def gc_content(encoded, seq_offsets):
+    """Return the GC fraction of encoded sequences.
+
+    Parameters
+    ----------
+    encoded : numpy.ndarray
+        Encoded sequences, as returned by encode_seqs().
+
+    seq_offsets : numpy.ndarray
+        Sequence offsets in encoded, as returned by encode_seqs().
+
+    Returns
+    -------
+    numpy.ndarray
+        GC fraction of every sequence, 0 for empty sequences.
+    """
+    gc_count = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum((encoded == 2) | (encoded == 3), out=gc_count[1:])
+    return np.diff(gc_count[seq_offsets]) / np.maximum(np.diff(seq_offsets), 1)
+
+
+def _motif_matrix(motif):
+    """Return the log-odds matrix of a motif with six columns, see motif_tensor()."""
+    logodds = np.array(motif.logodds, dtype=np.float64).reshape(-1, 4)
+    matrix = np.zeros((len(logodds), 6))
+    if len(logodds) > 0:
+        matrix[:, 1:5] = logodds
+        matrix[:, 0] = logodds.min(1)
+        matrix[:, 5] = matrix[:, 0]
+    return matrix
+
+
+def motif_tensor(motifs):
+    """Stack the log-odds matrices of motifs for the batch scanning kernel.
+
+    Every row contains the scores for N, A, C, G, T and N (for the reverse
+    complement), where N gets the minimum score of the row.
+
+    Parameters
+    ----------
+    motifs : list
+        List of Motif instances.
+
+    Returns
+    -------
+    matrix : numpy.ndarray
+        Array of shape (total motif length, 6) with all log-odds matrices.
+
+    offsets : numpy.ndarray
+        First row of every motif in matrix. The last element is the total
+        number of rows.
+    """
+    offsets = np.zeros(len(motifs) + 1, dtype=np.int64)
+    np.cumsum([len(m.logodds) for m in motifs], out=offsets[1:])
+    matrix = np.zeros((offsets[-1], 6))
+    for motif, start, end in zip(motifs, offsets[:-1], offsets[1:]):
+        if end > start:
+            matrix[start:end] = _motif_matrix(motif)
+    return matrix, offsets
+
+
+def motif_kmer_tables(motif, k=KMER_SIZE):
+    """Return the super-alphabet score tables of a motif.
+
+    The motif is split in blocks of k positions. For every block there is a
+    table with the summed scores of these positions for all 5^k encoded
+    k-mers (see encode_seqs()), first for the forward strand and then for
+    the reverse complement. Positions after the end of the motif score 0.
+
+    The tables are cached per process by Motif.hash(), up to
+    KMER_CACHE_BYTES.
+
+    Parameters
+    ----------
+    motif : Motif instance
+        Motif.
+
+    k : int, optional
+        Number of positions per table.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (2 * ceil(motif length / k), 5^k).
+    """
+    matrix = _motif_matrix(motif)
+    key = (motif.hash(), k)
+    if key in _kmer_tables:
+        cached_matrix, tables = _kmer_tables[key]
+        # Motif.hash() is based on the rounded frequencies
+        if np.array_equal(cached_matrix, matrix):
+            _kmer_tables.move_to_end(key)
+            return tables
+
+    ncols = -(-len(matrix) // k)
+    # Digits of every k-mer, most significant first
+    digits = (np.arange(5 ** k)[:, None] // 5 ** np.arange(k - 1, -1, -1)) % 5
+    tables = []
+    # The reverse complement scores N, T, G, C, A from the last position
+    for strand_matrix in (matrix[:, :5], matrix[::-1, :0:-1]):
+        blocks = np.zeros((ncols * k, 5))
+        blocks[: len(matrix)] = strand_matrix
+        blocks = blocks.reshape(ncols, k, 5)
+        tables.append(blocks[:, np.arange(k), digits].sum(2))
+    tables = np.ascontiguousarray(np.concatenate(tables))
+
+    _kmer_tables.pop(key, None)
+    _kmer_tables[key] = (matrix, tables)
+    nbytes = sum(t.nbytes for _, t in _kmer_tables.values())
+    while nbytes > KMER_CACHE_BYTES and len(_kmer_tables) > 1:
+        _, (_, old_tables) = _kmer_tables.popitem(last=False)
+        nbytes -= old_tables.nbytes
+    return tables
+
+
+def kmer_tensor(motifs, k=KMER_SIZE):
+    """Stack the super-alphabet score tables of motifs.
+
+    Parameters
+    ----------
+    motifs : list
+        List of Motif instances.
+
+    k : int, optional
+        Number of positions per table.
+
+    Returns
+    -------
+    tables : numpy.ndarray
+        Array of shape (total number of tables, 5^k), see motif_kmer_tables().
+
+    offsets : numpy.ndarray
+        First table of every motif in tables. The last element is the total
+        number of tables.
+    """
+    tables = [motif_kmer_tables(m, k) for m in motifs]
+    offsets = np.zeros(len(motifs) + 1, dtype=np.int64)
+    np.cumsum([len(t) for t in tables], out=offsets[1:])
+    if len(tables) == 0:
+        return np.zeros((0, 5 ** k)), offsets
+    return np.concatenate(tables), offsets
+
+
+def scan_seq_batch(
+    seqs,
+    seq_gc_bins,
+    matrix,
+    motif_offsets,
+    cutoffs,
+    nreport,
+    scan_rc,
+    zscore=None,
+    simd=False,
+    moods=False,
 ):
+    """Scan a batch of sequences with all motifs at once.
 
-    scanner = MOODS.scan.Scanner(7)
-    scanner.set_motifs(matrices, bg, thresholds)
+    The hits are returned as flat arrays, in order of sequence, motif and
+    score, instead of a list of lists per sequence.
 
-    ret = []
-    for name, seq in fo.items():
-        length = len(seq)
-
-        scan_seq = seq.upper()
-        if scan_rc:
-            scan_seq = "".join((scan_seq, "N" * 50, rc(scan_seq)))
-        results = scanner.scan_max_hits(scan_seq, nreport)
-        for motif, result in zip(motifs, results):
-            matches = []
-            for match in result:
-                strand = 1
-                pos = match.pos
-                if scan_rc:
-                    if pos > length:
-                        pos = length - (pos - length - 50) - len(motif)
-                        strand = -1
-                matches.append((pos, match.score, strand))
-            ret.append((motif, {name: matches}))
+    Parameters
+    ----------
+    seqs : list
+        List of sequences.
 
-    return ret
+    seq_gc_bins : list
+        GC% bin of every sequence, as index in the mean and std arrays of
+        zscore. Only used for z-scores.
+
+    matrix : numpy.ndarray
+        Stacked log-odds matrices, as returned by motif_tensor().
+
+    motif_offsets : numpy.ndarray
+        Motif offsets in matrix, as returned by motif_tensor().
+
+    cutoffs : numpy.ndarray
+        Score cutoff for every motif.
+
+    nreport : int
+        Maximum number of hits to report per motif and sequence, 0 for all
+        hits.
+
+    scan_rc : bool
+        Scan the reverse complement.
+
+    zscore : tuple, optional
+        Tuple of (mean, std), arrays of nbins x nmotifs with the background
+        mean and std of every motif. The hits are reported as z-scores and
+        the cutoffs are z-score cutoffs.
 
+    simd : bool, optional
+        Use the SIMD kernel, which scores blocks of windows with float32
+        vector instructions and only scores windows that can pass the cutoff
+        exactly. The hits are the same. See simd_level() for the instruction
+        set that is used.
 
-def scan_fa_with_motif_moods_count(
-    fo, motifs, matrices, bg, thresholds, nreport, scan_rc=True
+    moods : bool, optional
+        Scan with MOODS, see scan_moods_encoded().
+
+    Returns
+    -------
+    nhits : numpy.ndarray
+        Number of hits for every sequence (rows) and motif (columns).
+
+    scores, pos, strand : numpy.ndarray
+        Score, position and strand of all hits. With nreport 0, the hits of
+        every sequence and motif are in order of strand (forward first) and
+        position instead of score.
+    """
+    encoded, seq_offsets = encode_seqs(seqs)
+    if zscore is not None:
+        zscore = (np.asarray(seq_gc_bins, dtype=np.int64),) + tuple(zscore)
+    return scan_encoded_batch(
+        encoded,
+        seq_offsets,
+        matrix,
+        motif_offsets,
+        cutoffs,
+        nreport,
+        scan_rc,
+        zscore,
+        simd,
+        moods,
+    )
+
+
+def scan_encoded_batch(
+    encoded,
+    seq_offsets,
+    matrix,
+    motif_offsets,
+    cutoffs,
+    nreport,
+    scan_rc,
+    zscore=None,
+    simd=False,
+    moods=False,
 ):
-    scanner = MOODS.scan.Scanner(7)
-    scanner.set_motifs(matrices, bg, thresholds)
+    """Scan a batch of encoded sequences with all motifs at once.
 
-    ret = []
-    for name, seq in fo.items():
-        scan_seq = seq.upper()
-        if scan_rc:
-            scan_seq = "".join((scan_seq, "N" * 50, rc(scan_seq)))
-        results = scanner.counts_max_hits(scan_seq, nreport)
-        ret.append((name, results))
+    Same as scan_seq_batch(), for sequences encoded with encode_seqs(). For
+    z-scores, zscore is a tuple of (bins, mean, std), where bins contains the
+    GC% bin of every sequence.
 
-    return ret
+    The z-scores are calculated in the kernel, so only the hits that pass the
+    cutoff are returned.
+    """
+    if moods:
+        return scan_moods_encoded(
+            encoded,
+            seq_offsets,
+            matrix,
+            motif_offsets,
+            cutoffs,
+            nreport,
+            scan_rc,
+            zscore,
+        )
 
+    if nreport == 0:
+        return _scan_encoded_all(
+            encoded, seq_offsets, matrix, motif_offsets, cutoffs, scan_rc, zscore, simd
+        )
 
-def calc_threshold_moods(m, c):
-    m_min = MOODS.tools.min_score(m)
-    m_max = MOODS.tools.max_score(m)
+    nmotifs = len(cutoffs)
+    nseqs = len(seq_offsets) - 1
+    step = max(1, BATCH_MAX_HITS // max(1, nmotifs * nreport))
 
-    return m_min + (m_max - m_min) * c
+    ret = []
+    for i in range(0, nseqs, step):
+        start, end = seq_offsets[i], seq_offsets[min(i + step, nseqs)]
+        offsets = seq_offsets[i : i + step + 1] - start
+        shape = (len(offsets) - 1, nmotifs, nreport)
+        scores = np.empty(shape)
+        pos = np.empty(shape, dtype=np.int64)
+        strand = np.empty(shape, dtype=np.int8)
+        if zscore is None:
+            pwmscan_batch(
+                encoded[start:end],
+                offsets,
+                matrix,
+                motif_offsets,
+                cutoffs,
+                nreport,
+                int(scan_rc),
+                scores,
+                pos,
+                strand,
+                int(simd),
+            )
+        else:
+            bins, mean, std = zscore
+            pwmscan_batch_zscore(
+                encoded[start:end],
+                offsets,
+                matrix,
+                motif_offsets,
+                cutoffs,
+                np.ascontiguousarray(bins[i : i + step], dtype=np.int64),
+                np.ascontiguousarray(mean, dtype=np.float64),
+                np.ascontiguousarray(std, dtype=np.float64),
+                nreport,
+                int(scan_rc),
+                scores,
+                pos,
+                strand,
+                int(simd),
+            )
+        found = pos >= 0
+        ret.append((found.sum(2), scores[found], pos[found], strand[found]))
+
+    if len(ret) == 1:
+        return ret[0]
+    if len(ret) == 0:
+        return (
+            np.zeros((0, nmotifs), dtype=int),
+            np.zeros(0),
+            np.zeros(0, dtype=np.int64),
+            np.zeros(0, dtype=np.int8),
+        )
+    return tuple(np.concatenate(x) for x in zip(*ret))
 
 
-def scan_it_moods(
-    infile, motifs, cutoff, bgfile, nreport=1, scan_rc=True, pvalue=None, count=False
+def _scan_encoded_all(
+    encoded,
+    seq_offsets,
+    matrix,
+    motif_offsets,
+    cutoffs,
+    scan_rc,
+    zscore=None,
+    simd=False,
+    capacity=None,
 ):
-    tmpdir = mkdtemp()
-    matrices = []
-    pseudocount = 1e-3
-    # sys.stderr.write("bgfile: {}\n".format(bgfile))
-    bg = MOODS.tools.bg_from_sequence_dna("".join(Fasta(bgfile).seqs), 1)
-
-    for motif in motifs:
-        pfmname = os.path.join(tmpdir, "{}.pfm".format(motif.id))
-        with open(pfmname, "w") as f:
-            matrix = np.array(motif.pwm).transpose()
-            for line in [" ".join([str(x) for x in row]) for row in matrix]:
-                f.write("{}\n".format(line))
-
-        matrices.append(MOODS.parsers.pfm_log_odds(pfmname, bg, pseudocount))
-
-    thresholds = []
-    if pvalue is not None:
-        thresholds = [
-            MOODS.tools.threshold_from_p(m, bg, float(pvalue)) for m in matrices
+    """Return all hits of a batch of encoded sequences, see
+    scan_encoded_batch() with nreport 0.
+
+    The kernel appends the hits to arrays with room for capacity hits, by
+    default BATCH_MAX_HITS. If these are full, it stops after the sequence
+    and motif that did not fit. That motif and everything after it are then
+    scanned again, with room for at least all hits of that motif.
+    """
+    if capacity is None:
+        capacity = BATCH_MAX_HITS
+    nseqs = len(seq_offsets) - 1
+    nmotifs = len(cutoffs)
+    nhits = np.full((nseqs, nmotifs), -1, dtype=np.int64)
+    scores = np.empty(capacity)
+    pos = np.empty(capacity, dtype=np.int64)
+    strand = np.empty(capacity, dtype=np.int8)
+    args = [encoded, seq_offsets, matrix, motif_offsets, cutoffs]
+    if zscore is not None:
+        bins, mean, std = zscore
+        args += [
+            np.ascontiguousarray(bins, dtype=np.int64),
+            np.ascontiguousarray(mean, dtype=np.float64),
+            np.ascontiguousarray(std, dtype=np.float64),
         ]
-        # sys.stderr.write("{}\n".format(thresholds))
+        scan = pwmscan_batch_zscore
     else:
-        thresholds = [calc_threshold_moods(m, float(cutoff)) for m in matrices]
+        scan = pwmscan_batch
+    total = scan(*args, 0, int(scan_rc), scores, pos, strand, int(simd), nhits)
+    if total <= capacity:
+        return nhits, scores[:total], pos[:total], strand[:total]
+
+    i, k = divmod(np.flatnonzero(nhits.ravel() >= 0)[-1], nmotifs)
+    kept = total - nhits[i, k]
+    capacity = max(capacity, nhits[i, k])
+    parts = [(scores[:kept], pos[:kept], strand[:kept])]
+
+    # The rest of the motifs of sequence i
+    start, end = motif_offsets[k], motif_offsets[-1]
+    rest = _scan_encoded_all(
+        *_encoded_slice((encoded, seq_offsets), i, i + 1),
+        matrix[start:end],
+        motif_offsets[k:] - start,
+        cutoffs[k:],
+        scan_rc,
+        None if zscore is None else (bins[i : i + 1], mean[:, k:], std[:, k:]),
+        simd,
+        capacity,
+    )
+    nhits[i, k:] = rest[0][0]
+    parts.append(rest[1:])
+
+    # The sequences after sequence i
+    if i + 1 < nseqs:
+        rest = _scan_encoded_all(
+            *_encoded_slice((encoded, seq_offsets), i + 1, nseqs),
+            matrix,
+            motif_offsets,
+            cutoffs,
+            scan_rc,
+            None if zscore is None else (bins[i + 1 :], mean, std),
+            simd,
+            capacity,
+        )
+        nhits[i + 1 :] = rest[0]
+        parts.append(rest[1:])
+    return (nhits,) + tuple(np.concatenate(x) for x in zip(*parts))
 
-    scanner = MOODS.scan.Scanner(7)
-    scanner.set_motifs(matrices, bg, thresholds)
 
-    config = MotifConfig()
-    ncpus = int(config.get_default_params()["ncpus"])
-    fa = Fasta(infile)
-    chunk = 500
-    if (len(fa) / chunk) < ncpus:
-        chunk = len(fa) / (ncpus + 1)
-
-    jobs = []
-    func = scan_fa_with_motif_moods
-    if count:
-        func = scan_fa_with_motif_moods_count
-
-    pool = mp.Pool()
-    for i in range(0, len(fa), chunk):
-        jobs.append(
-            pool.apply_async(
-                func,
-                (fa[i : i + chunk], motifs, matrices, bg, thresholds, nreport, scan_rc),
+def _share_array(arr):
+    """Copy an array to shared memory.
+
+    Returns the SharedMemory instance, which should be closed and unlinked
+    by the caller, and a (name, shape, dtype) tuple that can be passed to
+    worker processes to attach to the array.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    shared[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def _attach_array(spec):
+    """Return an array in shared memory, as created by _share_array().
+
+    Worker processes keep the most recently used arrays attached, so arrays
+    that are used by many jobs, such as the motifs, are only attached once.
+    """
+    name, shape, dtype = spec
+    if name in _attached:
+        _attached.move_to_end(name)
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+        while len(_attached) > MAX_ATTACHED:
+            _, (old_shm, old_arr) = _attached.popitem(last=False)
+            del old_arr
+            old_shm.close()
+    return _attached[name][1]
+
+
+def scan_shared_batch(
+    bounds,
+    seqs,
+    motifs,
+    cutoffs,
+    nreport,
+    scan_rc,
+    zscore=None,
+    simd=False,
+    moods=False,
+):
+    """Scan a batch of sequences in shared memory with all motifs at once.
+
+    Parameters
+    ----------
+    bounds : tuple
+        Index of the first and last (exclusive) sequence to scan.
+
+    seqs : tuple
+        Shared memory specs of the encoded sequences and sequence offsets,
+        as returned by encode_seqs().
+
+    motifs : tuple
+        Shared memory specs of the stacked matrices and motif offsets, as
+        returned by motif_tensor().
+
+    cutoffs, nreport, scan_rc
+        See scan_seq_batch().
+
+    zscore : tuple, optional
+        Shared memory specs of the GC% bin of every sequence and of the mean
+        and std arrays, for z-scores. See scan_seq_batch().
+
+    simd, moods : bool, optional
+        Use the SIMD or MOODS kernel, see scan_seq_batch().
+
+    Returns
+    -------
+    tuple
+        See scan_seq_batch().
+    """
+    start, end = bounds
+    encoded, seq_offsets = [_attach_array(spec) for spec in seqs]
+    matrix, motif_offsets = [_attach_array(spec) for spec in motifs]
+    if zscore is not None:
+        bins, mean, std = [_attach_array(spec) for spec in zscore]
+        zscore = (bins[start:end], mean, std)
+
+    seq_offsets = seq_offsets[start : end + 1]
+    return scan_encoded_batch(
+        encoded[seq_offsets[0] : seq_offsets[-1]],
+        seq_offsets - seq_offsets[0],
+        matrix,
+        motif_offsets,
+        cutoffs,
+        nreport,
+        scan_rc,
+        zscore,
+        simd,
+        moods,
+    )
+
+
+def scan_best_encoded(
+    encoded,
+    seq_offsets,
+    matrix,
+    motif_offsets,
+    min_scores,
+    scan_rc,
+    out,
+    zscore=None,
+    kmer_tables=None,
+    simd=False,
+):
+    """Write the best score of every motif in every sequence to out.
+
+    Parameters
+    ----------
+    encoded, seq_offsets
+        Encoded sequences, as returned by encode_seqs().
+
+    matrix, motif_offsets
+        Stacked motifs, as returned by motif_tensor().
+
+    min_scores : numpy.ndarray
+        Minimum score of every motif. This is the score of a sequence that is
+        shorter than the motif, or for which the best score is lower.
+
+    scan_rc : bool
+        Also scan the reverse complement.
+
+    out : numpy.ndarray
+        Output array of nseqs x nmotifs. Scores are written directly if it is
+        a contiguous float32 or float64 array, otherwise they are converted.
+
+    zscore : tuple, optional
+        Tuple of (bins, mean, std) to convert the scores to z-scores. The
+        array bins contains the GC% bin index of every sequence, mean and
+        std are arrays of nbins x nmotifs.
+
+    kmer_tables : tuple, optional
+        Super-alphabet tables and offsets, as returned by kmer_tensor(). If
+        specified, the sequences are scored with these tables. The scores
+        are the same.
+
+    simd : bool, optional
+        Use the SIMD kernel, see scan_seq_batch().
+    """
+    direct = (
+        zscore is None
+        and out.dtype in (np.float32, np.float64)
+        and out.flags.c_contiguous
+    )
+    scores = out if direct else np.empty(out.shape, dtype=np.float64)
+    if kmer_tables is not None:
+        _scan_kmer(
+            encoded,
+            seq_offsets,
+            matrix,
+            motif_offsets,
+            kmer_tables,
+            None,
+            min_scores,
+            0,
+            scan_rc,
+            None,
+            scores,
+        )
+    else:
+        pwmscan_best(
+            encoded,
+            seq_offsets,
+            matrix,
+            motif_offsets,
+            min_scores,
+            int(scan_rc),
+            scores,
+            int(simd),
+        )
+
+    if zscore is not None:
+        scores = _zscore_best(scores, seq_offsets, motif_offsets, min_scores, zscore)
+
+    if not direct:
+        out[...] = scores
+    return out
+
+
+def _zscore_best(scores, seq_offsets, motif_offsets, min_scores, zscore):
+    """Convert best scores to z-scores, see scan_best_encoded()."""
+    bins, mean, std = zscore
+    z = (scores - mean[bins]) / std[bins]
+    # Same as scan_sequence(): sequences that are shorter than the motif
+    # and z-scores below the minimum score get the minimum score
+    short = np.diff(seq_offsets)[:, None] < np.diff(motif_offsets)[None, :]
+    return np.where(short | (z < min_scores), min_scores, z)
+
+
+def scan_count_encoded(
+    encoded,
+    seq_offsets,
+    matrix,
+    motif_offsets,
+    cutoffs,
+    min_scores,
+    nreport,
+    scan_rc,
+    out,
+    kmer_tables=None,
+    simd=False,
+    moods=False,
+):
+    """Write the number of matches of every motif in every sequence to out.
+
+    The counts are the same as the number of matches that are returned by
+    scan_seq_batch(), but the matches themselves are never stored.
+
+    Parameters
+    ----------
+    encoded, seq_offsets
+        Encoded sequences, as returned by encode_seqs().
+
+    matrix, motif_offsets
+        Stacked motifs, as returned by motif_tensor().
+
+    cutoffs : numpy.ndarray
+        Cutoff for every motif, np.inf for no matches.
+
+    min_scores : numpy.ndarray
+        Minimum score of every motif. If the cutoff is at or below the
+        minimum score, a sequence without matches gets nreport matches.
+
+    nreport : int
+        Maximum number of matches to count, 0 for all matches.
+
+    scan_rc : bool
+        Also scan the reverse complement.
+
+    out : numpy.ndarray
+        Contiguous int64 output array of nseqs x nmotifs.
+
+    simd, moods : bool, optional
+        Use the SIMD or MOODS kernel, see scan_seq_batch().
+
+    kmer_tables : tuple, optional
+        Super-alphabet tables, see scan_best_encoded().
+    """
+    if moods:
+        _count_moods(
+            encoded, seq_offsets, matrix, motif_offsets, cutoffs, nreport, scan_rc, out
+        )
+    elif kmer_tables is not None:
+        _scan_kmer(
+            encoded,
+            seq_offsets,
+            matrix,
+            motif_offsets,
+            kmer_tables,
+            cutoffs,
+            min_scores,
+            nreport,
+            scan_rc,
+            out,
+            None,
+        )
+    else:
+        pwmscan_count(
+            encoded,
+            seq_offsets,
+            matrix,
+            motif_offsets,
+            cutoffs,
+            nreport,
+            int(scan_rc),
+            out,
+            int(simd),
+        )
+    _fill_counts(out, cutoffs, min_scores, nreport)
+    return out
+
+
+def _fill_counts(counts, cutoffs, min_scores, nreport):
+    """Same as scan_sequence(): if the cutoff is at or below the minimum score,
+    a sequence without matches gets nreport matches."""
+    fill = cutoffs <= min_scores
+    if nreport > 0 and fill.any():
+        fill_counts = counts[:, fill]
+        fill_counts[fill_counts == 0] = nreport
+        counts[:, fill] = fill_counts
+
+
+def scan_count_best_encoded(
+    encoded,
+    seq_offsets,
+    matrix,
+    motif_offsets,
+    cutoffs,
+    min_scores,
+    nreport,
+    scan_rc,
+    out,
+    zscore=None,
+    kmer_tables=None,
+    simd=False,
+):
+    """Write the number of matches and best score of every motif to out.
+
+    This gives the same result as scan_count_encoded() and
+    scan_best_encoded(), but scans the sequences only once.
+
+    Parameters
+    ----------
+    encoded, seq_offsets, matrix, motif_offsets, cutoffs, min_scores, nreport, scan_rc
+        See scan_count_encoded().
+
+    out : tuple
+        Tuple of two output arrays of nseqs x nmotifs: int64 counts and
+        scores.
+
+    zscore, kmer_tables : tuple, optional
+        See scan_best_encoded().
+
+    simd : bool, optional
+        Use the SIMD kernel, see scan_seq_batch().
+    """
+    counts, out_scores = out
+    direct = (
+        zscore is None
+        and out_scores.dtype in (np.float32, np.float64)
+        and out_scores.flags.c_contiguous
+    )
+    scores = out_scores if direct else np.empty(out_scores.shape, dtype=np.float64)
+    if kmer_tables is not None:
+        _scan_kmer(
+            encoded,
+            seq_offsets,
+            matrix,
+            motif_offsets,
+            kmer_tables,
+            cutoffs,
+            min_scores,
+            nreport,
+            scan_rc,
+            counts,
+            scores,
+        )
+        # Same as pwmscan_count_best(), scores are at least the minimum score
+        np.maximum(scores, min_scores.astype(scores.dtype), out=scores)
+    else:
+        pwmscan_count_best(
+            encoded,
+            seq_offsets,
+            matrix,
+            motif_offsets,
+            cutoffs,
+            min_scores,
+            nreport,
+            int(scan_rc),
+            counts,
+            scores,
+            int(simd),
+        )
+    _fill_counts(counts, cutoffs, min_scores, nreport)
+
+    if zscore is not None:
+        scores = _zscore_best(scores, seq_offsets, motif_offsets, min_scores, zscore)
+
+    if not direct:
+        out_scores[...] = scores
+    return out
+
+
+def _scan_kmer(
+    encoded,
+    seq_offsets,
+    matrix,
+    motif_offsets,
+    kmer_tables,
+    cutoffs,
+    min_scores,
+    nreport,
+    scan_rc,
+    counts,
+    scores,
+):
+    """Count matches and/or determine best scores with super-alphabet tables.
+
+    Either counts or scores can be None, see pwmscan_kmer().
+    """
+    tables, table_offsets = kmer_tables
+    k = int(round(np.log(tables.shape[1]) / np.log(5)))
+    if cutoffs is None:
+        cutoffs = np.empty(0)
+    pwmscan_kmer(
+        encoded,
+        seq_offsets,
+        matrix,
+        motif_offsets,
+        tables,
+        table_offsets,
+        k,
+        cutoffs,
+        min_scores,
+        nreport,
+        int(scan_rc),
+        counts,
+        scores,
+    )
+
+
+def _no_job_kwargs(start, end):
+    """Job-specific keyword arguments, for jobs that have none."""
+    return {}
+
+
+def scan_matrix_batch(seqs, job_kwargs, func, matrix, motif_offsets, dtype, **kwargs):
+    """Scan a batch of sequences with all motifs, and return a matrix.
+
+    Parameters
+    ----------
+    seqs : list or tuple
+        List of sequences, or encoded sequences as returned by encode_seqs().
+
+    job_kwargs : dict
+        Keyword arguments for func that are specific for this batch.
+
+    func : callable
+        Function that fills the matrix, such as scan_best_encoded().
+
+    matrix, motif_offsets
+        Stacked motifs, as returned by motif_tensor().
+
+    dtype : numpy dtype or list
+        Data type of the matrix. If this is a list, func fills a tuple of
+        matrices, one for every data type.
+
+    **kwargs
+        Other keyword arguments for func.
+
+    Returns
+    -------
+    numpy.ndarray or tuple
+        Matrix (or tuple of matrices) of nseqs x nmotifs.
+    """
+    encoded, seq_offsets = _encoded(seqs)
+    shape = (len(seq_offsets) - 1, len(motif_offsets) - 1)
+    if isinstance(dtype, list):
+        out = tuple(np.empty(shape, dtype=d) for d in dtype)
+    else:
+        out = np.empty(shape, dtype=dtype)
+    func(
+        encoded,
+        seq_offsets,
+        matrix,
+        motif_offsets,
+        out=out,
+        **job_kwargs,
+        **kwargs,
+    )
+    return out
+
+
+def scan_matrix_shared(bounds, job_kwargs, func, seqs, motifs, out, **kwargs):
+    """Scan a batch of sequences in shared memory and write the rows to out.
+
+    Parameters
+    ----------
+    bounds : tuple
+        Index of the first and last (exclusive) sequence to scan.
+
+    job_kwargs, func, **kwargs
+        See scan_matrix_batch().
+
+    seqs, motifs
+        Shared memory specs, see scan_shared_batch(). If motifs contains
+        four specs, the last two are the super-alphabet tables and offsets,
+        which are passed to func as kmer_tables.
+
+    out : tuple or list
+        Filename, shape and dtype of the memory-mapped output matrix, or a
+        list of these for multiple matrices. The rows of this batch are
+        written.
+    """
+    start, end = bounds
+    encoded, seq_offsets = [_attach_array(spec) for spec in seqs]
+    matrix, motif_offsets, *kmer_tables = [_attach_array(spec) for spec in motifs]
+    if kmer_tables:
+        kwargs["kmer_tables"] = tuple(kmer_tables)
+
+    specs = out if isinstance(out, list) else [out]
+    results = [
+        np.memmap(fname, dtype=dtype, mode="r+", shape=shape)[start:end]
+        for fname, shape, dtype in specs
+    ]
+    func(
+        *_encoded_slice((encoded, seq_offsets), start, end),
+        matrix,
+        motif_offsets,
+        out=tuple(results) if isinstance(out, list) else results[0],
+        **job_kwargs,
+        **kwargs,
+    )
+    del results
+
+
+def batch_to_matches(result, motifs, nreport):
+    """Convert the output of scan_seq_batch() to lists of matches.
+
+    Parameters
+    ----------
+    result : tuple
+        Result of scan_seq_batch().
+
+    motifs : list
+        List of (Motif, cutoff) tuples that were used for scanning.
+
+    nreport : int
+        Maximum number of hits per motif and sequence.
+
+    Yields
+    ------
+    matches : list
+        For every sequence a list with the matches for every motif, where
+        every match is a [score, position, strand] list.
+    """
+    nhits, scores, pos, strand = result
+    hits = list(map(list, zip(scores.tolist(), pos.tolist(), strand.tolist())))
+
+    # If the cutoff is the minimum score of the motif, always report a match
+    fill = [
+        [[m.pwm_min_score(), 0, 1]] * nreport
+        if cutoff is not None and cutoff <= m.pwm_min_score()
+        else []
+        for m, cutoff in motifs
+    ]
+
+    start = 0
+    for row in nhits.tolist():
+        matches = []
+        for n, empty in zip(row, fill):
+            if n == 0:
+                matches.append(list(empty))
+            else:
+                matches.append(hits[start : start + n])
+                start += n
+        yield matches
+
+
+def genome_chunks(sizes, chunk_size, overlap):
+    """Split chromosomes into overlapping chunks.
+
+    Parameters
+    ----------
+    sizes : iterable
+        Tuples of chromosome name and size.
+
+    chunk_size : int
+        Number of start positions per chunk.
+
+    overlap : int
+        Number of nucleotides every chunk extends into the next chunk.
+        Should be the length of the longest motif minus one.
+
+    Yields
+    ------
+    tuple
+        Chromosome, start and end of the chunk.
+    """
+    for chrom, size in sizes:
+        for start in range(0, size, chunk_size):
+            yield chrom, start, min(start + chunk_size + overlap, size)
+
+
+def scan_genome_chunk(chunk, genome, motifs, cutoffs, scan_rc, chunk_size, **kwargs):
+    """Scan a genomic chunk as created by genome_chunks().
+
+    The chunk is encoded from the genome cache and scanned with all motifs at
+    once, see scan_encoded_batch(). Only hits that start in the first
+    `chunk_size` positions are reported, hits that start in the overlap are
+    reported by the next chunk.
+
+    Parameters
+    ----------
+    chunk : tuple
+        Chromosome, start and end of the chunk.
+
+    genome : str
+        Genome name or FASTA file.
+
+    motifs : tuple
+        Stacked matrices and motif offsets, as returned by motif_tensor(),
+        or their shared memory specs.
+
+    cutoffs : numpy.ndarray
+        Cutoff for every motif, np.inf for no matches.
+
+    scan_rc : bool
+        Scan the reverse complement.
+
+    chunk_size : int
+        Number of start positions per chunk.
+
+    kwargs
+        Kernel, see kernel_kwargs().
+
+    Returns
+    -------
+    tuple
+        Chromosome and a tuple of arrays with the genomic start position,
+        motif index, strand and score of every hit, sorted in that order.
+    """
+    chrom, start, end = chunk
+    if isinstance(motifs[0], tuple):
+        motifs = [_attach_array(spec) for spec in motifs]
+    matrix, motif_offsets = motifs
+
+    encoded, seq_offsets = get_genome_cache(genome).encode_regions(
+        [f"{chrom}:{start}-{end}"]
+    )
+    nhits, scores, pos, strand = scan_encoded_batch(
+        encoded, seq_offsets, matrix, motif_offsets, cutoffs, 0, scan_rc, **kwargs
+    )
+    motif_idx = np.repeat(np.arange(len(cutoffs)), nhits[0])
+
+    keep = pos < chunk_size
+    hits = (pos[keep] + start, motif_idx[keep], strand[keep], scores[keep])
+    order = np.lexsort(hits[::-1])
+    return chrom, tuple(arr[order] for arr in hits)
+
+
+def kernel_kwargs(kernel, func):
+    """Return the keyword arguments that select a kernel in a scan function.
+
+    Parameters
+    ----------
+    kernel : str
+        Name of the kernel, one of KERNELS.
+
+    func : callable
+        Scan function, such as scan_seq_batch() or scan_count_encoded().
+
+    Returns
+    -------
+    dict
+        Keyword arguments for func, empty if func uses the default kernel.
+    """
+    arg = KERNEL_ARGS.get(kernel)
+    if arg is None or arg not in inspect.signature(func).parameters:
+        return {}
+    return {arg: True}
+
+
+def _moods_scanner(matrix, motif_offsets, cutoffs, scan_rc):
+    """Return a MOODS scanner for stacked motifs, see scan_moods_encoded().
+
+    The scanner gets the log-odds matrices of motif_tensor() directly, so it
+    finds the same windows as the native kernels. For the reverse strand
+    the reverse complement of every motif is added. Scanners are cached per
+    process, as they are used for many batches of sequences.
+    """
+    key = (matrix.tobytes(), motif_offsets.tobytes(), cutoffs.tobytes(), scan_rc)
+    if key in _moods_scanners:
+        _moods_scanners.move_to_end(key)
+        return _moods_scanners[key]
+
+    matrices = [
+        matrix[start:end, 1:5].T.tolist()
+        for start, end in zip(motif_offsets[:-1], motif_offsets[1:])
+    ]
+    thresholds = cutoffs.tolist()
+    if scan_rc:
+        matrices += [MOODS.tools.reverse_complement(m) for m in matrices]
+        thresholds += thresholds
+    # MOODS skips stretches without N that are shorter than the window size
+    window = min([MOODS_WINDOW] + np.diff(motif_offsets).tolist())
+    scanner = MOODS.scan.Scanner(max(1, window))
+    scanner.set_motifs(matrices, MOODS.tools.flat_bg(4), thresholds)
+
+    _moods_scanners[key] = scanner
+    while len(_moods_scanners) > MAX_MOODS_SCANNERS:
+        _moods_scanners.popitem(last=False)
+    return scanner
+
+
+def _scan_moods(encoded, seq_offsets, matrix, motif_offsets, cutoffs, scan_rc):
+    """Return all windows of encoded sequences that pass the cutoffs, using MOODS.
+
+    MOODS adds the scores in a different order, so it scans with slightly
+    lower cutoffs, and the windows that it finds are scored again in the same
+    order as the native kernels. The scores, and the order of hits with the
+    same score, are then exactly the same.
+
+    Returns
+    -------
+    seq_idx, motif_idx, scores, pos, strand : numpy.ndarray
+        Sequence, motif, score, position and strand of all windows, in order
+        of sequence, motif, decreasing score, strand (forward first) and
+        position.
+    """
+    nmotifs = len(motif_offsets) - 1
+    # Rounding tolerance of every motif, see simd_alloc() in c_metrics
+    row_max = np.abs(matrix[:, 1:5]).max(axis=1)
+    tol = 1e-9 * (1.0 + np.add.reduceat(row_max, motif_offsets[:-1]))
+    scanner = _moods_scanner(matrix, motif_offsets, cutoffs - tol, scan_rc)
+
+    seq_idx, motif_idx, pos = [], [], []
+    for i, (start, end) in enumerate(zip(seq_offsets[:-1], seq_offsets[1:])):
+        if end == start:
+            continue
+        seq = MOODS_DECODING[encoded[start:end]].tobytes().decode("ascii")
+        for k, hits in enumerate(scanner.scan(seq)):
+            if len(hits) > 0:
+                seq_idx += [i] * len(hits)
+                motif_idx += [k] * len(hits)
+                pos += [h.pos for h in hits]
+
+    seq_idx = np.array(seq_idx, dtype=np.int64)
+    motif_idx = np.array(motif_idx, dtype=np.int64)
+    pos = np.array(pos, dtype=np.int64)
+    # The reverse complement matrices follow the forward matrices
+    strand = np.where(motif_idx < nmotifs, 1, -1).astype(np.int8)
+    motif_idx %= max(1, nmotifs)
+
+    # Same as window_score() in c_metrics
+    lengths = np.diff(motif_offsets)[motif_idx]
+    rows = motif_offsets[:-1][motif_idx]
+    starts = seq_offsets[:-1][seq_idx] + pos
+    scores = np.zeros(len(pos))
+    for m in range(lengths.max() if len(pos) > 0 else 0):
+        valid = m < lengths
+        nuc = encoded[np.where(valid, starts + m, 0)]
+        row = np.where(strand > 0, rows + m, rows + lengths - 1 - m)
+        col = np.where(strand > 0, nuc, 5 - nuc)
+        scores += np.where(valid, matrix[np.where(valid, row, 0), col], 0.0)
+
+    keep = scores >= cutoffs[motif_idx]
+    order = np.lexsort(
+        (pos[keep], -strand[keep], -scores[keep], motif_idx[keep], seq_idx[keep])
+    )
+    return tuple(
+        arr[keep][order] for arr in (seq_idx, motif_idx, scores, pos, strand)
+    )
+
+
+def _group_rank(seq_idx, motif_idx):
+    """Return the rank of every hit within its sequence and motif, for hits
+    that are ordered by sequence and motif."""
+    new_group = np.ones(len(seq_idx), dtype=bool)
+    new_group[1:] = (seq_idx[1:] != seq_idx[:-1]) | (motif_idx[1:] != motif_idx[:-1])
+    group_start = np.maximum.accumulate(np.where(new_group, np.arange(len(seq_idx)), 0))
+    return np.arange(len(seq_idx)) - group_start
+
+
+def _moods_blocks(encoded, seq_offsets, matrix, motif_offsets, cutoffs):
+    """Split a batch into the sequences and motifs that are scanned with MOODS,
+    and those that are scanned with the native kernel.
+
+    MOODS skips the windows that contain an N, while the native kernels score
+    an N with the minimum score of the motif position. Sequences with an N
+    are therefore scanned with the native kernel. MOODS also returns every
+    hit as a Python object, which is slow for motifs with many hits, so
+    motifs with a cutoff below MOODS_MIN_CUTOFF of their score range are
+    scanned with the native kernel as well.
+
+    Yields
+    ------
+    seq_idx, motif_idx : numpy.ndarray
+        Index of the sequences and motifs of the block.
+
+    moods : bool
+        Scan the block with MOODS.
+    """
+    has_n = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(encoded == 0, out=has_n[1:])
+    moods_seqs = has_n[seq_offsets[1:]] == has_n[seq_offsets[:-1]]
+
+    rows = np.zeros((len(matrix) + 1, 2))
+    np.cumsum(
+        np.stack([matrix[:, 1:5].min(axis=1), matrix[:, 1:5].max(axis=1)], axis=1),
+        axis=0,
+        out=rows[1:],
+    )
+    min_scores, max_scores = (rows[motif_offsets[1:]] - rows[motif_offsets[:-1]]).T
+    moods_motifs = cutoffs >= min_scores + MOODS_MIN_CUTOFF * (max_scores - min_scores)
+
+    all_motifs = np.ones(len(cutoffs), dtype=bool)
+    for seqs, motifs, moods in [
+        (moods_seqs, moods_motifs, True),
+        (moods_seqs, ~moods_motifs, False),
+        (~moods_seqs, all_motifs, False),
+    ]:
+        if seqs.any() and motifs.any():
+            yield np.flatnonzero(seqs), np.flatnonzero(motifs), moods
+
+
+def scan_moods_encoded(
+    encoded,
+    seq_offsets,
+    matrix,
+    motif_offsets,
+    cutoffs,
+    nreport,
+    scan_rc,
+    zscore=None,
+):
+    """Scan a batch of encoded sequences with MOODS.
+
+    Same as scan_encoded_batch(), with the same result. Sequences with an N
+    and motifs with a low cutoff are scanned with the native kernel, see
+    _moods_blocks().
+    """
+    nseqs = len(seq_offsets) - 1
+    nmotifs = len(cutoffs)
+    raw_cutoffs = cutoffs
+    if zscore is not None:
+        # Scan with the lowest raw score cutoff of all GC% bins, and select
+        # the hits that pass the z-score cutoff of their own bin
+        bins, mean, std = zscore
+        raw_cutoffs = np.min(mean + cutoffs * std, axis=0)
+        raw_cutoffs -= 1e-9 * (np.abs(raw_cutoffs) + 1.0)
+
+    blocks = []
+    for seq_idx, motif_idx, moods in _moods_blocks(
+        encoded, seq_offsets, matrix, motif_offsets, raw_cutoffs
+    ):
+        seqs = _encoded_take((encoded, seq_offsets), seq_idx)
+        motifs = _encoded_take((matrix, motif_offsets), motif_idx)
+        if moods:
+            hits = _scan_moods_block(
+                *seqs,
+                *motifs,
+                cutoffs[motif_idx],
+                raw_cutoffs[motif_idx],
+                nreport,
+                scan_rc,
+                None if zscore is None else (bins[seq_idx], mean, std),
+                motif_idx,
             )
+        else:
+            nhits, scores, pos, strand = scan_encoded_batch(
+                *seqs,
+                *motifs,
+                cutoffs[motif_idx],
+                nreport,
+                scan_rc,
+                None
+                if zscore is None
+                else (bins[seq_idx], mean[:, motif_idx], std[:, motif_idx]),
+            )
+            group = np.repeat(np.arange(nhits.size), nhits.ravel())
+            hits = (group // len(motif_idx), group % len(motif_idx))
+            hits += (scores, pos, strand)
+        blocks.append((seq_idx[hits[0]], motif_idx[hits[1]]) + hits[2:])
+
+    if len(blocks) == 0:
+        return (
+            np.zeros((nseqs, nmotifs), dtype=int),
+            np.zeros(0),
+            np.zeros(0, dtype=np.int64),
+            np.zeros(0, dtype=np.int8),
         )
+    seq_idx, motif_idx, scores, pos, strand = [np.concatenate(a) for a in zip(*blocks)]
+    # Hits of the blocks in order of sequence and motif
+    group = seq_idx * nmotifs + motif_idx
+    order = np.argsort(group, kind="stable") if len(blocks) > 1 else slice(None)
+    nhits = np.bincount(group, minlength=nseqs * nmotifs).reshape(nseqs, nmotifs)
+    return nhits, scores[order], pos[order], strand[order]
+
+
+def _scan_moods_block(
+    encoded,
+    seq_offsets,
+    matrix,
+    motif_offsets,
+    cutoffs,
+    raw_cutoffs,
+    nreport,
+    scan_rc,
+    zscore,
+    motif_idx,
+):
+    """Return the hits of the sequences and motifs that are scanned with MOODS,
+    see scan_moods_encoded().
+
+    Returns
+    -------
+    seq_idx, motif_idx, scores, pos, strand : numpy.ndarray
+        Sequence and motif (within the block), score, position and strand of
+        the hits, in order of sequence and motif.
+    """
+    seq_idx, block_idx, scores, pos, strand = _scan_moods(
+        encoded, seq_offsets, matrix, motif_offsets, raw_cutoffs, scan_rc
+    )
+    if zscore is not None:
+        bins, mean, std = zscore
+        m_mean = mean[bins[seq_idx], motif_idx[block_idx]]
+        m_std = std[bins[seq_idx], motif_idx[block_idx]]
+        scores = (scores - m_mean) / m_std
+        keep = scores >= cutoffs[block_idx]
+        seq_idx, block_idx, scores, pos, strand = [
+            arr[keep] for arr in (seq_idx, block_idx, scores, pos, strand)
+        ]
+
+    if nreport > 0:
+        keep = _group_rank(seq_idx, block_idx) < nreport
+    else:
+        keep = np.lexsort((pos, -strand, block_idx, seq_idx))
+    return tuple(arr[keep] for arr in (seq_idx, block_idx, scores, pos, strand))
+
+
+def _count_moods(
+    encoded, seq_offsets, matrix, motif_offsets, cutoffs, nreport, scan_rc, out
+):
+    """Count the matches of every motif with MOODS, see scan_count_encoded().
 
-    for job in jobs:
-        for ret in job.get():
-            yield ret
+    Sequences with an N and motifs with a low cutoff are counted with the
+    native kernel, see _moods_blocks().
+    """
+    for seq_idx, motif_idx, moods in _moods_blocks(
+        encoded, seq_offsets, matrix, motif_offsets, cutoffs
+    ):
+        seqs = _encoded_take((encoded, seq_offsets), seq_idx)
+        motifs = _encoded_take((matrix, motif_offsets), motif_idx)
+        counts = np.zeros((len(seq_idx), len(motif_idx)), dtype=np.int64)
+        if moods:
+            hits = _scan_moods(*seqs, *motifs, cutoffs[motif_idx], scan_rc)
+            np.add.at(counts, hits[:2], 1)
+            if nreport > 0:
+                np.minimum(counts, nreport, out=counts)
+        else:
+            pwmscan_count(
+                *seqs, *motifs, cutoffs[motif_idx], nreport, int(scan_rc), counts, 0
+            )
+        out[np.ix_(seq_idx, motif_idx)] = counts
 
 
 class Scanner(object):
@@ -643,6 +2422,10 @@ class Scanner(object):
     def __init__(self, ncpus=None):
         self.config = MotifConfig()
         self._threshold = None
+        self._threshold_fpr = FPR
+        # Sorted background scores per motif and memoised thresholds per
+        # GC% composition, see get_gc_thresholds()
+        self._gc_thresholds = {}
         self.genome = None
         self.background = None
         self.meanstd = {}
@@ -653,38 +2436,152 @@ class Scanner(object):
         else:
             self.ncpus = ncpus
 
-        if self.ncpus > 1:
-            # try:
-            #    ctx = mp.get_context('spawn')
-            #    self.pool = ctx.Pool(processes=self.ncpus)
-            # except AttributeError:
-            self.pool = mp.Pool(processes=self.ncpus)
+        if not pool_available():
+            # Worker processes cannot use the pool themselves
+            self.ncpus = 1
+
+        # Limits of the jobs in flight on the worker pool
+        self.max_jobs = JOBS_PER_CPU * self.ncpus
+        self.max_inflight_bytes = MAX_INFLIGHT_BYTES
+
+        # Cache of thresholds, background scores and backgrounds
+        self.cache = get_cache()
 
-        self.use_cache = False
-        if self.config.get_default_params().get("use_cache", False):
-            self._init_cache()
+        # Cache of the best score and number of matches per sequence
+        self.scan_cache = None
+        if self.config.get_default_params().get("scan_cache", False):
+            self.set_scan_cache()
+
+        # Motifs in shared memory for the worker processes
+        self._shared_motifs = None
+
+        # Kernel for count and hit scans, see set_kernel()
+        self.kernel = "default"
+        # Super-alphabet tables of the last motifs, see _kmer_tables()
+        self._kmer_tensor = None
 
     def __del__(self):
-        # Close the pool because of memory leak
-        if hasattr(self, "pool"):
-            self.pool.close()
+        self._release_shared_motifs()
 
-    def _init_cache(self):
-        try:
-            self.cache = make_region().configure(
-                "dogpile.cache.pylibmc",
-                expiration_time=3600,
-                arguments={"url": ["127.0.0.1"], "binary": True}
-                #    'dogpile.cache.dbm',
-                #    expiration_time = 3600,
-                #    arguments = {
-                #        'filename': 'cache.dbm'
-                #    }
+    @property
+    def pool(self):
+        """The process-wide pool of worker processes."""
+        return get_pool(self.ncpus)
+
+    def _share_motifs(self, matrix, motif_offsets, *tables):
+        """Return the shared memory specs of the motif tensor.
+
+        The super-alphabet tables and offsets (see kmer_tensor()) can be
+        shared as well. The arrays are only copied to shared memory when the
+        motifs change.
+        """
+        arrays = (matrix, motif_offsets) + tables
+        if self._shared_motifs is not None:
+            shared_arrays, shms, specs = self._shared_motifs
+            if len(shared_arrays) == len(arrays) and all(
+                a is b or np.array_equal(a, b) for a, b in zip(shared_arrays, arrays)
+            ):
+                return specs
+            self._release_shared_motifs()
+
+        shms, specs = zip(*[_share_array(arr) for arr in arrays])
+        self._shared_motifs = (arrays, shms, specs)
+        _sharing_scanners.add(self)
+        return specs
+
+    def _release_shared_motifs(self):
+        if getattr(self, "_shared_motifs", None) is not None:
+            for shm in self._shared_motifs[1]:
+                shm.close()
+                shm.unlink()
+            self._shared_motifs = None
+
+    def set_scan_cache(self, cache_dir=None, max_size=None):
+        """Cache the best score and number of matches per sequence and motif.
+
+        The results are stored on disk by sequence and motif, see
+        gimmemotifs.scan_cache. After this, count_matrix(), best_score_matrix()
+        and count_and_best_score() only scan the sequences and motifs that
+        are not in the cache.
+
+        Parameters
+        ----------
+        cache_dir : str, optional
+            Directory of the cache, by default in the GimmeMotifs cache
+            directory.
+
+        max_size : int, optional
+            Maximum size of the cache in bytes.
+        """
+        self.scan_cache = ScanCache(cache_dir, max_size)
+
+    def set_kernel(self, kernel):
+        """Set the kernel that is used to count and scan for matches.
+
+        The "superalphabet" kernel scores every window with one lookup per
+        KMER_SIZE motif positions, in tables with the summed scores of these
+        positions for every k-mer (see kmer_tensor()). This is used for
+        count and best score matrices, hits are scanned with the default
+        kernel. The default kernel selects it automatically for collections
+        of at least KMER_MIN_MOTIFS motifs with an average length of at
+        least KMER_MIN_LENGTH. The results are the same.
+
+        The "simd" kernel scores blocks of windows with float32 vector
+        instructions (AVX2, SSE4.1 or plain C, see simd_level()), and only
+        scores the windows that can pass the cutoff or be the best score
+        exactly. This is used for hits, counts and best scores, with the
+        same results. It is faster than the default kernel for hits, which
+        are scanned without super-alphabet tables. Counts and best scores
+        are determined with the super-alphabet tables if the default kernel
+        would use them, as these are at least as fast.
+
+        The "moods" kernel scans with MOODS (if it is installed), using the
+        same matrices and thresholds as the other kernels. This is used for
+        hits and counts, with the same results. MOODS skips windows with an
+        N, so sequences with an N are scanned with the default kernel, as
+        are motifs with a cutoff below MOODS_MIN_CUTOFF of the score range.
+
+        Scans that a kernel does not support use the default kernel, see
+        kernel_kwargs().
+
+        Parameters
+        ----------
+        kernel : str
+            Name of the kernel, one of KERNELS.
+        """
+        if kernel not in KERNELS:
+            raise ValueError(
+                "Unknown kernel {}, choose from {}".format(kernel, ", ".join(KERNELS))
             )
-            self.use_cache = True
-        except Exception as e:
-            sys.stderr.write("failed to initialize cache\n")
-            sys.stderr.write("{}\n".format(e))
+        if kernel == "moods" and MOODS is None:
+            raise ImportError("The moods kernel needs MOODS, install MOODS-python")
+        if kernel == "simd":
+            logger.debug("SIMD level: %s", simd_level())
+        self.kernel = kernel
+
+    def _kmer_tables(self, motifs):
+        """Return the super-alphabet tables of motifs if they should be used.
+
+        Returns
+        -------
+        tuple or None
+            Tables and offsets as returned by kmer_tensor(), or None if the
+            motifs are scanned with the plain kernel.
+        """
+        if self.kernel != "superalphabet":
+            if len(motifs) < KMER_MIN_MOTIFS:
+                return None
+            if np.mean([len(m) for m in motifs]) < KMER_MIN_LENGTH:
+                return None
+
+        # The same tables are returned for the same motifs, so they are only
+        # copied to shared memory once
+        tensor = motif_tensor(motifs)
+        if self._kmer_tensor is None or not all(
+            np.array_equal(a, b) for a, b in zip(self._kmer_tensor[0], tensor)
+        ):
+            self._kmer_tensor = (tensor, kmer_tensor(motifs))
+        return self._kmer_tensor[1]
 
     def set_motifs(self, motifs):
         try:
@@ -700,10 +2597,6 @@ class Scanner(object):
 
         self.motifs = motif_file
         self.motif_ids = [m.id for m in read_motifs(motif_file)]
-        self.checksum = {}
-        if self.use_cache:
-            chksum = xxhash.xxh64("\n".join(sorted(self.motif_ids))).digest()
-            self.checksum[self.motifs] = chksum
 
     def _meanstd_from_seqs(self, motifs, seqs):
         scan_motifs = [(m, m.pwm_min_score()) for m in motifs]
@@ -718,9 +2611,11 @@ class Scanner(object):
     def _threshold_from_seqs(self, motifs, seqs, fpr):
         scan_motifs = [(m, m.pwm_min_score()) for m in motifs]
         table = []
-        seq_gc_bins = [self.get_seq_bin(seq) for seq in seqs]
+        seq_bins = self.get_seq_bins(seqs)
+        seq_gc_bins = np.array(self.gc_bin_names())[seq_bins]
         for gc_bin, result in zip(
-            seq_gc_bins, self._scan_sequences_with_motif(scan_motifs, seqs, 1, True)
+            seq_gc_bins,
+            self._scan_sequences_with_motif(scan_motifs, seqs, 1, True, seq_bins),
         ):
             table.append([gc_bin] + [row[0][0] for row in result])
 
@@ -743,56 +2638,46 @@ class Scanner(object):
             bins = ["0.00-1.00"]
 
         motifs = read_motifs(self.motifs)
-        lock.acquire()
+
+        def meanstd_key(motif, bin):
+            return "e{}|{}|{}".format(motif.hash(), self.background_hash, bin)
 
         try:
-            with Cache(CACHE_DIR) as cache:
-                scan_motifs = []
-                for bin in bins:
-                    if bin not in self.meanstd:
-                        self.meanstd[bin] = {}
-                    bin_seqs = [s for s, b in zip(seqs, seq_bins) if b == bin]
-
-                    for motif in motifs:
-                        k = "e{}|{}|{}".format(motif.hash(), self.background_hash, bin)
-
-                        results = cache.get(k)
-                        if results is None:
-                            scan_motifs.append(motif)
-                        else:
-                            self.meanstd[bin][motif.id] = results
-
-                    if len(scan_motifs) > 0:
-                        logger.debug("Determining mean and stddev for motifs.")
+            for bin in bins:
+                bin_seqs = [s for s, b in zip(seqs, seq_bins) if b == bin]
+                keys = {meanstd_key(motif, bin): motif for motif in motifs}
+
+                def compute(missing):
+                    logger.debug("Determining mean and stddev for motifs.")
+                    return {
+                        meanstd_key(motif, bin): [mean, std]
                         for motif, mean, std in self._meanstd_from_seqs(
-                            scan_motifs, bin_seqs
-                        ):
-                            k = "e{}|{}|{}".format(
-                                motif.hash(), self.background_hash, bin
-                            )
-                            cache.set(k, [mean, std])
-                            self.meanstd[bin][motif.id] = mean, std
-
-                # Prevent std of 0
-                # This should only happen in testing
-                for motif in motifs:
-                    stds = np.array(
-                        [self.meanstd[gcbin][motif.id][1] for gcbin in bins]
-                    )
-                    idx = stds == 0
-                    if True in idx:
-                        std = np.mean(stds[~idx])
-                        for gcbin in np.array(bins)[idx]:
-                            k = "e{}|{}|{}".format(
-                                motif.hash(), self.background_hash, gcbin
-                            )
-                            mean = self.meanstd[gcbin][motif.id][0]
-                            cache.set(k, [mean, std])
-                            self.meanstd[gcbin][motif.id] = mean, std
+                            [keys[k] for k in missing], bin_seqs
+                        )
+                    }
+
+                values = self.cache.get_or_compute(list(keys), compute)
+                self.meanstd[bin] = {
+                    motif.id: values[meanstd_key(motif, bin)] for motif in motifs
+                }
+
+            # Prevent std of 0
+            # This should only happen in testing
+            fixed = {}
+            for motif in motifs:
+                stds = np.array([self.meanstd[gcbin][motif.id][1] for gcbin in bins])
+                idx = stds == 0
+                if True in idx:
+                    std = np.mean(stds[~idx])
+                    for gcbin in np.array(bins)[idx]:
+                        mean = self.meanstd[gcbin][motif.id][0]
+                        fixed[meanstd_key(motif, gcbin)] = [mean, std]
+                        self.meanstd[gcbin][motif.id] = mean, std
+            if fixed:
+                self.cache.set_many(fixed)
         except sqlite3.DatabaseError:
             print_cluster_error_message()
             sys.exit(1)
-        lock.release()
 
         for gc_bin in self.gc_bins:
             gc_bin = "{:.2f}-{:.2f}".format(*gc_bin)
@@ -865,33 +2750,29 @@ class Scanner(object):
                 raise ValueError("Need either genome or filename for background.")
 
         logger.debug("using background: genome {} with size {}".format(genome, size))
-        lock.acquire()
+        self.background_hash = "d{}:{}:{}:{}".format(
+            genome, int(size), gc, str(gc_bins)
+        )
+
+        def compute(missing):
+            if gc:
+                with NamedTemporaryFile() as tmp:
+                    logger.info("using {} sequences".format(nseq))
+                    gc_bin_bedfile(
+                        tmp.name, genome, number=nseq, length=size, bins=gc_bins
+                    )
+                    fa = as_fasta(tmp.name, genome=genome)
+            else:
+                fa = RandomGenomicFasta(genome, size, nseq)
+            return {self.background_hash: (fa, gc_bins)}
+
         try:
-            with Cache(CACHE_DIR) as cache:
-                self.background_hash = "d{}:{}:{}:{}".format(
-                    genome, int(size), gc, str(gc_bins)
-                )
-                c = cache.get(self.background_hash)
-                if c:
-                    fa, gc_bins = c
-                else:
-                    fa = None
-
-                if not fa:
-                    if gc:
-                        with NamedTemporaryFile() as tmp:
-                            logger.info("using {} sequences".format(nseq))
-                            gc_bin_bedfile(
-                                tmp.name, genome, number=nseq, length=size, bins=gc_bins
-                            )
-                            fa = as_fasta(tmp.name, genome=genome)
-                    else:
-                        fa = RandomGenomicFasta(genome, size, nseq)
-                    cache.set(self.background_hash, (fa, gc_bins))
+            fa, gc_bins = self.cache.get_or_compute([self.background_hash], compute)[
+                self.background_hash
+            ]
         except sqlite3.DatabaseError:
             print_cluster_error_message()
             sys.exit(1)
-        lock.release()
 
         self.background = fa
         if gc_bins:
@@ -903,7 +2784,7 @@ class Scanner(object):
             self.set_threshold()
         return self._threshold
 
-    def set_threshold(self, fpr=None, threshold=None, gc=False):
+    def set_threshold(self, fpr=None, threshold=None, gc=False, method="scan"):
         """Set motif scanning threshold based on background sequences.
 
         Parameters
@@ -917,10 +2798,20 @@ class Scanner(object):
             Should either be a float between 0.0 and 1.0 or a filename
             with thresholds as created by 'gimme threshold'.
 
+        method : str, optional
+            Method to determine the FPR-based threshold. By default ("scan")
+            the background sequences are scanned. With "dp" the exact score
+            distribution of every motif is calculated, using a 1st order
+            Markov model of the background sequences. This is much faster.
+            With gc=True every GC% bin gets a model of the background
+            sequences in that bin.
         """
         if threshold and fpr:
             raise ValueError("Need either fpr or threshold.")
 
+        if method not in ["scan", "dp"]:
+            raise ValueError("Unknown threshold method {}".format(method))
+
         if threshold is None and fpr is None:
             if self.genome:
                 fpr = 0.01
@@ -936,6 +2827,8 @@ class Scanner(object):
             fpr = float(fpr)
             if not (0.0 < fpr < 1.0):
                 raise ValueError("Parameter fpr should be between 0 and 1")
+        self._threshold_fpr = fpr if fpr else FPR
+        self._gc_thresholds = {}
 
         if not self.motifs:
             raise ValueError("please run set_motifs() first")
@@ -958,54 +2851,89 @@ class Scanner(object):
             except Exception:
                 raise ValueError("please run set_background() first")
 
+        if method == "dp":
+            self._threshold_from_dp(motifs, fpr, gc_bins)
+            self.threshold_str = "{}_{}_{}_{}_dp".format(
+                fpr, threshold, self.background_hash, ",".join(sorted(gc_bins))
+            )
+            return
+
         seqs = self.background.seqs
 
-        lock.acquire()
+        def threshold_key(motif):
+            return "{}|{}|{:.4f}|{}".format(
+                motif.hash(), self.background_hash, fpr, ",".join(sorted(gc_bins))
+            )
+
+        keys = {threshold_key(motif): motif for motif in motifs}
+
+        def compute(missing):
+            logger.info("determining FPR-based threshold")
+            df = self._threshold_from_seqs(
+                [keys[k] for k in missing], seqs, fpr
+            ).set_index("gc_bin")
+            return {k: df[keys[k].id] for k in missing}
+
         try:
-            with Cache(CACHE_DIR) as cache:
-                scan_motifs = []
-                self._threshold = None
-                for motif in motifs:
-                    k = "{}|{}|{:.4f}|{}".format(
-                        motif.hash(),
-                        self.background_hash,
-                        fpr,
-                        ",".join(sorted(gc_bins)),
-                    )
-                    vals = cache.get(k)
-                    if vals is None:
-                        scan_motifs.append(motif)
-                    else:
-                        if self._threshold is None:
-                            self._threshold = vals.to_frame()
-                        else:
-                            self._threshold[motif.id] = vals
-
-                if len(scan_motifs) > 0:
-                    logger.info("determining FPR-based threshold")
-                    df = self._threshold_from_seqs(scan_motifs, seqs, fpr).set_index(
-                        "gc_bin"
-                    )
-                    if self._threshold is None:
-                        self._threshold = df
-                    else:
-                        self._threshold = pd.concat((self._threshold, df), axis=1)
-                    for motif in scan_motifs:
-                        k = "{}|{}|{:.4f}|{}".format(
-                            motif.hash(),
-                            self.background_hash,
-                            fpr,
-                            ",".join(sorted(gc_bins)),
-                        )
-                        cache.set(k, df[motif.id])
+            values = self.cache.get_or_compute(list(keys), compute)
         except sqlite3.DatabaseError:
             print_cluster_error_message()
             sys.exit(1)
-        lock.release()
+        self._threshold = pd.concat(
+            [values[threshold_key(motif)].rename(motif.id) for motif in motifs], axis=1
+        )
         self.threshold_str = "{}_{}_{}_{}".format(
             fpr, threshold, self.background_hash, ",".join(sorted(gc_bins))
         )
 
+    def _threshold_from_dp(self, motifs, fpr, gc_bins):
+        seqs = self.background.seqs
+        seq_bins = self.get_seq_bins(seqs) if len(gc_bins) > 1 else None
+
+        # Every GC% bin gets the composition and length of the background
+        # sequences in that bin, or of all sequences if the bin has none
+        models = []
+        for i in range(len(gc_bins)):
+            bin_seqs = seqs
+            if seq_bins is not None and np.any(seq_bins == i):
+                bin_seqs = [seq for seq, b in zip(seqs, seq_bins) if b == i]
+            composition = background_composition(bin_seqs, order=1)
+            seqlen = int(np.median([len(seq) for seq in bin_seqs]))
+            models.append((composition, composition_hash(composition), seqlen))
+
+        def threshold_key(motif, model):
+            _, comp_hash, seqlen = model
+            return "p{}|{}|{:.4f}|{}".format(motif.hash(), comp_hash, fpr, seqlen)
+
+        keys = {
+            threshold_key(motif, model): (motif, model)
+            for motif in motifs
+            for model in models
+        }
+
+        def compute(missing):
+            cutoffs = {}
+            for k in missing:
+                motif, (composition, _, seqlen) = keys[k]
+                pvalue = fpr_to_pvalue(fpr, seqlen, len(motif))
+                cutoff = pvalue_threshold(motif.logodds, pvalue, composition)
+                cutoffs[k] = np.nan if cutoff is None else cutoff
+            return cutoffs
+
+        try:
+            values = self.cache.get_or_compute(list(keys), compute)
+        except sqlite3.DatabaseError:
+            print_cluster_error_message()
+            sys.exit(1)
+
+        self._threshold = pd.DataFrame(
+            {
+                motif.id: [values[threshold_key(motif, model)] for model in models]
+                for motif in motifs
+            },
+            index=pd.Index(gc_bins, name="gc_bin"),
+        )
+
     def set_genome(self, genome):
         """
         set the genome to be used for:
@@ -1025,30 +2953,275 @@ class Scanner(object):
         count the number of matches above the cutoff
         returns an iterator of lists containing integer counts
         """
-        for matches in self.scan(seqs, nreport, scan_rc):
-            counts = [len(m) for m in matches]
-            yield counts
+        for batch in self._input_batches(seqs):
+            thresholds = self.get_gc_thresholds(batch)
+            for row in self._counts(batch, thresholds, nreport, scan_rc).tolist():
+                yield row
+
+    def count_matrix(self, seqs, nreport=100, scan_rc=True, sparse=False):
+        """Return the number of matches of each motif in each sequence.
+
+        Only the number of matches above the cutoff is determined, the
+        matches themselves are never stored.
+
+        Parameters
+        ----------
+        seqs : str, list, Fasta
+            Regions or sequences to scan, see as_fasta().
+
+        nreport : int, optional
+            Maximum number of matches to count per motif, 0 for no limit.
+
+        scan_rc : bool, optional
+            Also scan the reverse complement.
+
+        sparse : bool, optional
+            Return a sparse CSR matrix with unsigned integer counts. The
+            sequences are counted in batches, the dense counts are never
+            stored for all sequences.
+
+        Returns
+        -------
+        counts : numpy.ndarray or scipy.sparse.csr_matrix
+            Integer matrix of nseqs x nmotifs, in the order of self.motifs.
+        """
+        nmotifs = len(read_motifs(self.motifs))
+
+        def counts(batch):
+            thresholds = self.get_gc_thresholds(batch)
+            return self._counts(batch, thresholds, nreport, scan_rc)
+
+        if not sparse:
+            return self._scan_input(
+                seqs, nmotifs, lambda batch: [counts(batch)], [np.int64]
+            )[0]
+
+        return sparse_counts(
+            (
+                counts(part)
+                for batch in self._input_batches(seqs)
+                for _, part in _encoded_batches(batch, SPARSE_BATCH_SIZE)
+            ),
+            nmotifs,
+            nreport,
+        )
 
     def total_count(self, seqs, nreport=100, scan_rc=True):
         """
         count the number of matches above the cutoff
         returns an iterator of lists containing integer counts
         """
-
-        count_table = [counts for counts in self.count(seqs, nreport, scan_rc)]
-        return np.sum(np.array(count_table), 0)
+        return self.count_matrix(seqs, nreport, scan_rc).sum(0)
 
     def best_score(self, seqs, scan_rc=True, zscore=False, gc=False):
         """
         give the score of the best match of each motif in each sequence
         returns an iterator of lists containing floats
         """
-        self.set_threshold(threshold=0.0, gc=gc)
-        for matches in self.scan(seqs, 1, scan_rc, zscore=zscore, gc=gc):
-            scores = np.array(
-                [sorted(m, key=lambda x: x[0])[0][0] for m in matches if len(m) > 0]
+        if zscore:
+            self._init_meanstd(gc)
+
+        for batch in self._input_batches(seqs):
+            for row in self._best_scores(batch, scan_rc, zscore, np.float64):
+                yield row
+
+    def best_score_matrix(
+        self, seqs, scan_rc=True, zscore=False, gc=False, dtype=np.float32
+    ):
+        """Return the score of the best match of each motif in each sequence.
+
+        The input is read and scanned in batches, see _input_batches(), and
+        the scores are written to a preallocated matrix if the number of
+        sequences is known, see _scan_input(). When using multiple
+        cores the worker processes write the scores of a batch to a shared
+        memory-mapped matrix, so the scores never need to be pickled.
+
+        Parameters
+        ----------
+        seqs : str, list, Fasta
+            Regions or sequences to scan, see as_fasta().
+
+        scan_rc : bool, optional
+            Also scan the reverse complement.
+
+        zscore : bool, optional
+            Return z-scores, based on the motif scores in the background.
+
+        gc : bool, optional
+            Use GC% specific background scores for the z-score.
+
+        dtype : numpy dtype, optional
+            Data type of the matrix, for instance float32 or float16.
+
+        Returns
+        -------
+        scores : numpy.ndarray
+            Matrix of nseqs x nmotifs, in the order of self.motifs.
+        """
+        if zscore:
+            self._init_meanstd(gc)
+        return self._scan_input(
+            seqs,
+            len(read_motifs(self.motifs)),
+            lambda batch: [self._best_scores(batch, scan_rc, zscore, dtype)],
+            [dtype],
+        )[0]
+
+    def count_and_best_score(
+        self,
+        seqs,
+        nreport=100,
+        scan_rc=True,
+        zscore=False,
+        gc=False,
+        dtype=np.float32,
+        sparse=False,
+    ):
+        """Return both the number of matches and the best score of each motif
+        in each sequence.
+
+        The result is the same as count_matrix() and best_score_matrix(), but
+        the sequences are retrieved and scanned only once.
+
+        Parameters
+        ----------
+        seqs : str, list, Fasta
+            Regions or sequences to scan, see as_fasta().
+
+        nreport : int, optional
+            Maximum number of matches to count per motif, 0 for no limit.
+
+        scan_rc : bool, optional
+            Also scan the reverse complement.
+
+        zscore : bool, optional
+            Return z-scores, based on the motif scores in the background.
+
+        gc : bool, optional
+            Use GC% specific background scores for the z-score.
+
+        dtype : numpy dtype, optional
+            Data type of the score matrix, for instance float32 or float16.
+
+        sparse : bool, optional
+            Return the counts as a sparse CSR matrix, see count_matrix().
+
+        Returns
+        -------
+        counts : numpy.ndarray or scipy.sparse.csr_matrix
+            Integer matrix of nseqs x nmotifs, in the order of self.motifs.
+
+        scores : numpy.ndarray
+            Matrix of nseqs x nmotifs, in the order of self.motifs.
+        """
+        if zscore:
+            self._init_meanstd(gc)
+        motifs = read_motifs(self.motifs)
+        min_scores = np.array([m.pwm_min_score() for m in motifs])
+
+        def count_best(batch):
+            thresholds = self.get_gc_thresholds(batch, motifs)
+            cutoffs = [thresholds[m.id] for m in motifs]
+            cutoffs = np.array([np.inf if c is None else c for c in cutoffs])
+            if self.scan_cache is not None:
+                counts, scores = self._scan_cached(
+                    batch, motifs, scan_rc, cutoffs, nreport
+                )
+                if zscore:
+                    scores = self._zscore_scores(batch, motifs, scores)
+                return counts, scores.astype(dtype, copy=False)
+
+            return self._scan_matrix(
+                batch,
+                motifs,
+                scan_count_best_encoded,
+                [np.int64, dtype],
+                self._zscore_kwargs(batch, motifs) if zscore else None,
+                cutoffs=cutoffs,
+                min_scores=min_scores,
+                nreport=nreport,
+                scan_rc=scan_rc,
             )
-            yield scores
+
+        if not sparse:
+            return tuple(
+                self._scan_input(seqs, len(motifs), count_best, [np.int64, dtype])
+            )
+
+        scores = [np.empty((0, len(motifs)), dtype=dtype)]
+
+        def count_batches():
+            for batch in self._input_batches(seqs):
+                for _, part in _encoded_batches(batch, SPARSE_BATCH_SIZE):
+                    counts, part_scores = count_best(part)
+                    scores.append(part_scores)
+                    yield counts
+
+        counts = sparse_counts(count_batches(), len(motifs), nreport)
+        return counts, np.concatenate(scores)
+
+    def _input_batches(self, seqs):
+        """Yield regions or sequences as batches of encoded sequences, see
+        encode_seqs().
+
+        Regions are read from the memory-mapped genome cache, see
+        gimmemotifs.genome_cache. Other input is read with as_fasta_batches().
+        Only one batch of INPUT_BATCH_SIZE sequences is read at a time.
+        """
+        batch_size = INPUT_BATCH_SIZE
+        if isinstance(seqs, tuple):
+            for _, batch in _encoded_batches(seqs, batch_size):
+                yield batch
+        elif self.genome is not None and is_region_list(seqs):
+            genome_cache = get_genome_cache(self.genome)
+            for i in range(0, len(seqs), batch_size):
+                yield genome_cache.encode_regions(seqs[i : i + batch_size])
+        else:
+            for fa in as_fasta_batches(seqs, genome=self.genome, batch_size=batch_size):
+                yield encode_seqs(fa.seqs)
+
+    def _scan_input(self, seqs, nmotifs, scan, dtypes):
+        """Scan the input batch by batch, see _input_batches().
+
+        Parameters
+        ----------
+        seqs : str, list, Fasta or tuple
+            Regions or sequences to scan.
+
+        nmotifs : int
+            Number of motifs.
+
+        scan : callable
+            Function that returns the matrices of a batch of encoded
+            sequences, one for every data type.
+
+        dtypes : list
+            Data type of every matrix.
+
+        Returns
+        -------
+        list
+            Matrices of nseqs x nmotifs. If the number of sequences is known
+            in advance, see _input_size(), the rows of every batch are written
+            to preallocated matrices. Otherwise the matrices of the batches
+            are concatenated.
+        """
+        nseqs = _input_size(seqs)
+        if nseqs is None:
+            out = [[np.empty((0, nmotifs), dtype=dtype)] for dtype in dtypes]
+            for batch in self._input_batches(seqs):
+                for arrs, rows in zip(out, scan(batch)):
+                    arrs.append(rows)
+            return [np.concatenate(arrs) for arrs in out]
+
+        out = [np.empty((nseqs, nmotifs), dtype=dtype) for dtype in dtypes]
+        start = 0
+        for batch in self._input_batches(seqs):
+            end = start + len(batch[1]) - 1
+            for arr, rows in zip(out, scan(batch)):
+                arr[start:end] = rows
+            start = end
+        return out
 
     def best_match(self, seqs, scan_rc=True, zscore=False, gc=False):
         """
@@ -1060,22 +3233,367 @@ class Scanner(object):
         for matches in self.scan(seqs, 1, scan_rc, zscore=zscore, gc=gc):
             yield [m[0] for m in matches]
 
-    def get_seq_bin(self, seq):
-        if len(str(seq)) == 0:
-            gc = 0
-        else:
-            useq = seq.upper()
-            gc = round((useq.count("G") + useq.count("C")) / len(useq), 2)
-        if gc == 0:
-            gc = 0.01
-        for b_start, b_end in self.gc_bins:
-            if gc > round(b_start, 2) and gc <= round(b_end, 2):
-                return "{:.2f}-{:.2f}".format(b_start, b_end)
-
-        logger.error(
-            "Error determining seq: {}, bins: {}".format(seq, str(self.gc_bins))
+    def _best_scores(self, seqs, scan_rc, zscore=False, dtype=np.float32):
+        """Return a matrix with the best score of every motif in seqs."""
+        motifs = read_motifs(self.motifs)
+        if self.scan_cache is not None:
+            scores = self._scan_cached(seqs, motifs, scan_rc)[0]
+            if zscore:
+                scores = self._zscore_scores(seqs, motifs, scores)
+            return scores.astype(dtype, copy=False)
+
+        min_scores = np.array([m.pwm_min_score() for m in motifs])
+        return self._scan_matrix(
+            seqs,
+            motifs,
+            scan_best_encoded,
+            dtype,
+            self._zscore_kwargs(seqs, motifs) if zscore else None,
+            min_scores=min_scores,
+            scan_rc=scan_rc,
+        )
+
+    def _meanstd_arrays(self, motifs, seq_bins):
+        """Return the background mean and std of every motif, for the GC%
+        bins that occur in seq_bins.
+
+        Returns
+        -------
+        bins : numpy.ndarray
+            Row of the GC% bin of every sequence in mean and std.
+
+        mean, std : numpy.ndarray
+            Arrays of nbins x nmotifs.
+        """
+        bin_idx, bins = np.unique(seq_bins, return_inverse=True)
+        bin_names = np.array(self.gc_bin_names())[bin_idx]
+        meanstd = np.array(
+            [[self.get_motif_mean_std(b, m.id) for m in motifs] for b in bin_names]
+        ).reshape(len(bin_names), len(motifs), 2)
+        return bins.astype(np.int64), meanstd[:, :, 0], meanstd[:, :, 1]
+
+    def _zscore_kwargs(self, seqs, motifs, seq_bins=None):
+        """Return a job_kwargs function with the background mean and std of
+        every motif, for the GC% bin of every sequence."""
+        if seq_bins is None:
+            seq_bins = self.get_seq_bins(seqs)
+        bins, mean, std = self._meanstd_arrays(motifs, seq_bins)
+
+        def zscore_kwargs(start, end):
+            return {"zscore": (bins[start:end], mean, std)}
+
+        return zscore_kwargs
+
+    def _zscore_scores(self, seqs, motifs, scores, seq_bins=None):
+        """Convert a matrix of best scores of seqs to z-scores."""
+        zscore = self._zscore_kwargs(seqs, motifs, seq_bins)(0, len(seqs[1]) - 1)
+        _, motif_offsets = motif_tensor(motifs)
+        min_scores = np.array([m.pwm_min_score() for m in motifs])
+        return _zscore_best(scores, seqs[1], motif_offsets, min_scores, **zscore)
+
+    def _scan_cached(self, seqs, motifs, scan_rc, cutoffs=None, nreport=None):
+        """Return the counts and best scores of seqs, using the scan cache.
+
+        Only the sequences and motifs that are not in the cache are scanned.
+
+        Parameters
+        ----------
+        seqs : tuple
+            Encoded sequences, as returned by encode_seqs().
+
+        motifs : list
+            List of Motif instances.
+
+        scan_rc : bool
+            Also scan the reverse complement.
+
+        cutoffs : numpy.ndarray, optional
+            Cutoff for every motif. If this is None, only the scores are
+            returned.
+
+        nreport : int, optional
+            Maximum number of matches to count.
+
+        Returns
+        -------
+        list
+            Matrices of nseqs x nmotifs with the int64 counts (if cutoffs is
+            specified) and the float64 best scores, not as z-scores.
+        """
+        keys = []
+        dtypes = []
+        if cutoffs is not None:
+            keys.append(
+                [count_key(m, c, nreport, scan_rc) for m, c in zip(motifs, cutoffs)]
+            )
+            dtypes.append(np.int64)
+        keys.append([score_key(m, scan_rc) for m in motifs])
+        dtypes.append(np.float64)
+
+        def scan(seq_idx, motif_idx):
+            batch = _encoded_take(seqs, seq_idx)
+            batch_motifs = [motifs[i] for i in motif_idx]
+            min_scores = np.array([m.pwm_min_score() for m in batch_motifs])
+            if cutoffs is None:
+                return [
+                    self._scan_matrix(
+                        batch,
+                        batch_motifs,
+                        scan_best_encoded,
+                        np.float64,
+                        min_scores=min_scores,
+                        scan_rc=scan_rc,
+                    )
+                ]
+            return self._scan_matrix(
+                batch,
+                batch_motifs,
+                scan_count_best_encoded,
+                [np.int64, np.float64],
+                cutoffs=cutoffs[motif_idx],
+                min_scores=min_scores,
+                nreport=nreport,
+                scan_rc=scan_rc,
+            )
+
+        return self.scan_cache.lookup(seq_hashes(*seqs), keys, dtypes, scan)
+
+    def _counts(self, seqs, thresholds, nreport, scan_rc):
+        """Return a matrix with the number of matches of every motif in seqs."""
+        motifs = read_motifs(self.motifs)
+        cutoffs = [thresholds[m.id] for m in motifs]
+        cutoffs = np.array([np.inf if c is None else c for c in cutoffs])
+        if self.scan_cache is not None:
+            return self._scan_cached(seqs, motifs, scan_rc, cutoffs, nreport)[0]
+
+        return self._scan_matrix(
+            seqs,
+            motifs,
+            scan_count_encoded,
+            np.int64,
+            cutoffs=cutoffs,
+            min_scores=np.array([m.pwm_min_score() for m in motifs]),
+            nreport=nreport,
+            scan_rc=scan_rc,
         )
-        raise ValueError()
+
+    def _scan_matrix(self, seqs, motifs, func, dtype, job_kwargs=None, **kwargs):
+        """Scan sequences with func, which fills a matrix of nseqs x nmotifs.
+
+        Parameters
+        ----------
+        seqs : list or tuple
+            List of sequences, or encoded sequences as returned by
+            encode_seqs().
+
+        motifs : list
+            List of Motif instances.
+
+        func : callable
+            Function that fills the matrix for a batch of encoded sequences,
+            such as scan_best_encoded() or scan_count_encoded(). It gets the
+            super-alphabet tables as kmer_tables keyword argument if these
+            are used, see _kmer_tables(). Otherwise it gets the keyword
+            arguments of the kernel, see kernel_kwargs().
+
+        dtype : numpy dtype or list
+            Data type of the matrix. If this is a list, func fills a tuple of
+            matrices, one for every data type.
+
+        job_kwargs : callable, optional
+            Function that returns the keyword arguments for func that are
+            specific for the sequences from start to end.
+
+        **kwargs
+            Other keyword arguments for func.
+
+        Returns
+        -------
+        numpy.ndarray or tuple
+            Matrix (or tuple of matrices) of nseqs x nmotifs.
+        """
+        dtypes = dtype if isinstance(dtype, list) else [dtype]
+        seqs = _encoded(seqs)
+        nseqs = len(seqs[1]) - 1
+        shape = (nseqs, len(motifs))
+
+        def select(arrays, start, end):
+            rows = tuple(arr[start:end] for arr in arrays)
+            return rows if isinstance(dtype, list) else rows[0]
+
+        matrix, motif_offsets = motif_tensor(motifs)
+        kernel_args = kernel_kwargs(self.kernel, func)
+        kmer_tables = None
+        if nseqs > 0 and len(motifs) > 0:
+            if not kernel_args or self.kernel in KMER_FIRST_KERNELS:
+                kmer_tables = self._kmer_tables(motifs)
+            if kmer_tables is not None:
+                kernel_args = {}
+        kwargs.update(kernel_args)
+
+        if nseqs > 0 and len(motifs) > 0 and self.ncpus > 1:
+            if shared_memory is not None:
+                out = self._scan_matrix_shared(
+                    seqs,
+                    matrix,
+                    motif_offsets,
+                    func,
+                    shape,
+                    dtypes,
+                    job_kwargs or _no_job_kwargs,
+                    kwargs,
+                    kmer_tables,
+                )
+                return select(out, 0, nseqs)
+
+        if kmer_tables is not None:
+            kwargs["kmer_tables"] = kmer_tables
+
+        out = [np.empty(shape, dtype=d) for d in dtypes]
+        if nseqs == 0 or len(motifs) == 0:
+            return select(out, 0, nseqs)
+
+        if job_kwargs is None:
+            job_kwargs = _no_job_kwargs
+
+        bounds = self._seq_bounds(seqs)
+        if self.ncpus > 1:
+            scan_func = partial(
+                scan_matrix_batch,
+                func=func,
+                matrix=matrix,
+                motif_offsets=motif_offsets,
+                dtype=dtype,
+                **kwargs,
+            )
+            jobs = (
+                (_encoded_slice(seqs, start, end), job_kwargs(start, end))
+                for start, end in bounds
+            )
+            for (start, end), result in zip(bounds, self._run_jobs(scan_func, jobs)):
+                if not isinstance(dtype, list):
+                    result = (result,)
+                for arr, rows in zip(out, result):
+                    arr[start:end] = rows
+            return select(out, 0, nseqs)
+
+        for start, end in bounds:
+            func(
+                *_encoded_slice(seqs, start, end),
+                matrix,
+                motif_offsets,
+                out=select(out, start, end),
+                **job_kwargs(start, end),
+                **kwargs,
+            )
+        return select(out, 0, nseqs)
+
+    def _scan_matrix_shared(
+        self,
+        seqs,
+        matrix,
+        motif_offsets,
+        func,
+        shape,
+        dtypes,
+        job_kwargs,
+        kwargs,
+        kmer_tables=None,
+    ):
+        """Fill matrices with the worker pool, using shared memory.
+
+        The workers write to memory-mapped files in /dev/shm (if available).
+        The files are removed when all jobs are done, the returned matrices
+        stay valid as long as they are referenced. The super-alphabet tables
+        are shared with the motifs.
+        """
+        tmpdir = "/dev/shm" if os.access("/dev/shm", os.W_OK) else mytmpdir()
+        fnames = []
+        for _ in dtypes:
+            fd, fname = mkstemp(prefix="gimme.", suffix=".matrix", dir=tmpdir)
+            os.close(fd)
+            fnames.append(fname)
+
+        shms, seq_specs = zip(*[_share_array(arr) for arr in seqs])
+        try:
+            motif_specs = self._share_motifs(
+                matrix, motif_offsets, *(kmer_tables or ())
+            )
+            out = [
+                np.memmap(fname, dtype=dtype, mode="w+", shape=shape)
+                for fname, dtype in zip(fnames, dtypes)
+            ]
+            specs = [(fname, shape, arr.dtype.str) for fname, arr in zip(fnames, out)]
+            scan_func = partial(
+                scan_matrix_shared,
+                func=func,
+                seqs=seq_specs,
+                motifs=motif_specs,
+                out=specs if len(specs) > 1 else specs[0],
+                **kwargs,
+            )
+            jobs = (
+                ((start, end), job_kwargs(start, end))
+                for start, end in self._seq_bounds(seqs)
+            )
+            for _ in self._run_jobs(scan_func, jobs):
+                pass
+        finally:
+            for fname in fnames:
+                os.unlink(fname)
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+        return [arr.view(np.ndarray) for arr in out]
+
+    def get_seq_bin(self, seq):
+        return self.gc_bin_names()[self.get_seq_bins([seq])[0]]
+
+    def gc_bin_names(self):
+        """Return the names of the GC% bins, in the order of self.gc_bins."""
+        return ["{:.2f}-{:.2f}".format(*gc_bin) for gc_bin in self.gc_bins]
+
+    def get_seq_bins(self, seqs):
+        """Return the GC% bin of every sequence.
+
+        The GC% of all sequences is determined in one pass over the encoded
+        sequences, the bins are assigned with a binary search.
+
+        Parameters
+        ----------
+        seqs : list or tuple
+            List of sequences, or encoded sequences as returned by
+            encode_seqs().
+
+        Returns
+        -------
+        numpy.ndarray
+            Index of the GC% bin of every sequence in self.gc_bins.
+        """
+        gc_frac = gc_content(*_encoded(seqs))
+        gc = np.round(gc_frac, 2)
+        # np.round() and round() can differ for (near) ties, use round()
+        ties = np.abs(gc_frac * 100 % 1 - 0.5) < 1e-6
+        gc[ties] = [round(x, 2) for x in gc_frac[ties]]
+        gc[gc == 0] = 0.01
+
+        starts = np.array([round(b_start, 2) for b_start, _ in self.gc_bins])
+        ends = np.array([round(b_end, 2) for _, b_end in self.gc_bins])
+        order = np.argsort(ends, kind="stable")
+        idx = np.searchsorted(ends[order], gc, side="left")
+        bins = order[np.minimum(idx, len(order) - 1)]
+
+        invalid = (idx == len(order)) | (gc <= starts[bins])
+        if invalid.any():
+            seq = np.flatnonzero(invalid)[0]
+            if not isinstance(seqs, tuple):
+                seq = seqs[seq]
+            logger.error(
+                "Error determining seq: {}, bins: {}".format(seq, str(self.gc_bins))
+            )
+            raise ValueError()
+        return bins
 
     def get_motif_mean_std(self, gc_bin, motif):
         if gc_bin in self.meanstd:
@@ -1104,139 +3622,384 @@ class Scanner(object):
             self.meanstd[gc_bin] = self.meanstd[bstr]
         return self.meanstd[gc_bin][motif]
 
+    def _init_meanstd(self, gc):
+        """Determine the motif score mean and stddev, if not done yet."""
+        if gc:
+            if len(self.meanstd) <= 1:
+                self.set_meanstd(gc=gc)
+        else:
+            if len(self.meanstd) != 1:
+                self.set_meanstd(gc=gc)
+
     def scan(self, seqs, nreport=100, scan_rc=True, zscore=False, gc=False):
         """
         Scan a set of regions or sequences.
         """
-        seqs = as_fasta(seqs, genome=self.genome)
         if zscore:
-            if gc:
-                if len(self.meanstd) <= 1:
-                    self.set_meanstd(gc=gc)
-            else:
-                if len(self.meanstd) != 1:
-                    self.set_meanstd(gc=gc)
+            self._init_meanstd(gc)
 
-        batch_size = 50000
         logger.debug("Scanning")
-        for batch_idx in range(0, len(seqs), batch_size):
-            it = self._scan_sequences(
-                seqs.seqs[batch_idx : batch_idx + batch_size],
-                nreport,
-                scan_rc,
-                zscore=zscore,
-            )
+        for fa in as_fasta_batches(seqs, genome=self.genome, batch_size=50000):
+            it = self._scan_sequences(fa.seqs, nreport, scan_rc, zscore=zscore)
             for result in it:
                 yield result
 
-    def get_gc_thresholds(self, seqs, motifs=None, zscore=False):
-        # Simple case, only one threshold
-        if np.all(self.threshold.nunique(axis=0) == 1):
-            return self.threshold.iloc[0].to_dict()
+    def scan_genome(self, scan_rc=True, chunk_size=GENOME_CHUNK_SIZE):
+        """
+        Scan the complete genome, in chunks of chunk_size nucleotides, with
+        the kernel of set_kernel(). Returns an iterator of (chromosome, hits)
+        tuples in genome order, see scan_genome_chunk().
+        """
+        if self.genome is None:
+            raise ValueError("please run set_genome() first")
+
+        motifs = read_motifs(self.motifs)
+        # The background sequences have the GC% distribution of the genome
+        seqs = self.background.seqs if self.background else []
+        thresholds = self.get_gc_thresholds(seqs, motifs=motifs)
+        cutoffs = np.array(
+            [np.inf if thresholds[m.id] is None else thresholds[m.id] for m in motifs]
+        )
+        matrix, motif_offsets = motif_tensor(motifs)
+        overlap = max(len(m) for m in motifs) - 1
+
+        genome_cache = get_genome_cache(self.genome)
+        if self.ncpus > 1 and shared_memory is not None:
+            scan_motifs = self._share_motifs(matrix, motif_offsets)
+        else:
+            scan_motifs = (matrix, motif_offsets)
+        chunks = genome_chunks(
+            zip(genome_cache.chroms, genome_cache.sizes.tolist()), chunk_size, overlap
+        )
+        scan_func = partial(
+            scan_genome_chunk,
+            genome=self.genome,
+            motifs=scan_motifs,
+            cutoffs=cutoffs,
+            scan_rc=scan_rc,
+            chunk_size=chunk_size,
+            **kernel_kwargs(self.kernel, scan_encoded_batch),
+        )
+
+        logger.debug("Scanning genome")
+        for result in self._run_jobs(scan_func, ((chunk,) for chunk in chunks)):
+            yield result
+
+    def get_gc_thresholds(self, seqs, motifs=None, zscore=False, seq_bins=None):
+        """Return the threshold of every motif for sequences.
+
+        If the thresholds depend on the GC%, the threshold is the (1 - FPR)
+        quantile of the background scores, where the scores of every GC% bin
+        are weighted by the number of sequences in that bin. Thresholds are
+        memoised on the number of sequences per GC% bin.
+
+        Parameters
+        ----------
+        seqs : list
+            List of sequences, or encoded sequences as returned by
+            encode_seqs(). Not used if seq_bins is specified.
+
+        motifs : list, optional
+            List of Motif instances, by default self.motifs.
 
-        if motifs is None:
-            motifs = read_motifs(self.motifs)
-        seq_gc_bins = [self.get_seq_bin(seq) for seq in seqs]
+        zscore : bool, optional
+            Use thresholds based on the z-scores of the background scores.
 
-        gc_bin_count = Counter(seq_gc_bins)
+        seq_bins : numpy.ndarray, optional
+            GC% bin of every sequence, as returned by get_seq_bins().
+
+        Returns
+        -------
+        dict
+            Threshold per motif id, None if no score is above the threshold.
+        """
+        # Simple case, only one threshold
+        single = self._single_threshold()
+        if single is not None:
+            return single.copy()
+
+        if seq_bins is None:
+            seq_bins = self.get_seq_bins(seqs)
+
+        bin_count = np.bincount(seq_bins, minlength=len(self.gc_bins))
+        key = (zscore, tuple(self.gc_bin_names()), tuple(bin_count))
+        if key not in self._gc_thresholds:
+            if motifs is None:
+                motifs = read_motifs(self.motifs)
+            cutoffs = self._mixture_thresholds(bin_count, zscore)
+            maxt = {m.id: m.pwm_max_score() for m in motifs}
+            self._gc_thresholds[key] = {
+                motif: (val if val < maxt[motif] else None)
+                for motif, val in zip(self.threshold.columns, cutoffs.tolist())
+            }
+        return self._gc_thresholds[key].copy()
+
+    def _single_threshold(self):
+        """Return the threshold per motif id if it is the same for all GC%
+        bins, otherwise None."""
+        if "single" not in self._gc_thresholds:
+            threshold = self.threshold
+            single = None
+            if np.all(threshold.nunique(axis=0, dropna=False) == 1):
+                t = threshold.iloc[0]
+                single = t.where(t.notnull(), None).to_dict()
+            self._gc_thresholds["single"] = single
+        return self._gc_thresholds["single"]
+
+    def _sorted_thresholds(self, zscore):
+        """Return the sorted background scores of every motif.
+
+        Returns
+        -------
+        scores : numpy.ndarray
+            Background scores, every column sorted, nscores x nmotifs.
+
+        bins : numpy.ndarray
+            Index of the GC% bin of every score in self.gc_bins, -1 for
+            bins that are not in self.gc_bins.
+
+        nbin : numpy.ndarray
+            Number of background scores per GC% bin.
+        """
+        key = (zscore, tuple(self.gc_bin_names()))
+        if key not in self._gc_thresholds:
+            names = {name: i for i, name in enumerate(self.gc_bin_names())}
+            row_bins = np.array([names.get(b, -1) for b in self.threshold.index])
+            scores = self.threshold.values.astype(float)
+            if zscore:
+                # Scale the scores per GC% bin, same as sklearn's scale()
+                for b in np.unique(row_bins):
+                    rows = row_bins == b
+                    std = scores[rows].std(axis=0)
+                    std[std == 0] = 1
+                    scores[rows] = (scores[rows] - scores[rows].mean(axis=0)) / std
+
+            order = np.argsort(scores, axis=0, kind="stable")
+            nbin = np.bincount(row_bins[row_bins >= 0], minlength=len(self.gc_bins))
+            self._gc_thresholds[key] = (
+                np.take_along_axis(scores, order, axis=0),
+                row_bins[order],
+                nbin,
+            )
+        return self._gc_thresholds[key]
+
+    def _mixture_thresholds(self, bin_count, zscore):
+        """Return the (1 - FPR) quantile of the background scores of every
+        motif, with the GC% bins weighted by bin_count."""
+        scores, bins, nbin = self._sorted_thresholds(zscore)
+
+        present = (bin_count > 0) & (nbin > 0)
+        if np.any((bin_count > 0) & (nbin == 0)):
+            logger.warning(
+                "GC% of some sequences is not present in the background, "
+                "thresholds are based on the other GC% bins"
+            )
+        if not present.any():
+            # Use all background scores
+            present = nbin > 0
+            bin_count = np.ones(len(nbin))
+
+        # Every background score in a bin gets the same weight, the total
+        # weight of a bin is proportional to the number of sequences.
+        bin_weight = np.zeros(len(nbin) + 1)
+        bin_weight[:-1][present] = bin_count[present] / nbin[present]
+        weights = bin_weight[bins]
+
+        # The threshold is the lowest score where the cumulative weight is
+        # above the quantile.
+        cumulative = np.cumsum(weights, axis=0)
+        total = cumulative[-1]
+        q = 1 - self._threshold_fpr
+        above = cumulative > q * total + 1e-9 * total
+        return scores[np.argmax(above, axis=0), np.arange(scores.shape[1])]
+
+    def _scan_sequences_with_motif(
+        self, motifs, seqs, nreport, scan_rc, seq_bins=None, zscore=False, kernel=None
+    ):
+        cutoffs = np.array([np.inf if c is None else c for _, c in motifs])
+        matrix, motif_offsets = motif_tensor([m for m, _ in motifs])
+        # Upper bound of the size of the result for one sequence
+        result_bytes = len(motifs) * (8 + 17 * nreport)
+        kernel_args = kernel_kwargs(kernel, scan_seq_batch)
 
-        _threshold = self.threshold
+        meanstd = None
         if zscore:
-            grouped = _threshold.groupby(_threshold.index).apply(scale, axis=0)
-            _threshold = pd.DataFrame(
-                np.vstack(grouped.values),
-                index=_threshold.index,
-                columns=_threshold.columns,
+            # The cutoffs are z-scores, the kernel converts the scores
+            if seq_bins is None:
+                seq_bins = self.get_seq_bins(seqs)
+            meanstd = self._meanstd_arrays([m for m, _ in motifs], seq_bins)
+
+        if self.ncpus > 1 and shared_memory is not None:
+            it = self._scan_shared(
+                seqs,
+                matrix,
+                motif_offsets,
+                cutoffs,
+                nreport,
+                scan_rc,
+                result_bytes,
+                meanstd,
+                kernel_args,
+            )
+        else:
+            scan_func = partial(
+                scan_seq_batch,
+                matrix=matrix,
+                motif_offsets=motif_offsets,
+                cutoffs=cutoffs,
+                nreport=nreport,
+                scan_rc=scan_rc,
+                zscore=None if meanstd is None else meanstd[1:],
+                **kernel_args,
             )
 
-        nseqs = int(20000 / np.sum(list(gc_bin_count.values())))
-        t = {}
-        maxt = pd.Series([m.pwm_max_score() for m in motifs], index=_threshold.columns)
-        # We do this in a loop as the DataFrame will get too big to fit in memory
-        # when the difference between the number of sequences per gc_bin is very
-        # high.
-        _threshold = _threshold.reset_index()
-        idx = np.hstack(
-            [
-                _threshold[_threshold[_threshold.columns[0]] == gc_bin]
-                .sample(nseqs * count, replace=True, random_state=42)
-                .index.values
-                for gc_bin, count in gc_bin_count.items()
-            ]
-        )
-        for motif in _threshold.columns[1:]:
-            val = _threshold.loc[idx, motif].quantile(0.99, interpolation="higher")
-            if val < maxt.loc[motif]:
-                t[motif] = val
-            else:
-                t[motif] = None
-        return t
+            def job_bytes(args):
+                batch_seqs = args[0]
+                return len(batch_seqs) * result_bytes + sum(map(len, batch_seqs))
 
-    def _scan_sequences_with_motif(self, motifs, seqs, nreport, scan_rc):
-        scan_func = partial(
-            scan_seq_mult, motifs=motifs, nreport=nreport, scan_rc=scan_rc
-        )
-        for ret in self._scan_jobs(scan_func, seqs):
-            yield ret[1]
+            if meanstd is None:
+                it = self._scan_jobs(
+                    scan_func, seqs, sizeof=job_bytes, seq_bins=seq_bins
+                )
+            else:
+                bins = meanstd[0]
+                chunksize = self._chunksize(seqs)
+                jobs = (
+                    (seqs[i : i + chunksize], bins[i : i + chunksize])
+                    for i in range(0, len(seqs), chunksize)
+                )
+                it = self._run_jobs(scan_func, jobs, sizeof=job_bytes)
+
+        for result in it:
+            for matches in batch_to_matches(result, motifs, nreport):
+                yield matches
+
+    def _scan_shared(
+        self,
+        seqs,
+        matrix,
+        motif_offsets,
+        cutoffs,
+        nreport,
+        scan_rc,
+        result_bytes,
+        zscore=None,
+        kernel_args=None,
+    ):
+        """Scan sequences with the worker pool, using shared memory.
+
+        The sequences are encoded once and copied to shared memory, together
+        with the motifs. Jobs only contain the indices of the sequences to
+        scan, so almost nothing needs to be pickled. The results take at most
+        result_bytes per sequence. For z-scores, zscore is a tuple of (bins,
+        mean, std), see scan_encoded_batch(), which is shared as well. The
+        kernel is selected with kernel_args, see kernel_kwargs().
+        """
+        arrays = list(encode_seqs(seqs))
+        if zscore is not None:
+            arrays += list(zscore)
+        shms, specs = zip(*[_share_array(arr) for arr in arrays])
+        try:
+            scan_func = partial(
+                scan_shared_batch,
+                seqs=specs[:2],
+                motifs=self._share_motifs(matrix, motif_offsets),
+                cutoffs=cutoffs,
+                nreport=nreport,
+                scan_rc=scan_rc,
+                zscore=None if zscore is None else specs[2:],
+                **(kernel_args or {}),
+            )
+            chunksize = self._chunksize(seqs)
+            bounds = (
+                ((i, min(i + chunksize, len(seqs))),)
+                for i in range(0, len(seqs), chunksize)
+            )
+            for result in self._run_jobs(
+                scan_func,
+                bounds,
+                sizeof=lambda args: (args[0][1] - args[0][0]) * result_bytes,
+            ):
+                yield result
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
 
     def _scan_sequences(self, seqs, nreport, scan_rc, zscore=False):
-        thresholds = self.get_gc_thresholds(seqs, zscore=zscore)
+        seq_bins = self.get_seq_bins(seqs)
+        thresholds = self.get_gc_thresholds(seqs, zscore=zscore, seq_bins=seq_bins)
         motifs = [(m, thresholds[m.id]) for m in read_motifs(self.motifs)]
-        motifs_meanstd = None
-        if zscore:
-            motifs_meanstd = self.meanstd
+
+        if nreport > 0:
+            for matches in self._scan_sequences_with_motif(
+                motifs,
+                seqs,
+                nreport,
+                scan_rc,
+                seq_bins,
+                zscore=zscore,
+                kernel=self.kernel,
+            ):
+                yield matches
+            return
 
         scan_func = partial(
             scan_seq_mult,
             motifs=motifs,
             nreport=nreport,
             scan_rc=scan_rc,
-            motifs_meanstd=motifs_meanstd,
+            motifs_meanstd=self.meanstd,
             zscore=zscore,
         )
-        for _, ret in self._scan_jobs(scan_func, seqs):
-            yield ret
-
-    def _scan_jobs(self, scan_func, scan_seqs):
-        if self.ncpus > 1:
-            median_len = np.median([len(x) for x in scan_seqs])
-            chunksize = 200000 // int(median_len)  # 1000 seqs for len 200
-            # prepare for parallel processing
-            k = 0
-            max_queue_size = 2 * self.ncpus
-            jobs = []
-
-            # loop over each job/chunk, and keep adding them to the queue
-            for i in range(math.ceil(len(scan_seqs) / chunksize)):
-                batch_seqs = scan_seqs[i * chunksize : (i + 1) * chunksize]
-                seq_gc_bins = [self.get_seq_bin(seq) for seq in batch_seqs]
-                job = self.pool.apply_async(scan_func, (batch_seqs, seq_gc_bins))
-                jobs.append(job)
-
-                # if our queue is full, wait until oldest job finishes
-                while (len(jobs) >= max_queue_size) and not jobs[0].ready():
-                    time.sleep(0.05)
-
-                # resolve oldest job if finished
-                if jobs[0].ready():
-                    for ret in jobs[0].get():
-                        region = scan_seqs[k]
-                        k += 1
-                        yield region, ret
-                    jobs = jobs[1:]
-
-            # cleanup the last jobs that did not get resolved in the for loop
-            while len(jobs) > 0:
-                for ret in jobs[0].get():
-                    region = scan_seqs[k]
-                    yield region, ret
-                jobs = jobs[1:]
+        for result in self._scan_jobs(scan_func, seqs, seq_bins=seq_bins):
+            for matches in result:
+                yield matches
+
+    def _chunksize(self, seqs):
+        """Number of sequences per job for the worker pool."""
+        if isinstance(seqs, tuple):
+            median_len = np.median(np.diff(seqs[1]))
         else:
-            # non-parallel job scanning
-            batchsize = 1000
-            for i in range((len(scan_seqs) - 1) // batchsize + 1):
-                batch_seqs = scan_seqs[i * batchsize : (i + 1) * batchsize]
-                seq_gc_bins = [self.get_seq_bin(seq) for seq in batch_seqs]
-
-                for _j, ret in enumerate(scan_func(batch_seqs, seq_gc_bins)):
-                    yield scan_seqs[i], ret
+            median_len = np.median([len(x) for x in seqs])
+        return max(1, 200000 // max(1, int(median_len)))  # 1000 seqs for len 200
+
+    def _seq_bounds(self, seqs):
+        """Split sequences in chunks, return the (start, end) of every chunk."""
+        nseqs = len(seqs[1]) - 1 if isinstance(seqs, tuple) else len(seqs)
+        chunksize = self._chunksize(seqs)
+        return [(i, min(i + chunksize, nseqs)) for i in range(0, nseqs, chunksize)]
+
+    def _seq_chunks(self, seqs, seq_bins=None):
+        """Split sequences in chunks, with the GC% bin of every sequence."""
+        if seq_bins is None:
+            seq_bins = self.get_seq_bins(seqs)
+        bin_names = np.array(self.gc_bin_names())
+        chunksize = self._chunksize(seqs)
+        for i in range(0, len(seqs), chunksize):
+            yield seqs[i : i + chunksize], bin_names[
+                seq_bins[i : i + chunksize]
+            ].tolist()
+
+    def _run_jobs(self, func, jobs, sizeof=None):
+        """Run func with every tuple of arguments in jobs on the worker pool.
+
+        Results are yielded in the order of the jobs. The number of jobs in
+        flight is limited by max_jobs and, if sizeof() is given to estimate
+        the memory of a job, by max_inflight_bytes. With one cpu the jobs are
+        run serially.
+        """
+        if self.ncpus > 1:
+            return imap_ordered(
+                func,
+                jobs,
+                pool=self.pool,
+                max_jobs=self.max_jobs,
+                max_bytes=None if sizeof is None else self.max_inflight_bytes,
+                sizeof=sizeof,
+            )
+        return imap_ordered(func, jobs)
+
+    def _scan_jobs(self, scan_func, scan_seqs, sizeof=None, seq_bins=None):
+        """Run scan_func on chunks of sequences and yield the result per chunk."""
+        return self._run_jobs(scan_func, self._seq_chunks(scan_seqs, seq_bins), sizeof)
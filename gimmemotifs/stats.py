@@ -1,5 +1,4 @@
 """Calculate motif enrichment statistics."""
-from multiprocessing import Pool
 import logging
 
 import numpy as np
@@ -10,6 +9,7 @@ from gimmemotifs import rocmetrics
 from gimmemotifs.scanner import scan_to_best_match, Scanner
 from gimmemotifs.motif import read_motifs, Motif
 from gimmemotifs.config import MotifConfig
+from gimmemotifs.pool import get_pool
 from gimmemotifs.utils import pfmfile_location
 
 logger = logging.getLogger("gimme.stats")
@@ -256,8 +256,7 @@ def _single_stats(motifs, stats, fg_total, bg_total):
 
 
 def _mp_stats(motifs, stats, fg_total, bg_total, ncpus):
-    # Initialize multiprocessing pool
-    pool = Pool(ncpus, maxtasksperchild=1000)
+    pool = get_pool(ncpus)
 
     jobs = []
     for motif in motifs:
@@ -277,8 +276,6 @@ def _mp_stats(motifs, stats, fg_total, bg_total, ncpus):
 
             j = pool.apply_async(func, (fg, bg))
             jobs.append([str(motif), s, j])
-    pool.close()
-    pool.join()
 
     for motif_id, s, job in jobs:
         ret = job.get()
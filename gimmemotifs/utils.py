@@ -23,7 +23,9 @@ from tempfile import NamedTemporaryFile
 # External imports
 import pyfaidx
 from scipy import special
+from scipy.sparse import csr_matrix
 import numpy as np
+import pandas as pd
 import pybedtools
 
 from genomepy import Genome
@@ -514,6 +516,7 @@ def get_seqs_type(seqs):
 
 # Regular expression to check for region (chr:start-end or genome@chr:start-end)
 region_p = re.compile(r"^[^@]+@([^\s]+):(\d+)-(\d+)$")
+interval_p = re.compile(r"^([^\s]+):(\d+)-(\d+)")
 
 
 def _check_minsize(fa, minsize):
@@ -715,6 +718,240 @@ def as_fasta(to_convert, genome=None, minsize=None):
     return Fasta(fdict=as_seqdict(to_convert, genome, minsize))
 
 
+def _fasta_batches(records, batch_size, minsize=None):
+    """Yield Fasta objects of batch_size (name, sequence) records."""
+    batch = {}
+    for name, seq in records:
+        batch[name] = seq
+        if len(batch) == batch_size:
+            yield Fasta(fdict=_check_minsize(batch, minsize))
+            batch = {}
+    if len(batch) > 0:
+        yield Fasta(fdict=_check_minsize(batch, minsize))
+
+
+def _line_batches(lines, batch_size):
+    """Yield lists of batch_size lines, skipping comments and headers."""
+    batch = []
+    for line in lines:
+        if line.startswith("#") or line.startswith("track") or line.strip() == "":
+            continue
+        batch.append(line)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+@singledispatch
+def as_fasta_batches(to_convert, genome=None, batch_size=50000, minsize=None):
+    """
+    Convert input to Fasta objects of at most batch_size sequences.
+
+    The input is read lazily, only one batch of sequences is in memory at
+    the same time. The same input types as as_seqdict() are supported.
+
+    Parameters
+    ----------
+    to_convert : list, str, Fasta, pyfaidx.Fasta or pybedtools.BedTool
+        Input to convert.
+
+    genome : str, optional
+        Genomepy genome name.
+
+    batch_size : int, optional
+        Maximum number of sequences per batch.
+
+    minsize : int or None, optional
+        If specified, check if all sequences have at least size minsize.
+
+    Yields
+    ------
+    Fasta
+        Batch of sequences, in the order of the input.
+    """
+    yield as_fasta(to_convert, genome, minsize)
+
+
+@as_fasta_batches.register(Fasta)
+def _as_fasta_batches_fasta(to_convert, genome=None, batch_size=50000, minsize=None):
+    for i in range(0, len(to_convert.ids), batch_size):
+        fa = to_convert[i : i + batch_size]
+        _check_minsize(dict(zip(fa.ids, fa.seqs)), minsize)
+        yield fa
+
+
+@as_fasta_batches.register(list)
+@as_fasta_batches.register(np.ndarray)
+def _as_fasta_batches_list(to_convert, genome=None, batch_size=50000, minsize=None):
+    for i in range(0, len(to_convert), batch_size):
+        yield as_fasta(list(to_convert[i : i + batch_size]), genome, minsize)
+
+
+@as_fasta_batches.register(TextIOWrapper)
+def _as_fasta_batches_file_object(
+    to_convert, genome=None, batch_size=50000, minsize=None
+):
+    for fa in _fasta_batches(SimpleFastaParser(to_convert), batch_size, minsize):
+        yield fa
+
+
+@as_fasta_batches.register(str)
+def _as_fasta_batches_filename(to_convert, genome=None, batch_size=50000, minsize=None):
+    if not os.path.exists(to_convert):
+        raise ValueError("Assuming filename, but it does not exist")
+
+    with open(to_convert) as f:
+        line = f.readline()
+        while line.startswith("#"):
+            line = f.readline()
+        if line == "":
+            raise IOError(f"empty file {to_convert}")
+
+    if line.startswith(">"):
+        with open(to_convert) as f:
+            for fa in as_fasta_batches(f, genome, batch_size, minsize):
+                yield fa
+        return
+
+    # BED or region file, convert every batch of lines separately
+    with open(to_convert) as f:
+        for lines in _line_batches(f, batch_size):
+            if interval_p.match(lines[0]):
+                yield as_fasta([line.strip() for line in lines], genome, minsize)
+                continue
+            with NamedTemporaryFile(mode="w") as tmp:
+                tmp.writelines(lines)
+                tmp.flush()
+                yield as_fasta(tmp.name, genome, minsize)
+
+
+@as_fasta_batches.register(pyfaidx.Fasta)
+def _as_fasta_batches_pyfaidx(to_convert, genome=None, batch_size=50000, minsize=None):
+    records = ((k, str(v)) for k, v in to_convert.items())
+    for fa in _fasta_batches(records, batch_size, minsize):
+        yield fa
+
+
+@as_fasta_batches.register(pybedtools.BedTool)
+def _as_fasta_batches_bedtool(to_convert, genome=None, batch_size=50000, minsize=None):
+    regions = ("{}:{}-{}".format(*f[:3]) for f in to_convert)
+    for lines in _line_batches(regions, batch_size):
+        yield as_fasta(lines, genome, minsize)
+
+
+def count_dtype(nreport):
+    """Return the smallest unsigned integer type for motif counts.
+
+    Parameters
+    ----------
+    nreport : int
+        Maximum number of matches counted per motif and sequence, 0 for no
+        limit.
+
+    Returns
+    -------
+    numpy dtype
+    """
+    if 0 < nreport <= np.iinfo(np.uint8).max:
+        return np.uint8
+    if 0 < nreport <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.uint32
+
+
+def is_sparse_table(df):
+    """Return True if all columns of a DataFrame are sparse."""
+    return df.shape[1] > 0 and all(
+        isinstance(dtype, pd.SparseDtype) for dtype in df.dtypes
+    )
+
+
+def table_to_matrix(df):
+    """Return the values of a DataFrame, as CSR matrix if it is sparse.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Table with motif counts or scores.
+
+    Returns
+    -------
+    numpy.ndarray or scipy.sparse.csr_matrix
+    """
+    if is_sparse_table(df):
+        return df.sparse.to_coo().tocsr()
+    return df.values
+
+
+def write_sparse_table(df, fname):
+    """Write a table to a compressed NumPy file, as CSR matrix.
+
+    Only the non-zero values are stored, together with the row and column
+    names. This is the on-disk format for (sparse) motif count tables.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Table, with sparse or dense columns.
+
+    fname : str
+        Name of the output file, should end with .npz.
+    """
+    X = csr_matrix(table_to_matrix(df))
+    np.savez_compressed(
+        fname,
+        data=X.data,
+        indices=X.indices,
+        indptr=X.indptr,
+        shape=np.array(X.shape),
+        index=np.array(df.index, dtype=str),
+        columns=np.array(df.columns, dtype=str),
+    )
+
+
+def read_sparse_table(fname):
+    """Read a table written by write_sparse_table().
+
+    Parameters
+    ----------
+    fname : str
+        Name of .npz file.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Table with sparse columns.
+    """
+    with np.load(fname) as f:
+        X = csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+        return pd.DataFrame.sparse.from_spmatrix(
+            X, index=f["index"].astype(object), columns=f["columns"].astype(object)
+        )
+
+
+def read_motif_table(fname):
+    """Read a table with motif counts or scores.
+
+    Parameters
+    ----------
+    fname : str
+        Sparse table (.npz, see write_sparse_table()), feather file or
+        tab-separated text file, with the regions in the first column.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    if fname.endswith(".npz"):
+        return read_sparse_table(fname)
+    if fname.endswith("feather"):
+        df = pd.read_feather(fname)
+        return df.set_index(df.columns[0])
+    return pd.read_table(fname, index_col=0, comment="#")
+
+
 def file_checksum(fname):
     """Return md5 checksum of file.
 
@@ -0,0 +1,117 @@
+import multiprocessing as mp
+import os
+import pickle
+import socket
+import time
+
+import pytest
+
+from gimmemotifs.cache import TieredCache, get_cache
+
+
+def test_tiered_cache(tmpdir):
+    cache = TieredCache(str(tmpdir), memory_size=2)
+    assert cache.get("a") is None
+    assert cache.get("a", 0) == 0
+    cache.set("a", [1, 2])
+    cache.set("b", 2)
+    assert cache.get("a") == [1, 2]
+    assert cache.stats() == {"memory_hits": 1, "disk_hits": 0, "misses": 2}
+
+    # "b" is least recently used and is removed from memory, not from disk
+    cache.set("c", 3)
+    assert list(cache._memory) == ["a", "c"]
+    assert cache.get("b") == 2
+    assert cache.stats()["disk_hits"] == 1
+
+    # Values are shared with other processes through the disk cache
+    other = TieredCache(str(tmpdir))
+    assert other.get("c") == 3
+
+    copy = pickle.loads(pickle.dumps(cache))
+    assert len(copy._memory) == 0
+    assert copy.get("a") == [1, 2]
+
+    with pytest.raises(ValueError):
+        TieredCache(str(tmpdir), backend="unknown")
+
+
+def test_get_cache():
+    assert get_cache() is get_cache()
+
+
+def _compute_once(directory, queue):
+    cache = TieredCache(directory)
+
+    def compute(missing):
+        time.sleep(0.5)
+        return {k: os.getpid() for k in missing}
+
+    queue.put(cache.get_or_compute(["shared"], compute)["shared"])
+
+
+def test_get_or_compute(tmpdir):
+    cache = TieredCache(str(tmpdir))
+    cache.set_many({"a": 1, "b": 2})
+    assert cache.get_many(["a", "b", "c"]) == {"a": 1, "b": 2}
+
+    calls = []
+
+    def compute(missing):
+        calls.append(missing)
+        return {k: k.upper() for k in missing}
+
+    values = cache.get_or_compute(["a", "c", "d", "c"], compute)
+    assert values == {"a": 1, "c": "C", "d": "D"}
+    assert calls == [["c", "d"]]
+    cache.get_or_compute(["c", "d"], compute)
+    assert len(calls) == 1
+
+    # Locks are released on an exception
+    def fail(missing):
+        raise RuntimeError()
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_compute(["e"], fail)
+    assert cache.get_or_compute(["e"], compute) == {"e": "E"}
+
+    # A value is computed by one process, the other waits for it
+    ctx = mp.get_context("fork")
+    queue = ctx.Queue()
+    procs = [
+        ctx.Process(target=_compute_once, args=(str(tmpdir), queue)) for _ in range(2)
+    ]
+    for p in procs:
+        p.start()
+    pids = [queue.get(timeout=30) for _ in procs]
+    for p in procs:
+        p.join()
+    assert pids[0] == pids[1]
+    assert pids[0] in [p.pid for p in procs]
+
+
+def test_lock_of_dead_process(tmpdir):
+    cache = TieredCache(str(tmpdir))
+
+    # The lock of a process that is no longer running is taken over
+    ctx = mp.get_context("fork")
+    p = ctx.Process(target=time.sleep, args=(0,))
+    p.start()
+    p.join()
+    cache.store.add("lock|a", (socket.gethostname(), p.pid, "token"))
+    start = time.time()
+    assert cache.get_or_compute(["a"], lambda missing: {"a": 1}) == {"a": 1}
+    assert time.time() - start < 5
+    assert cache.store.get("lock|a") is None
+
+    # The lock of a running process is not
+    cache.store.add("lock|b", (socket.gethostname(), os.getpid(), "token"))
+    proc = ctx.Process(
+        target=cache.get_or_compute, args=(["b"], lambda missing: {"b": 2})
+    )
+    proc.start()
+    proc.join(1)
+    assert proc.is_alive()
+    proc.terminate()
+    proc.join()
+    assert cache.store.get("lock|b") == (socket.gethostname(), os.getpid(), "token")
@@ -57,6 +57,49 @@ def test_gimme_scan(arguments):
     assert 1 == 1
 
 
+@pytest.mark.parametrize("bgzip", [[], ["--bgzip"]])
+def test_gimme_scan_genome_wide(bgzip):
+    with TemporaryDirectory() as d:
+        cli(
+            [
+                "scan",
+                "-p",
+                "test/data/pwmscan/TATA.pwm",
+                "-g",
+                "test/data/genomes/hg38sample/hg38sample.fa",
+                "-c",
+                "0.8",
+                "--genome-wide",
+                d,
+            ]
+            + bgzip
+        )
+
+        suffix = ".bed.gz" if bgzip else ".bed"
+        for chrom in ["chr1", "chr2", "chr8"]:
+            assert os.path.exists(os.path.join(d, f"{chrom}{suffix}"))
+
+
+@pytest.mark.parametrize("arguments", [["-n", "2"], ["-z"], ["--format", "arrow"]])
+def test_gimme_scan_genome_wide_options(arguments, capsys):
+    with TemporaryDirectory() as d:
+        with pytest.raises(SystemExit):
+            cli(
+                [
+                    "scan",
+                    "-p",
+                    "test/data/pwmscan/TATA.pwm",
+                    "-g",
+                    "test/data/genomes/hg38sample/hg38sample.fa",
+                    "--genome-wide",
+                    d,
+                ]
+                + arguments
+            )
+        assert arguments[0] in capsys.readouterr().err
+        assert [] == os.listdir(d)
+
+
 def test_gimme_logo():
     motif_name = "MA0103.3_ZEB1"
     cli(["logo", "-p", "test/data/cli/motifs.pfm", "-i", motif_name])
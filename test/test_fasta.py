@@ -1,4 +1,5 @@
 from gimmemotifs.fasta import *
+import pickle
 import tempfile
 import os
 import pytest
@@ -48,3 +49,35 @@ def test4_gt_in_id(id_fa_files):
         print(seqs)
         for i in range(3):
             assert seqs[i] == "ACTG" * (i + 1)
+
+
+def test5_modify(fasta_obj):
+    """ Add, change and delete sequences by id """
+    fasta_obj["seq4"] = "TTTT"
+    fasta_obj["seq1"] = "CCCC"
+    assert fasta_obj.ids == ["seq1", "seq2", "seq3", "seq4"]
+    assert fasta_obj["seq1"] == "CCCC"
+    assert fasta_obj["seq4"] == "TTTT"
+
+    del fasta_obj["seq2"]
+    assert "seq2" not in fasta_obj
+    assert fasta_obj["seq2"] is None
+    assert fasta_obj["seq3"] == "CCCCGGGG"
+    assert fasta_obj.has_key("seq4")
+    with pytest.raises(ValueError):
+        del fasta_obj["seq2"]
+
+    sliced = fasta_obj[1:]
+    assert sliced.ids == ["seq3", "seq4"]
+    assert sliced["seq4"] == "TTTT"
+    assert sliced["seq1"] is None
+
+
+def test6_pickle(fasta_obj):
+    """ Fasta objects can be unpickled, also from before the index """
+    f = pickle.loads(pickle.dumps(fasta_obj))
+    assert f["seq2"] == "ACGT"
+
+    old = Fasta.__new__(Fasta)
+    old.__setstate__({"ids": ["seq1"], "seqs": ["AAAA"]})
+    assert old["seq1"] == "AAAA"
@@ -0,0 +1,91 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+from genomepy import Genome
+
+from gimmemotifs.genome_cache import GenomeCache, is_region_list
+from gimmemotifs.scanner import Scanner, encode_seqs
+from gimmemotifs.utils import as_fasta
+
+genome = "test/data/genomes/hg38sample/hg38sample.fa"
+
+
+def random_regions(n=50, seed=42):
+    rng = np.random.default_rng(seed)
+    regions = []
+    for chrom, size in Genome(genome).sizes.items():
+        for _ in range(n):
+            start = int(rng.integers(0, size - 1))
+            end = min(start + int(rng.integers(1, 500)), size)
+            regions.append(f"{chrom}:{start}-{end}")
+    return regions
+
+
+@pytest.mark.parametrize("max_size", [None, 0])
+def test_encode_regions(tmpdir, max_size):
+    """ Regions from the genome cache are the same as from the FASTA file """
+    cache = GenomeCache(genome, cache_dir=str(tmpdir), max_size=max_size)
+    # A genome that does not fit is read from the FASTA file
+    assert (cache.data is None) == (max_size == 0)
+    regions = random_regions()
+
+    encoded, offsets = cache.encode_regions(regions)
+    expected = encode_seqs(as_fasta(regions, genome=genome).seqs)
+    np.testing.assert_array_equal(expected[0], encoded)
+    np.testing.assert_array_equal(expected[1], offsets)
+
+    # The cache is reused
+    assert GenomeCache(genome, cache_dir=str(tmpdir)).fname == cache.fname
+
+    with pytest.raises(ValueError):
+        cache.encode_regions(["chrUnknown:1-100"])
+    with pytest.raises(ValueError):
+        cache.encode_regions(["chr1:1-100", "chr1"])
+
+
+def test_stale_cache(tmpdir):
+    """ The cache of an older version of the FASTA file is removed """
+    fasta = str(tmpdir.join("genome.fa"))
+    shutil.copyfile(genome, fasta)
+    cache_dir = str(tmpdir.join("cache"))
+    old = GenomeCache(fasta, cache_dir=cache_dir)
+    assert os.path.exists(old.fname)
+
+    stat = os.stat(fasta)
+    os.utime(fasta, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    new = GenomeCache(fasta, cache_dir=cache_dir)
+    assert new.fname != old.fname
+    assert sorted(os.listdir(cache_dir)) == sorted(
+        os.path.basename(f) for f in [new.fname, new.index_fname]
+    )
+
+    # Counted against the maximum size, together with the other genomes
+    os.utime(fasta, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+    size = os.path.getsize(new.fname)
+    assert GenomeCache(fasta, cache_dir=cache_dir, max_size=size).data is not None
+    other = str(tmpdir.join("other.fa"))
+    shutil.copyfile(genome, other)
+    assert GenomeCache(other, cache_dir=cache_dir, max_size=size).data is None
+
+
+def test_is_region_list():
+    assert is_region_list(["chr1:1-100"])
+    assert is_region_list(np.array(["chr1:1-100"]))
+    assert not is_region_list("chr1:1-100")
+    assert not is_region_list(["hg38@chr1:1-100"])
+    assert not is_region_list([])
+
+
+def test_scanner_regions():
+    """ Scanning regions gives the same result as scanning sequences """
+    regions = random_regions()
+    fa = as_fasta(regions, genome=genome)
+
+    s = Scanner(ncpus=1)
+    s.set_motifs("test/data/pwms/motifs.pwm")
+    s.set_genome(genome)
+    s.set_threshold(threshold=0.8)
+    np.testing.assert_array_equal(s.count_matrix(fa), s.count_matrix(regions))
+    np.testing.assert_array_equal(s.best_score_matrix(fa), s.best_score_matrix(regions))
@@ -1,7 +1,12 @@
 import unittest
 import tempfile
 import os
+from shutil import rmtree
+
+import pandas as pd
+
 from gimmemotifs.moap import moap
+from gimmemotifs.utils import read_motif_table, write_sparse_table
 
 
 class TestMoap(unittest.TestCase):
@@ -59,6 +64,30 @@ class TestMoap(unittest.TestCase):
             )
             self.assertEquals((623, 2), df.shape)
 
+    def test3_moap_sparse(self):
+        """ Test motif activity prediction with a sparse count table """
+        tmpdir = tempfile.mkdtemp()
+        sparse_count = os.path.join(tmpdir, "motifs.count.npz")
+        write_sparse_table(read_motif_table(self.motifs_count), sparse_count)
+
+        for method in ["hypergeom", "rf"]:
+            df = moap(
+                self.clusters, method=method, scoring="count", motiffile=sparse_count
+            )
+            self.assertEquals((623, 4), df.shape)
+
+        dense = moap(
+            self.clusters,
+            method="hypergeom",
+            scoring="count",
+            motiffile=self.motifs_count,
+        )
+        sparse = moap(
+            self.clusters, method="hypergeom", scoring="count", motiffile=sparse_count
+        )
+        pd.testing.assert_frame_equal(dense, sparse)
+        rmtree(tmpdir)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,64 @@
+from time import sleep
+
+import pytest
+
+from gimmemotifs.pool import get_pool, imap_ordered, shutdown_pool
+from gimmemotifs.scanner import Scanner
+
+
+def test_get_pool():
+    shutdown_pool()
+
+    pool = get_pool(2)
+    assert pool.map(abs, [-1, -2, 3]) == [1, 2, 3]
+
+    # The same pool is reused, also if less processes are needed
+    assert get_pool(2) is pool
+    assert get_pool(1) is pool
+    assert Scanner(ncpus=2).pool is pool
+
+    # A larger pool replaces the old one
+    job = pool.apply_async(abs, (-4,))
+    larger = get_pool(3)
+    assert larger is not pool
+    assert job.get() == 4
+    assert larger.apply_async(abs, (-5,)).get() == 5
+
+    shutdown_pool()
+    assert get_pool(2) is not larger
+    shutdown_pool()
+
+
+def slow_square(x, delay):
+    sleep(delay)
+    return x * x
+
+
+def test_imap_ordered():
+    jobs = [(i, 0.1 if i % 3 == 0 else 0) for i in range(10)]
+    expected = [i * i for i in range(10)]
+
+    # Serial
+    assert list(imap_ordered(slow_square, iter(jobs))) == expected
+
+    # Results are in order, even if later jobs finish first
+    pool = get_pool(2)
+    assert list(imap_ordered(slow_square, iter(jobs), pool, max_jobs=3)) == expected
+
+    # Jobs are only submitted when there is room in the window
+    submitted = []
+
+    def gen():
+        for job in jobs:
+            submitted.append(job)
+            yield job
+
+    it = imap_ordered(
+        slow_square, gen(), pool, max_jobs=8, max_bytes=2, sizeof=lambda args: 1
+    )
+    assert next(it) == 0
+    assert len(submitted) <= 3
+    assert list(it) == expected[1:]
+
+    with pytest.raises(ValueError):
+        list(imap_ordered(slow_square, jobs, pool, max_bytes=10))
@@ -0,0 +1,91 @@
+from itertools import product
+
+import numpy as np
+import pytest
+
+from gimmemotifs.fasta import Fasta
+from gimmemotifs.motif import read_motifs
+from gimmemotifs.pvalue import (
+    background_composition,
+    fpr_to_pvalue,
+    pvalue_threshold,
+    score_distribution,
+)
+from gimmemotifs.scanner import Scanner
+
+motifs = "test/data/pwms/motifs.pwm"
+bg_fa = "test/data/scan/scan_test_regions.fa"
+
+
+@pytest.mark.parametrize("order", [0, 1])
+def test_score_distribution(order):
+    """ DP score distribution is the same as enumerating all words """
+    comp = background_composition(Fasta(bg_fa).seqs, order=order)
+    init, trans = comp
+    np.testing.assert_almost_equal(trans.sum(axis=1), 1)
+
+    matrix = [[1.2, -0.5, 0.3, -2.1], [0.1, 0.9, -1.3, 0.4], [-0.7, 0.2, 1.5, -0.1]]
+    scores, probs = score_distribution(matrix, comp, granularity=0.1)
+    assert probs.sum() == pytest.approx(1)
+
+    expected = {}
+    for word in product(range(4), repeat=len(matrix)):
+        p = init[word[0]]
+        for a, b in zip(word, word[1:]):
+            p *= trans[a, b]
+        score = round(sum(matrix[i][n] for i, n in enumerate(word)), 1)
+        expected[score] = expected.get(score, 0) + p
+
+    for score, p in zip(scores, probs):
+        assert p == pytest.approx(expected.get(round(score, 1), 0))
+
+
+def test_pvalue_threshold():
+    comp = background_composition(Fasta(bg_fa).seqs)
+    motif = read_motifs(motifs)[0]
+
+    cutoffs = [pvalue_threshold(motif.logodds, p, comp) for p in [1e-2, 1e-3, 1e-4]]
+    assert cutoffs == sorted(cutoffs)
+    assert cutoffs[-1] <= motif.pwm_max_score()
+
+    # No score has a p-value this low
+    assert pvalue_threshold(motif.logodds, 1e-20, comp) is None
+
+    pvalue = fpr_to_pvalue(0.01, 200, 10)
+    assert 1 - (1 - pvalue) ** (2 * 191) == pytest.approx(0.01)
+
+
+def test_scanner_dp_threshold():
+    s = Scanner(ncpus=1)
+    s.set_motifs(motifs)
+    s.set_background(fname=bg_fa)
+    s.set_threshold(fpr=0.01, method="dp")
+
+    thresholds = s.get_gc_thresholds(Fasta(bg_fa).seqs)
+    for motif in read_motifs(motifs):
+        t = thresholds[motif.id]
+        assert t is None or motif.pwm_min_score() < t <= motif.pwm_max_score()
+
+    with pytest.raises(ValueError):
+        s.set_threshold(fpr=0.01, method="unknown")
+
+
+def test_scanner_dp_threshold_gc():
+    """ Every GC% bin gets the DP threshold of its own background sequences """
+    seqs = Fasta(bg_fa).seqs
+    s = Scanner(ncpus=1)
+    s.set_motifs(motifs)
+    s.set_background(fname=bg_fa)
+    s.gc_bins = [(0.0, 0.4), (0.4, 0.5), (0.5, 1.0)]
+    s.set_threshold(fpr=0.01, method="dp", gc=True)
+    assert list(s.threshold.index) == ["0.00-0.40", "0.40-0.50", "0.50-1.00"]
+
+    seq_bins = s.get_seq_bins(seqs)
+    motif = read_motifs(motifs)[0]
+    for i, gc_bin in enumerate(s.threshold.index):
+        bin_seqs = [seq for seq, b in zip(seqs, seq_bins) if b == i] or seqs
+        comp = background_composition(bin_seqs)
+        seqlen = int(np.median([len(seq) for seq in bin_seqs]))
+        pvalue = fpr_to_pvalue(0.01, seqlen, len(motif))
+        expected = pvalue_threshold(motif.logodds, pvalue, comp)
+        assert s.threshold.loc[gc_bin, motif.id] == pytest.approx(expected)
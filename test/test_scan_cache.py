@@ -0,0 +1,82 @@
+import os
+from unittest.mock import patch
+
+import numpy as np
+
+from gimmemotifs.motif import read_motifs
+from gimmemotifs.scan_cache import ScanCache
+from gimmemotifs.scanner import Scanner, encode_seqs
+
+fa = "test/data/scan/scan_test_regions.fa"
+pwms = "test/data/pwms/motifs.pwm"
+
+
+def test_cache_get_set(tmpdir):
+    cache = ScanCache(str(tmpdir))
+    hashes = np.array([5, 3, 9], dtype=np.uint64)
+    counts = np.array([[1, 2], [3, 4], [5, 6]])
+    scores = np.array([[0.5, 0.6], [0.3, 0.4], [0.9, 1.0]])
+    cache.set([["c1", "c2"], ["s1", "s2"]], hashes, [counts, scores])
+
+    found, (c, sc) = cache.get(
+        [["c2", "c3"], ["s2", "s3"]],
+        np.array([9, 4, 5], dtype=np.uint64),
+        [np.int64, np.float64],
+    )
+    np.testing.assert_array_equal(found, [[True, False], [False, False], [True, False]])
+    np.testing.assert_array_equal(c, [[6, 0], [0, 0], [2, 0]])
+    np.testing.assert_array_equal(sc, [[1.0, 0], [0, 0], [0.6, 0]])
+
+    # Another process sees the chunk
+    found, (sc,) = ScanCache(str(tmpdir)).get([["s1"]], hashes, [np.float64])
+    assert found.all()
+    np.testing.assert_array_equal(sc[:, 0], scores[:, 0])
+
+    # Least recently used chunks are evicted when a new chunk does not fit
+    (name,) = os.listdir(str(tmpdir))
+    os.utime(os.path.join(str(tmpdir), name), (0, 0))
+    cache.max_size = cache.size() + 1
+    cache.set([["s3"]], hashes, [scores[:, :1]])
+    assert not cache.get([["s1"]], hashes, [np.float64])[0].any()
+    assert cache.get([["s3"]], hashes, [np.float64])[0].all()
+    with patch.object(ScanCache, "evict") as evict:
+        cache.get([["s3"]], hashes, [np.float64])
+        assert evict.call_count == 0
+
+
+def test_scanner_cache(tmpdir):
+    s = Scanner(ncpus=1)
+    s.set_motifs(pwms)
+    s.set_threshold(threshold=0.8)
+    counts = s.count_matrix(fa)
+    scores = s.best_score_matrix(fa)
+
+    s.set_scan_cache(str(tmpdir))
+    for _ in range(2):
+        np.testing.assert_array_equal(counts, s.count_matrix(fa))
+        np.testing.assert_array_equal(scores, s.best_score_matrix(fa))
+        c, sc = s.count_and_best_score(fa, sparse=True)
+        np.testing.assert_array_equal(counts, c.toarray())
+        np.testing.assert_array_equal(scores, sc)
+
+    # Only the motifs that are not in the cache are scanned
+    motifs = read_motifs(pwms)
+    s.set_scan_cache(str(tmpdir.join("motifs")))
+    s.set_motifs(motifs[:2])
+    s.count_matrix(fa)
+    s.set_motifs(motifs[::-1])
+    with patch.object(Scanner, "_scan_matrix", wraps=s._scan_matrix) as scan:
+        np.testing.assert_array_equal(counts[:, ::-1], s.count_matrix(fa))
+        assert scan.call_count == 1
+        assert len(scan.call_args[0][1]) == len(motifs) - 2
+
+        s.count_matrix(fa)
+        assert scan.call_count == 1
+
+    # Only the sequences that are not in the cache are scanned
+    seqs = encode_seqs(["ACGTACGTGGGCGGGGCCACGTG" * 3, "TTTT"])
+    s._scan_cached(encode_seqs(["TTTT"]), motifs, True)
+    with patch.object(Scanner, "_scan_matrix", wraps=s._scan_matrix) as scan:
+        s._scan_cached(seqs, motifs, True)
+        assert scan.call_count == 1
+        np.testing.assert_array_equal(scan.call_args[0][0][1], [0, 69])
@@ -1,9 +1,13 @@
 import unittest
 import tempfile
 import os
+from gimmemotifs import scanner
 from gimmemotifs.scanner import *
+from gimmemotifs.scanner import _share_array
 from gimmemotifs.fasta import Fasta
+from gimmemotifs.utils import count_dtype
 from time import sleep
+from unittest.mock import patch
 
 
 class TestScanner(unittest.TestCase):
@@ -65,6 +69,750 @@ class TestScanner(unittest.TestCase):
         for score, match in zip(scores, result["AP1"]):
             self.assertAlmostEqual(score, match, 5)
 
+    def test4_scan_seq_batch(self):
+        """ Batch kernel gives the same result as the per-motif kernel """
+        motifs = read_motifs("test/data/pwms/motifs.pwm")[:10]
+        seqs = Fasta("test/data/scan/scan_test_regions.fa").seqs[:50]
+        seqs.append("ACGTN")
+
+        for cutoff in [None, 0.0, 0.8]:
+            scan_motifs = [
+                (m, None if cutoff is None else m.pwm_min_score() + cutoff)
+                for m in motifs
+            ]
+            cutoffs = np.array([np.inf if c is None else c for _, c in scan_motifs])
+            matrix, offsets = motif_tensor(motifs)
+            for nreport in [1, 5]:
+                for scan_rc in [True, False]:
+                    expected = scan_seq_mult(
+                        seqs, [None] * len(seqs), scan_motifs, nreport, scan_rc
+                    )
+                    result = scan_seq_batch(
+                        seqs, None, matrix, offsets, cutoffs, nreport, scan_rc
+                    )
+                    result = list(batch_to_matches(result, scan_motifs, nreport))
+                    self.assertEqual(expected, result)
+
+    def test4_scan_seq_batch_zscore(self):
+        """ Z-scores from the batch kernel are the same as per motif """
+        motifs = read_motifs("test/data/pwms/motifs.pwm")
+        seqs = Fasta("test/data/scan/scan_test_regions.fa").seqs[:50]
+        seq_bins = np.arange(len(seqs)) % 2
+        bin_names = ["0.00-0.50", "0.50-1.00"]
+        rng = np.random.default_rng(1)
+        mean = rng.uniform(-5, 0, size=(2, len(motifs)))
+        std = rng.uniform(1, 3, size=(2, len(motifs)))
+        meanstd = {
+            b: {m.id: (mean[i, j], std[i, j]) for j, m in enumerate(motifs)}
+            for i, b in enumerate(bin_names)
+        }
+
+        matrix, offsets = motif_tensor(motifs)
+        for cutoff in [None, 1.0, 2.5]:
+            scan_motifs = [(m, cutoff) for m in motifs]
+            cutoffs = np.array([np.inf if c is None else c for _, c in scan_motifs])
+            for nreport in [1, 5]:
+                expected = scan_seq_mult(
+                    seqs,
+                    [bin_names[b] for b in seq_bins],
+                    scan_motifs,
+                    nreport,
+                    True,
+                    motifs_meanstd=meanstd,
+                    zscore=True,
+                )
+                result = scan_seq_batch(
+                    seqs,
+                    seq_bins,
+                    matrix,
+                    offsets,
+                    cutoffs,
+                    nreport,
+                    True,
+                    zscore=(mean, std),
+                )
+                result = list(batch_to_matches(result, scan_motifs, nreport))
+                self.assertEqual(len(expected), len(result))
+                for exp_seq, res_seq in zip(expected, result):
+                    for exp, res in zip(exp_seq, res_seq):
+                        self.assertEqual([r[1:] for r in exp], [r[1:] for r in res])
+                        np.testing.assert_allclose(
+                            [r[0] for r in exp], [r[0] for r in res]
+                        )
+
+    def test4_scan_all_hits(self):
+        """ All hits of the batch kernel, also if they do not fit at once """
+        motifs = read_motifs("test/data/pwms/motifs.pwm")[:10]
+        seqs = Fasta("test/data/scan/scan_test_regions.fa").seqs[:50]
+        seqs.append("ACGTN")
+        matrix, offsets = motif_tensor(motifs)
+        encoded, seq_offsets = encode_seqs(seqs)
+        min_scores = np.array([m.pwm_min_score() for m in motifs])
+        mean = np.array([min_scores / 2, min_scores / 4])
+        std = np.ones((2, len(motifs)))
+        bins = np.arange(len(seqs)) % 2
+
+        for cutoff in [0.0, 8.0]:
+            cutoffs = min_scores + cutoff
+            for scan_rc in [True, False]:
+                for zscore in [None, (bins, mean, std)]:
+                    # No sequence has more than 1000 hits per motif
+                    expected = scan_encoded_batch(
+                        encoded,
+                        seq_offsets,
+                        matrix,
+                        offsets,
+                        cutoffs,
+                        1000,
+                        scan_rc,
+                        zscore,
+                    )
+                    # Ordered by strand and position instead of score
+                    group = np.repeat(np.arange(expected[0].size), expected[0].ravel())
+                    order = np.lexsort((expected[2], -expected[3], group))
+                    for max_hits in [scanner.BATCH_MAX_HITS, 7]:
+                        with patch.object(scanner, "BATCH_MAX_HITS", max_hits):
+                            result = scan_encoded_batch(
+                                encoded,
+                                seq_offsets,
+                                matrix,
+                                offsets,
+                                cutoffs,
+                                0,
+                                scan_rc,
+                                zscore,
+                            )
+                        np.testing.assert_array_equal(expected[0], result[0])
+                        for a, b in zip(expected[1:], result[1:]):
+                            np.testing.assert_array_equal(a[order], b)
+
+    def test4_superalphabet_kernel(self):
+        """ Super-alphabet tables give the same result as the default kernel """
+        motifs = read_motifs("test/data/pwms/motifs.pwm")
+        seqs = Fasta("test/data/scan/scan_test_regions.fa").seqs
+        seqs += ["ACGTN", "NNNNNNNNNNNNNNNNNNNN", ""]
+        matrix, offsets = motif_tensor(motifs)
+        encoded, seq_offsets = encode_seqs(seqs)
+        min_scores = np.array([m.pwm_min_score() for m in motifs])
+        max_scores = np.array([m.pwm_max_score() for m in motifs])
+        shape = (len(seqs), len(motifs))
+
+        for k in [1, 3, 4, 5]:
+            kmer_tables = kmer_tensor(motifs, k)
+            self.assertEqual(5 ** k, kmer_tables[0].shape[1])
+            for scan_rc in [True, False]:
+                expected, result = [
+                    scan_best_encoded(
+                        encoded,
+                        seq_offsets,
+                        matrix,
+                        offsets,
+                        min_scores,
+                        scan_rc,
+                        np.empty(shape),
+                        kmer_tables=tables,
+                    )
+                    for tables in [None, kmer_tables]
+                ]
+                np.testing.assert_array_equal(expected, result)
+
+                for frac in [0.0, 0.6, 0.9, 1.0]:
+                    cutoffs = min_scores + frac * (max_scores - min_scores)
+                    for nreport in [0, 3]:
+                        expected, result = [
+                            scan_count_best_encoded(
+                                encoded,
+                                seq_offsets,
+                                matrix,
+                                offsets,
+                                cutoffs,
+                                min_scores,
+                                nreport,
+                                scan_rc,
+                                (
+                                    np.empty(shape, dtype=np.int64),
+                                    np.empty(shape, dtype=np.float32),
+                                ),
+                                kmer_tables=tables,
+                            )
+                            for tables in [None, kmer_tables]
+                        ]
+                        for a, b in zip(expected, result):
+                            np.testing.assert_array_equal(a, b)
+
+        fa = Fasta("test/data/scan/scan_test_regions.fa")
+        for ncpus in [1, 2]:
+            s = Scanner(ncpus=ncpus)
+            s.set_motifs(motifs)
+            s.set_threshold(threshold=0.8)
+            expected = s.count_and_best_score(fa, 10)
+            self.assertIsNone(s._kmer_tables(motifs))
+
+            s.set_kernel("superalphabet")
+            self.assertIsNotNone(s._kmer_tables(motifs))
+            np.testing.assert_array_equal(expected[0], s.count_matrix(fa, 10))
+            np.testing.assert_array_equal(expected[1], s.best_score_matrix(fa))
+            for a, b in zip(expected, s.count_and_best_score(fa, 10)):
+                np.testing.assert_array_equal(a, b)
+
+            # The default kernel selects the tables for many long motifs
+            s.set_kernel("default")
+            with patch.object(scanner, "KMER_MIN_MOTIFS", 1):
+                self.assertIsNotNone(s._kmer_tables(motifs))
+                np.testing.assert_array_equal(expected[0], s.count_matrix(fa, 10))
+
+    def test4_simd_kernel(self):
+        """ SIMD kernel gives the same result as the default kernel """
+        motifs = read_motifs("test/data/pwms/motifs.pwm")
+        seqs = Fasta("test/data/scan/scan_test_regions.fa").seqs
+        # A sequence with more windows than one SIMD block
+        seqs += ["".join(seqs)[:10000], "ACGTN", "NNNNNNNNNNNNNNNNNNNN", ""]
+        matrix, offsets = motif_tensor(motifs)
+        encoded, seq_offsets = encode_seqs(seqs)
+        min_scores = np.array([m.pwm_min_score() for m in motifs])
+        max_scores = np.array([m.pwm_max_score() for m in motifs])
+        mean = np.array([min_scores / 2])
+        std = np.ones((1, len(motifs)))
+        bins = np.zeros(len(seqs), dtype=np.int64)
+        shape = (len(seqs), len(motifs))
+
+        supported = simd_level()
+        levels = ["portable", "sse4.1", "avx2"]
+        levels = levels[: levels.index(supported) + 1]
+        try:
+            for level in levels:
+                self.assertEqual(level, simd_level(level))
+                for scan_rc in [True, False]:
+                    expected, result = [
+                        scan_best_encoded(
+                            encoded,
+                            seq_offsets,
+                            matrix,
+                            offsets,
+                            min_scores,
+                            scan_rc,
+                            np.empty(shape),
+                            simd=simd,
+                        )
+                        for simd in [False, True]
+                    ]
+                    np.testing.assert_array_equal(expected, result)
+
+                    for frac in [0.0, 0.6, 0.9, 1.0]:
+                        cutoffs = min_scores + frac * (max_scores - min_scores)
+                        expected, result = [
+                            scan_count_best_encoded(
+                                encoded,
+                                seq_offsets,
+                                matrix,
+                                offsets,
+                                cutoffs,
+                                min_scores,
+                                3,
+                                scan_rc,
+                                (
+                                    np.empty(shape, dtype=np.int64),
+                                    np.empty(shape, dtype=np.float32),
+                                ),
+                                simd=simd,
+                            )
+                            for simd in [False, True]
+                        ]
+                        for a, b in zip(expected, result):
+                            np.testing.assert_array_equal(a, b)
+
+                        expected, result = [
+                            scan_count_encoded(
+                                encoded,
+                                seq_offsets,
+                                matrix,
+                                offsets,
+                                cutoffs,
+                                min_scores,
+                                0,
+                                scan_rc,
+                                np.empty(shape, dtype=np.int64),
+                                simd=simd,
+                            )
+                            for simd in [False, True]
+                        ]
+                        np.testing.assert_array_equal(expected, result)
+
+                        for zscore in [None, (bins, mean, std)]:
+                            expected, result = [
+                                scan_encoded_batch(
+                                    encoded,
+                                    seq_offsets,
+                                    matrix,
+                                    offsets,
+                                    cutoffs,
+                                    5,
+                                    scan_rc,
+                                    zscore,
+                                    simd=simd,
+                                )
+                                for simd in [False, True]
+                            ]
+                            for a, b in zip(expected, result):
+                                np.testing.assert_array_equal(a, b)
+        finally:
+            simd_level(supported)
+
+        with self.assertRaises(ValueError):
+            simd_level("unknown")
+
+        fa = Fasta("test/data/scan/scan_test_regions.fa")
+        for ncpus in [1, 2]:
+            s = Scanner(ncpus=ncpus)
+            s.set_motifs(motifs)
+            s.set_threshold(threshold=0.95)
+            expected = s.count_and_best_score(fa, 10)
+            hits = list(s._scan_sequences(seqs, 5, True))
+            s.set_kernel("simd")
+            self.assertIsNone(s._kmer_tables(motifs))
+            np.testing.assert_array_equal(expected[0], s.count_matrix(fa, 10))
+            np.testing.assert_array_equal(expected[1], s.best_score_matrix(fa))
+            for a, b in zip(expected, s.count_and_best_score(fa, 10)):
+                np.testing.assert_array_equal(a, b)
+            self.assertEqual(hits, list(s._scan_sequences(seqs, 5, True)))
+        with self.assertRaises(ValueError):
+            s.set_kernel("unknown")
+
+    @unittest.skipIf(scanner.MOODS is None, "MOODS is not installed")
+    @patch.object(scanner, "MOODS_MIN_CUTOFF", 0.5)
+    def test4_moods_kernel(self):
+        """ MOODS kernel gives the same result as the default kernel """
+        motifs = read_motifs("test/data/pwms/motifs.pwm")
+        seqs = Fasta("test/data/scan/scan_test_regions.fa").seqs + ["ACGT", ""]
+        # MOODS skips windows with an N, these are scanned natively
+        seqs += [seqs[0][:40] + "N" + seqs[0][41:], "N" * 30]
+        matrix, offsets = motif_tensor(motifs)
+        encoded, seq_offsets = encode_seqs(seqs)
+        min_scores = np.array([m.pwm_min_score() for m in motifs])
+        max_scores = np.array([m.pwm_max_score() for m in motifs])
+        mean = np.array([min_scores / 2, min_scores / 4])
+        std = np.ones((2, len(motifs)))
+        bins = np.arange(len(seqs)) % 2
+        shape = (len(seqs), len(motifs))
+
+        # Motifs with a low cutoff are scanned natively
+        mixed = np.where(np.arange(len(motifs)) % 2 == 0, 0.3, 0.9)
+        for frac in [0.6, 0.9, 1.0, mixed]:
+            cutoffs = min_scores + frac * (max_scores - min_scores)
+            for scan_rc in [True, False]:
+                for nreport in [0, 3]:
+                    expected, result = [
+                        scan_count_encoded(
+                            encoded,
+                            seq_offsets,
+                            matrix,
+                            offsets,
+                            cutoffs,
+                            min_scores,
+                            nreport,
+                            scan_rc,
+                            np.empty(shape, dtype=np.int64),
+                            moods=moods,
+                        )
+                        for moods in [False, True]
+                    ]
+                    np.testing.assert_array_equal(expected, result)
+
+                for zscore in [None, (bins, mean, std)]:
+                    for nreport in [0, 5]:
+                        expected, result = [
+                            scan_encoded_batch(
+                                encoded,
+                                seq_offsets,
+                                matrix,
+                                offsets,
+                                cutoffs,
+                                nreport,
+                                scan_rc,
+                                zscore,
+                                moods=moods,
+                            )
+                            for moods in [False, True]
+                        ]
+                        for a, b in zip(expected, result):
+                            np.testing.assert_array_equal(a, b)
+
+        with patch.object(scanner, "_scan_moods", wraps=scanner._scan_moods) as scan:
+            cutoffs = min_scores + mixed * (max_scores - min_scores)
+            scan_moods_encoded(encoded, seq_offsets, matrix, offsets, cutoffs, 0, True)
+            self.assertEqual(1, scan.call_count)
+            # Sequences with an N and motifs with a low cutoff are not
+            # scanned with MOODS
+            args = scan.call_args[0]
+            self.assertEqual(len(seqs) - 2, len(args[1]) - 1)
+            self.assertEqual(len(motifs) // 2, len(args[3]) - 1)
+
+        fa = Fasta("test/data/scan/scan_test_regions.fa")
+        for ncpus in [1, 2]:
+            s = Scanner(ncpus=ncpus)
+            s.set_motifs(motifs)
+            s.set_threshold(threshold=0.8)
+            expected = s.count_matrix(fa, 10)
+            hits = list(s._scan_sequences(fa.seqs, 5, True))
+            s.set_kernel("moods")
+            np.testing.assert_array_equal(expected, s.count_matrix(fa, 10))
+            self.assertEqual(hits, list(s._scan_sequences(fa.seqs, 5, True)))
+
+        # Same output with gimme scan --kernel moods
+        kwargs = dict(fpr=None, cutoff=0.9, ncpus=1, zscore=False, gcnorm=False)
+        for table in [False, True]:
+            output = []
+            for kernel in ["default", "moods"]:
+                fname = os.path.join(self.tmpdir, "{}.txt".format(kernel))
+                scan_to_file(
+                    self.fa, self.motifs, fname, table=table, kernel=kernel, **kwargs
+                )
+                with open(fname) as f:
+                    output.append(f.read())
+            self.assertEqual(output[0], output[1])
+
+        with patch.object(scanner, "MOODS", None):
+            with self.assertRaises(ImportError):
+                Scanner(ncpus=1).set_kernel("moods")
+
+    def test4_scan_shared_batch(self):
+        """ Scanning sequences in shared memory """
+        motifs = read_motifs("test/data/pwms/motifs.pwm")
+        seqs = Fasta("test/data/scan/scan_test_regions.fa").seqs
+        cutoffs = np.array([m.pwm_min_score() + 2 for m in motifs])
+        matrix, motif_offsets = motif_tensor(motifs)
+        encoded, seq_offsets = encode_seqs(seqs)
+
+        shms = []
+        specs = []
+        for arr in [encoded, seq_offsets, matrix, motif_offsets]:
+            shm, spec = _share_array(arr)
+            shms.append(shm)
+            specs.append(spec)
+
+        for bounds in [(0, len(seqs)), (3, 17)]:
+            result = scan_shared_batch(bounds, specs[:2], specs[2:], cutoffs, 3, True)
+            expected = scan_seq_batch(
+                seqs[bounds[0] : bounds[1]],
+                None,
+                matrix,
+                motif_offsets,
+                cutoffs,
+                3,
+                True,
+            )
+            for a, b in zip(expected, result):
+                np.testing.assert_array_equal(a, b)
+
+        # Same result using the worker pool
+        s = Scanner(ncpus=2)
+        s.set_motifs(motifs)
+        s.set_threshold(threshold=0.8)
+        result = list(s._scan_sequences(seqs, 2, True))
+        s = Scanner(ncpus=1)
+        s.set_motifs(motifs)
+        s.set_threshold(threshold=0.8)
+        self.assertEqual(list(s._scan_sequences(seqs, 2, True)), result)
+
+        for name in list(scanner._attached):
+            scanner._attached.pop(name)[0].close()
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    def test5_scan_long_sequence(self):
+        """ Scan a chromosome-length sequence """
+        motif = read_motifs(self.motifs)[0]
+        best = "".join("ACGT"[np.argmax(row)] for row in motif.pwm)
+        seq = "N" * 5_000_000 + best + "a" * 5_000_000
+
+        result = pwmscan(seq, motif.logodds, motif.pwm_min_score(), 1, True)
+        self.assertEqual(1, len(result))
+        self.assertEqual(5_000_000, result[0][1])
+        self.assertAlmostEqual(motif.pwm_max_score(), result[0][0], 5)
+
+        # All forward positions are reported for return_all
+        result = pwmscan(seq, motif.logodds, 0, 0, True, True)
+        self.assertEqual(len(seq) - len(motif) + 1, len(result))
+
+    def test6_scan_genome(self):
+        """ Genome-wide scan gives the same hits as scanning whole chromosomes """
+        genome = "test/data/genomes/hg38sample/hg38sample.fa"
+        g = Genome(genome)
+        motifs = read_motifs("test/data/pwms/motifs.pwm")[:10]
+        s = Scanner(ncpus=1)
+        s.set_motifs(motifs)
+        s.set_threshold(threshold=0.8)
+        expected = {}
+        for chrom in g.keys():
+            seq = g[chrom][:].seq
+            expected[chrom] = []
+            for i, m in enumerate(read_motifs(s.motifs)):
+                cutoff = s.threshold.iloc[0][m.id]
+                for score, pos, strand in pwmscan(seq, m.logodds, cutoff, 0, True):
+                    expected[chrom].append((pos, i, strand, score))
+            expected[chrom].sort()
+
+        for ncpus, kernel in [(1, "default"), (2, "default"), (1, "simd")]:
+            s = Scanner(ncpus=ncpus)
+            s.set_motifs(motifs)
+            s.set_genome(genome)
+            s.set_threshold(threshold=0.8)
+            s.set_kernel(kernel)
+
+            result = {}
+            # Small chunks, to have many hits at the chunk boundaries, and a
+            # small output of the kernel, which is then scanned in parts
+            with patch.object(scanner, "BATCH_MAX_HITS", 5):
+                for chrom, hits in s.scan_genome(chunk_size=997):
+                    hits = zip(*[arr.tolist() for arr in hits])
+                    result.setdefault(chrom, []).extend(hits)
+
+            self.assertEqual(list(g.keys()), list(result.keys()))
+            for chrom in g.keys():
+                self.assertEqual(expected[chrom], result[chrom])
+
+    def test7_scan_genome_to_files(self):
+        """ Genome-wide scan to sorted BED files """
+        genome = "test/data/genomes/hg38sample/hg38sample.fa"
+        fnames = scan_genome_to_files(
+            genome, self.motifs, self.tmpdir, cutoff=0.6, ncpus=1
+        )
+        self.assertEqual(
+            [os.path.join(self.tmpdir, f"chr{c}.bed") for c in [1, 8, 2]], fnames
+        )
+        df = pd.concat([pd.read_csv(fname, sep="\t", header=None) for fname in fnames])
+        self.assertTrue(df.groupby(0)[1].is_monotonic_increasing.all())
+        self.assertEqual(["AP1"], df[3].unique())
+
+        fnames = scan_genome_to_files(
+            genome, self.motifs, self.tmpdir, cutoff=0.6, bgzip=True, ncpus=1
+        )
+        for fname in fnames:
+            self.assertTrue(fname.endswith(".bed.gz"))
+            self.assertTrue(os.path.exists(fname + ".tbi"))
+
+    def test8_best_score_matrix(self):
+        """ Best score kernel gives the same scores as scanning """
+        fa = Fasta(self.fa)
+        for ncpus in [1, 2]:
+            s = Scanner(ncpus=ncpus)
+            s.set_motifs("test/data/pwms/motifs.pwm")
+            s.set_threshold(threshold=0.0)
+            expected = [[m[0][0] for m in matches] for matches in s.scan(fa, 1, True)]
+            for dtype in [np.float32, np.float16]:
+                result = s.best_score_matrix(fa, dtype=dtype)
+                self.assertEqual(dtype, result.dtype)
+                np.testing.assert_allclose(
+                    np.array(expected, dtype=dtype), result, rtol=1e-6
+                )
+
+            # Short sequences get the minimum score
+            seqs = [seq[:5] for seq in fa.seqs]
+            min_scores = [m.pwm_min_score() for m in read_motifs(s.motifs)]
+            result = s._best_scores(seqs, True)
+            np.testing.assert_allclose(
+                np.tile(min_scores, (len(seqs), 1)), result, rtol=1e-6
+            )
+
+            # The matrix can be wrapped by a DataFrame without a copy
+            result = s.best_score_matrix(fa)
+            df = pd.DataFrame(result, index=fa.ids)
+            self.assertTrue(np.shares_memory(result, df.values))
+
+    def test9_count_matrix(self):
+        """ Count kernel gives the same counts as scanning """
+        seqs = Fasta("test/data/scan/scan_test_regions.fa")
+        for ncpus in [1, 2]:
+            s = Scanner(ncpus=ncpus)
+            s.set_motifs("test/data/pwms/motifs.pwm")
+            for threshold in [0.0, 0.8]:
+                s.set_threshold(threshold=threshold)
+                for nreport in [0, 1, 10]:
+                    expected = [
+                        [len(m) for m in matches]
+                        for matches in s._scan_sequences(seqs.seqs, nreport, True)
+                    ]
+                    result = s.count_matrix(seqs, nreport)
+                    self.assertEqual(np.int64, result.dtype)
+                    self.assertEqual(expected, result.tolist())
+                    self.assertEqual(expected, list(s.count(seqs, nreport)))
+                    self.assertEqual(
+                        np.sum(expected, 0).tolist(),
+                        s.total_count(seqs, nreport).tolist(),
+                    )
+
+                    # Sparse counts, in small batches
+                    with patch.object(scanner, "SPARSE_BATCH_SIZE", 7):
+                        result = s.count_matrix(seqs, nreport, sparse=True)
+                    self.assertEqual(count_dtype(nreport), result.dtype)
+                    self.assertEqual(expected, result.toarray().tolist())
+
+    def test10_count_and_best_score(self):
+        """ Counts and scores in one pass are the same as separately """
+        seqs = Fasta("test/data/scan/scan_test_regions.fa")
+        for ncpus in [1, 2]:
+            s = Scanner(ncpus=ncpus)
+            s.set_motifs("test/data/pwms/motifs.pwm")
+            for threshold in [0.0, 0.8]:
+                s.set_threshold(threshold=threshold)
+                for nreport in [0, 1, 10]:
+                    counts, scores = s.count_and_best_score(seqs, nreport)
+                    np.testing.assert_array_equal(s.count_matrix(seqs, nreport), counts)
+                    np.testing.assert_array_equal(s.best_score_matrix(seqs), scores)
+
+    def test11_get_seq_bins(self):
+        """ GC% bins of sequences """
+        s = Scanner()
+        s.gc_bins = [(0.0, 0.2), (0.8, 1)] + [
+            (b, b + 0.05) for b in np.arange(0.2, 0.799, 0.05)
+        ]
+        seqs = ["", "AAAA", "ATGC", "GGGGC", "GCAAAAAAAA", "gcaaaaaaaa", "GAAAA"]
+        expected = [
+            "0.00-0.20",
+            "0.00-0.20",
+            "0.45-0.50",
+            "0.80-1.00",
+            "0.00-0.20",
+            "0.00-0.20",
+            "0.00-0.20",
+        ]
+        bins = s.get_seq_bins(seqs)
+        self.assertEqual(expected, [s.gc_bin_names()[i] for i in bins])
+        self.assertEqual(expected, [s.get_seq_bin(seq) for seq in seqs])
+
+        s.gc_bins = [(0.5, 1)]
+        with self.assertRaises(ValueError):
+            s.get_seq_bins(seqs)
+
+    def test12_gc_thresholds(self):
+        """ Thresholds for a mixture of GC% bins """
+        fname = "test/data/scan/scan_test_regions.fa"
+        s = Scanner(ncpus=1)
+        s.set_motifs("test/data/pwms/motifs.pwm")
+        s.set_background(fname=fname)
+        s.gc_bins = [(0.0, 0.2), (0.8, 1)] + [
+            (b, b + 0.05) for b in np.arange(0.2, 0.799, 0.05)
+        ]
+        seqs = Fasta(fname).seqs
+        for fpr in [0.01, 0.1]:
+            s.set_threshold(fpr=fpr)
+            self.assertGreater(s.threshold.index.nunique(), 1)
+
+            # Same GC% distribution as the background, so all background
+            # scores have the same weight
+            thresholds = s.get_gc_thresholds(seqs)
+            for motif in read_motifs(s.motifs):
+                scores = np.sort(s.threshold[motif.id].values)
+                expected = scores[int(np.floor((1 - fpr) * len(scores)))]
+                if expected < motif.pwm_max_score():
+                    self.assertAlmostEqual(expected, thresholds[motif.id])
+                else:
+                    self.assertIsNone(thresholds[motif.id])
+
+            # Memoised on the number of sequences per GC% bin
+            self.assertEqual(thresholds, s.get_gc_thresholds(seqs[::-1]))
+
+        # Every batch of the input gets the thresholds of its own GC% bins,
+        # and the input is read only once
+        expected = np.vstack(
+            [
+                s.count_matrix(encode_seqs(seqs[i : i + 7]))
+                for i in range(0, len(seqs), 7)
+            ]
+        )
+        with patch.object(scanner, "INPUT_BATCH_SIZE", 7), patch.object(
+            s, "_input_batches", wraps=s._input_batches
+        ) as batches:
+            np.testing.assert_array_equal(expected, s.count_matrix(fname))
+            self.assertEqual(1, batches.call_count)
+
+    def test13_scan_to_columnar(self):
+        """ Columnar scan output """
+        kwargs = dict(fpr=None, cutoff=0.9, ncpus=1, zscore=False, gcnorm=False)
+        fname = os.path.join(self.tmpdir, "hits.arrow")
+        scan_to_file(self.fa, self.motifs, fname, fmt="arrow", **kwargs)
+        hits = pd.read_feather(fname)
+        self.assertEqual(["region", "motif", "pos", "score", "strand"], list(hits))
+
+        s = Scanner(ncpus=1)
+        s.set_motifs(self.motifs)
+        s.set_threshold(threshold=0.9)
+        f = Fasta(self.fa)
+        expected = [
+            (seq_id, score, pos, strand)
+            for seq_id, result in zip(f.ids, s.scan(f, nreport=1))
+            for score, pos, strand in result[0]
+        ]
+        self.assertEqual([e[0] for e in expected], list(hits["region"]))
+        self.assertEqual([e[2] for e in expected], list(hits["pos"]))
+        np.testing.assert_allclose([e[1] for e in expected], hits["score"], 1e-6)
+
+        fname = os.path.join(self.tmpdir, "counts.parquet")
+        scan_to_file(self.fa, self.motifs, fname, fmt="parquet", table=True, **kwargs)
+        counts = pd.read_parquet(fname).set_index("region")
+        self.assertEqual(f.ids, list(counts.index))
+        np.testing.assert_array_equal(s.count_matrix(f, nreport=1), counts.values)
+
+        with self.assertRaises(ValueError):
+            scan_to_file(self.fa, self.motifs, fname, fmt="csv", **kwargs)
+
+    def test14_input_batches(self):
+        """ Input is scanned in batches, with the same result """
+        fname = "test/data/scan/scan_test_regions.fa"
+        s = Scanner(ncpus=1)
+        s.set_motifs("test/data/pwms/motifs.pwm")
+        s.set_background(fname=fname)
+        s.set_threshold(fpr=0.02)
+        seqs = Fasta(fname)
+
+        expected = [
+            s.count_matrix(seqs),
+            s.best_score_matrix(seqs, zscore=True, gc=False),
+            *s.count_and_best_score(seqs, zscore=True, gc=False),
+        ]
+        with patch.object(scanner, "INPUT_BATCH_SIZE", 7):
+            self.assertEqual(
+                7, max(len(batch[1]) - 1 for batch in s._input_batches(fname))
+            )
+            for inputs in [fname, seqs]:
+                result = [
+                    s.count_matrix(inputs),
+                    s.best_score_matrix(inputs, zscore=True, gc=False),
+                    *s.count_and_best_score(inputs, zscore=True, gc=False),
+                ]
+                for a, b in zip(expected, result):
+                    np.testing.assert_array_equal(a, b)
+                counts, scores = s.count_and_best_score(
+                    inputs, zscore=True, gc=False, sparse=True
+                )
+                np.testing.assert_array_equal(expected[2], counts.toarray())
+                np.testing.assert_array_equal(expected[3], scores)
+                self.assertEqual(expected[0].tolist(), list(s.count(inputs)))
+
+    def test15_scan_regionfile(self):
+        """ Region table is read in chunks """
+        genome = "test/data/genomes/hg38sample/hg38sample.fa"
+        fname = os.path.join(self.tmpdir, "regions.txt")
+        regions = [
+            f"chr{c}:{i * 500}-{i * 500 + 200}" for c in [1, 2, 8] for i in range(5)
+        ]
+        pd.DataFrame({"value": range(len(regions))}, index=regions).to_csv(
+            fname, sep="\t"
+        )
+        with patch.object(scanner, "TABLE_CHUNK_SIZE", 4):
+            result = scan_regionfile_to_table(
+                fname, genome, "count", pfmfile=self.motifs, ncpus=1, gc=False
+            )
+        self.assertEqual(regions, list(result.index))
+
+        s = Scanner(ncpus=1)
+        s.set_motifs(self.motifs)
+        s.set_genome(genome)
+        s.set_background(genome=genome, gc=False)
+        s.set_threshold(fpr=FPR)
+        np.testing.assert_array_equal(s.count_matrix(regions), result.values)
+
     def testThreshold(self):
         s = Scanner()
         s.set_motifs("test/data/pwms/motifs.pwm")
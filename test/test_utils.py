@@ -52,6 +52,27 @@ class TestUtils(unittest.TestCase):
 
         rmtree(tmpdir)
 
+    def test3_as_fasta_batches(self):
+        """ read bed, regions, etc in batches of Fasta """
+        g = Genome("genome", genomes_dir=self.genomes_dir)
+
+        fafile = os.path.join(self.datadir, "test.fa")
+        bedfile = os.path.join(self.datadir, "test.bed")
+        regionfile = os.path.join(self.datadir, "test.txt")
+        with open(regionfile) as f:
+            regions = [l.strip() for l in f]
+
+        for to_convert in [fafile, Fasta(fafile), bedfile, regionfile, regions]:
+            fa = as_fasta(to_convert, g)
+            for batch_size in [1, 2, 1000]:
+                batches = list(as_fasta_batches(to_convert, g, batch_size=batch_size))
+                self.assertTrue(all(len(b) <= batch_size for b in batches))
+                self.assertEqual(fa.ids, sum([b.ids for b in batches], []))
+                self.assertEqual(fa.seqs, sum([b.seqs for b in batches], []))
+
+        with self.assertRaises(ValueError):
+            list(as_fasta_batches(bedfile))
+
     def test_checkum(self):
         fname = "test/data/fasta/test.fa"
         md5 = "a34798835d4110c34df45bbd8ed2f910"